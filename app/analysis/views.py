@@ -199,8 +199,7 @@ def download_json():
     tag_nodes = {}  # key = str(tag), value = {} (tag node)
     tag_edges = []
 
-    tagged_objects = alert.all_analysis
-    tagged_objects.extend(alert.all_observables)
+    tagged_objects = alert.all
 
     for tagged_object in tagged_objects:
         for tag in tagged_object.tags:
@@ -232,7 +231,8 @@ def redirect_to():
         flash("internal error")
         return redirect(url_for('analysis.index'))
 
-    if not alert.load():
+    # only the file observable is needed
+    if not alert.load(lazy=True):
         flash("internal error")
         logging.error("unable to load alert {0}".format(alert))
         return redirect(url_for('analysis.index'))
@@ -251,7 +251,7 @@ def redirect_to():
 
     # find the observable with this uuid
     try:
-        file_observable = alert.observable_store[file_uuid]
+        file_observable = alert.get_observable(file_uuid)
     except KeyError:
         logging.error("missing file observable uuid {0} for alert {1} user {2}".format(
             file_uuid, alert, current_user))
@@ -379,7 +379,8 @@ def download_file():
         flash("internal error")
         return redirect(url_for('analysis.index'))
 
-    if not alert.load():
+    # only the file observable is needed
+    if not alert.load(lazy=True):
         flash("internal error")
         logging.error("unable to load alert {0}".format(alert))
         return redirect(url_for('analysis.index'))
@@ -406,7 +407,7 @@ def download_file():
 
     # find the observable with this uuid
     try:
-        file_observable = alert.observable_store[file_uuid]
+        file_observable = alert.get_observable(file_uuid)
     except KeyError:
         logging.error("missing file observable uuid {0} for alert {1} user {2}".format(
             file_uuid, alert, current_user))
@@ -1354,7 +1355,8 @@ def search():
     for uuid in list(set(uuids)):
         try:
             alert = db.session.query(GUIAlert).filter(GUIAlert.uuid == uuid).one()
-            alert.load()
+            # the results only display the alert itself
+            alert.load(lazy=True)
             alerts.append(alert)
         except Exception as e:
             logging.error("unable to load alert uuid {0}: {1}".format(uuid, str(e)))
@@ -3620,7 +3622,7 @@ def image():
     observable_uuid = request.values['observable_uuid']
 
     alert = db.session.query(GUIAlert).filter(GUIAlert.uuid == alert_uuid).one()
-    alert.load()
+    alert.load(lazy=True)
     _file = alert.get_observable(observable_uuid)
 
     with open(_file.path, 'rb') as fp:
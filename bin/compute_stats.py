@@ -1,7 +1,14 @@
 #!/usr/bin/env python3
+#
+# computes analysis module execution time statistics
+#
+# reads the module_timings.csv histogram rollups the engines write to stats/modules/ENGINE/YYYYMMDD/
+# if no files are given then it reads either a rollup or the older .stats format (one timedelta per line) from stdin
+#
 
 import sys
 import argparse
+import csv
 import os
 import os.path
 import re
@@ -9,40 +16,121 @@ import re
 regex = re.compile(r'^(\d+):(\d\d):(\d\d)\.(\d+)$')
 alt_regex = re.compile(r'^(\d+):(\d\d):(\d\d)$')
 
-count = 0
-total = 0.0
-_max = 0.0
-_min = 100000
-minimum_considered = 1.0
-excluded = 0
-
-for line in sys.stdin:
-    if count == 1000000:
-        break
-
-    m = regex.match(line.strip())
-    if m:
-        hour, minute, second, frac = m.groups()
-    else:
-        m = alt_regex.match(line.strip())
+ROLLUP_HEADER = 'timestamp,engine,module,observable_type,count,sum,buckets'
+
+def compute_legacy_stats(lines):
+    count = 0
+    total = 0.0
+    _max = 0.0
+    _min = 100000
+    minimum_considered = 1.0
+    excluded = 0
+
+    for line in lines:
+        if count == 1000000:
+            break
+
+        m = regex.match(line.strip())
         if m:
-            hour, minute, second = m.groups()
-            frac = "000000"
+            hour, minute, second, frac = m.groups()
         else:
-            sys.stderr.write("ERROR: line {} in {} failed regex\n".format(line.strip(), stats_file))
+            m = alt_regex.match(line.strip())
+            if m:
+                hour, minute, second = m.groups()
+                frac = "000000"
+            else:
+                sys.stderr.write("ERROR: line {} failed regex\n".format(line.strip()))
+                continue
+
+        total_seconds = float('0.{}'.format(frac)) + float(second) + (float(minute) * 60.0) + (float(hour) * 60.0 * 60.0)
+        if total_seconds < minimum_considered:
+            excluded += 1
             continue
 
-    total_seconds = float('0.{}'.format(frac)) + float(second) + (float(minute) * 60.0) + (float(hour) * 60.0 * 60.0)
-    if total_seconds < minimum_considered:
-        excluded += 1
-        continue
+        total += total_seconds
+        count += 1
+        if total_seconds > _max:
+            _max = total_seconds
+        if total_seconds < _min:
+            _min = total_seconds
+
+    if count:
+        print("total {} averge {:.2f} max {:.2f} min {:.2f} (excluded {})".format(count, total / float(count), _max, _min, excluded))
+
+class Histogram(object):
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.buckets = {} # key = upper bound, value = count
+
+    def add(self, count, total, buckets):
+        self.count += count
+        self.total += total
+        for bucket in buckets.split():
+            upper_bound, bucket_count = bucket.rsplit(':', 1)
+            upper_bound = float(upper_bound)
+            self.buckets[upper_bound] = self.buckets.get(upper_bound, 0) + int(bucket_count)
+
+    def percentile(self, p):
+        """Returns the upper bound of the bucket that contains the given percentile."""
+        target = self.count * p
+        cumulative = 0
+        for upper_bound in sorted(self.buckets.keys()):
+            cumulative += self.buckets[upper_bound]
+            if cumulative >= target:
+                return upper_bound
+
+        return float('inf')
+
+    @property
+    def maximum(self):
+        return max(self.buckets.keys()) if self.buckets else 0.0
+
+def compute_rollup_stats(lines, by_type=False):
+    histograms = {} # key = tuple(engine, module[, observable_type]), value = Histogram
+    for row in csv.DictReader(lines):
+        try:
+            key = (row['engine'], row['module'])
+            if by_type:
+                key = key + (row['observable_type'],)
+
+            if key not in histograms:
+                histograms[key] = Histogram()
+
+            histograms[key].add(int(row['count']), float(row['sum']), row['buckets'])
+        except Exception as e:
+            sys.stderr.write("ERROR: invalid row {}: {}\n".format(row, e))
+
+    for key in sorted(histograms.keys()):
+        h = histograms[key]
+        print("{}: total {} average {:.2f} p50 {:.3f} p90 {:.3f} p99 {:.3f} max {:.3f}".format(
+              ':'.join([x for x in key if x]), h.count, h.total / h.count if h.count else 0.0,
+              h.percentile(0.5), h.percentile(0.9), h.percentile(0.99), h.maximum))
+
+def read_rollups(paths):
+    """Yields the csv lines of all the given rollup files with a single header."""
+    yield ROLLUP_HEADER + '\n'
+    for path in paths:
+        with open(path, 'r', newline='') as fp:
+            for line in fp:
+                if line.startswith('timestamp,'):
+                    continue
+
+                yield line
+
+parser = argparse.ArgumentParser(description="Computes analysis module execution time statistics.")
+parser.add_argument('files', nargs='*', help="The module_timings.csv files to read. Reads stdin by default.")
+parser.add_argument('-t', '--by-type', action='store_true', default=False, dest='by_type',
+    help="Break down the statistics by observable type.")
+args = parser.parse_args()
 
-    total += total_seconds
-    count += 1
-    if total_seconds > _max:
-        _max = total_seconds
-    if total_seconds < _min:
-        _min = total_seconds
+if args.files:
+    compute_rollup_stats(read_rollups(args.files), by_type=args.by_type)
+    sys.exit(0)
 
-if count:
-    print("total {} averge {:.2f} max {:.2f} min {:.2f} (excluded {})".format(count, total / float(count), _max, _min, excluded))
+# figure out which format we are reading from stdin
+first_line = sys.stdin.readline()
+if first_line.startswith('timestamp,'):
+    compute_rollup_stats([ first_line ] + list(sys.stdin), by_type=args.by_type)
+else:
+    compute_legacy_stats([ first_line ] + list(sys.stdin))
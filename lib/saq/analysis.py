@@ -5,6 +5,7 @@ import collections
 import copy
 import datetime
 import gc
+import hashlib
 import importlib
 import json
 import logging
@@ -21,9 +22,12 @@ import dateutil.parser
 import requests
 
 import saq
+from saq.blob_store import get_blob_store, copy_file, remove_file, STAT_DEDUPLICATED_FILES, STAT_DEDUPLICATED_BYTES
 from saq.constants import *
+from saq.details_store import DetailsStore
 from saq.error import report_exception
 from saq.lock import LocalLockableObject
+from saq.serialization import get_codec, JSONEncoder as _JSONEncoder
 
 ##############################################################################
 #
@@ -386,17 +390,9 @@ class AlertSubmitException(Exception):
     pass
 
 # utility class to translate custom objects into JSON
-class _JSONEncoder(json.JSONEncoder):
-    def default(self, obj):
-        if isinstance(obj, datetime.datetime):
-            return obj.isoformat()
-        elif isinstance(obj, bytes):
-            return obj.decode('unicode_escape', 'replace')
-        elif hasattr(obj, 'json'):
-            return obj.json
-        else:
-            logging.debug('json type {0}'.format(type(obj)))
-            return super(_JSONEncoder, self).default(obj)
+def _json_digest(data):
+    """Returns the digest of the given encoded JSON.  This is used to tell if something changed since it was written."""
+    return hashlib.md5(data).digest()
 
 class Tag(object):
     """Gives a bit of metadata to an observable or analysis.  Tags defined in the configuration file are also signals for detection."""
@@ -495,6 +491,13 @@ class TaggableObject(EventSource):
         assert isinstance(value, list)
         assert all([isinstance(i, str) or isinstance(i, Tag) for i in value])
         self._tags = value
+        self._invalidate_tree_views()
+
+    def _invalidate_tree_views(self):
+        """Called when this object changes without firing an event so the RootAnalysis rebuilds the all_* views."""
+        root = getattr(self, 'root', None)
+        if isinstance(root, RootAnalysis):
+            root._tree_views = {}
 
     def add_tag(self, tag):
         assert isinstance(tag, str)
@@ -508,6 +511,7 @@ class TaggableObject(EventSource):
 
     def clear_tags(self):
         self._tags = []
+        self._invalidate_tree_views()
 
     def has_tag(self, tag_value):
         """Returns True if this object has this tag."""
@@ -560,6 +564,8 @@ class Analysis(TaggableObject, DetectableObject, ProfileObject):
         self.external_details_path = None
         # gets set to True when the external details has been loaded from disk
         self.external_details_loaded = False
+        # the digest of the details as they were last loaded or saved (see save)
+        self._details_digest = None
 
         self.defined_details_properties = {}
 
@@ -642,12 +648,12 @@ class Analysis(TaggableObject, DetectableObject, ProfileObject):
         self._summary = self.generate_summary()
 
         # try to catch a case where we set the data but forgot to load first
+        store = self.root.details_store
         overwrite_warning = False
         if self._details is not None and not self.external_details_loaded and self.external_details_path is not None:
-            full_path = os.path.join(saq.SAQ_RELATIVE_DIR, self.root.storage_dir, '.ace', self.external_details_path)
-            if os.path.exists(full_path):
+            if store.exists(self.external_details_path):
                 logging.warning("saving new data over existing data without loading existing data in {} from {}".format(self, self.external_details_path))
-                logging.warning("previous file size was {} bytes".format(os.path.getsize(full_path)))
+                logging.warning("previous file size was {} bytes".format(store.size(self.external_details_path)))
                 logging.warning("new details is type {} value {}".format(type(self._details), self._details))
                 overwrite_warning = True
 
@@ -655,23 +661,24 @@ class Analysis(TaggableObject, DetectableObject, ProfileObject):
         if self.external_details_path is None:
             self.external_details_path = '{}_{}.json'.format(type(self).__name__, str(uuid.uuid4()))
 
-        # make sure the containing directory exists
-        if not os.path.exists(os.path.join(saq.SAQ_RELATIVE_DIR, self.storage_dir)):
-            os.makedirs(os.path.join(saq.SAQ_RELATIVE_DIR, self.storage_dir))
+        # the details are usually modified in place (without calling set_modified)
+        # so we compare what we would write with what was last loaded or saved
+        details_json = get_codec().encode(self._details)
+        details_digest = _json_digest(details_json)
+        if details_digest == self._details_digest and store.exists(self.external_details_path):
+            #logging.debug("SAVE: external details for {} did not change".format(self))
+            self.external_details_loaded = True
+            return
 
-        # analysis details go into a hidden directory
-        if not os.path.exists(os.path.join(saq.SAQ_RELATIVE_DIR, self.storage_dir, '.ace')):
-            os.makedirs(os.path.join(saq.SAQ_RELATIVE_DIR, self.storage_dir, '.ace'))
-        
         # save the details
         logging.debug("SAVE: saving external details for {} to {}".format(self, self.external_details_path))
-        with open(os.path.join(saq.SAQ_RELATIVE_DIR, self.storage_dir, '.ace', self.external_details_path), 'w') as fp:
-            json.dump(self._details, fp, cls=_JSONEncoder)
-            _track_writes()
+        store.write(self.external_details_path, details_json)
+        _track_writes()
+
+        self._details_digest = details_digest
 
         if overwrite_warning:
-            full_path = os.path.join(saq.SAQ_RELATIVE_DIR, self.root.storage_dir, '.ace', self.external_details_path)
-            logging.warning("new file size is {} bytes".format(os.path.getsize(full_path)))
+            logging.warning("new file size is {} bytes".format(len(details_json)))
 
         # at this point we consider the data "loaded"
         self.external_details_loaded = True
@@ -687,14 +694,12 @@ class Analysis(TaggableObject, DetectableObject, ProfileObject):
         """Deletes the current analysis output if it exists."""
         logging.debug("called reset() on {}".format(self))
         if self.external_details_path is not None:
-            full_path = os.path.join(saq.SAQ_RELATIVE_DIR, self.root.storage_dir, '.ace', self.external_details_path)
-            if os.path.exists(full_path):
-                logging.debug("removing external details file {}".format(full_path))
-                os.remove(full_path)
-            else:
-                logging.warning("external details path {} does not exist".format(full_path))
+            logging.debug("removing external details {}".format(self.external_details_path))
+            if not self.root.details_store.delete(self.external_details_path):
+                logging.warning("external details path {} does not exist".format(self.external_details_path))
 
         self._details = None
+        self._details_digest = None
         self.external_details_path = None
         self.external_details = None
         self.external_details_loaded = False
@@ -756,16 +761,17 @@ class Analysis(TaggableObject, DetectableObject, ProfileObject):
         self._details = None
         details_file_path = os.path.join(saq.SAQ_RELATIVE_DIR, self.storage_dir, '.ace', self.external_details_path)
 
-        if not os.path.exists(details_file_path):
-            logging.warning("missing file {0}".format(details_file_path))
-            return None
+        try:
+            details_json = self.root.details_store.read(self.external_details_path)
+            if details_json is None:
+                logging.warning("missing file {0}".format(details_file_path))
+                return None
 
-        if os.path.getsize(details_file_path) > 1024 * 1024:
-            logging.debug("JSON file {0} is very large: {1} bytes".format(details_file_path, os.path.getsize(details_file_path)))
+            if len(details_json) > 1024 * 1024:
+                logging.debug("JSON file {0} is very large: {1} bytes".format(details_file_path, len(details_json)))
 
-        try:
-            with open(details_file_path, 'r') as fp:
-                self._details = json.load(fp)
+            self._details = get_codec().decode(details_json)
+            self._details_digest = _json_digest(details_json)
 
             _track_reads()
 
@@ -852,6 +858,7 @@ class Analysis(TaggableObject, DetectableObject, ProfileObject):
         assert isinstance(value, list)
         assert all(isinstance(o, str) or isinstance(o, Observable) for o in self._observables)
         self._observables = value
+        self._invalidate_tree_views()
 
     def has_observable(self, o_or_o_type=None, o_value=None):
         """Returns True if this Analysis has this Observable.  Accepts a single Observable or o_type, o_value."""
@@ -865,6 +872,7 @@ class Analysis(TaggableObject, DetectableObject, ProfileObject):
     def clear_observables(self):
         """Clears any existing Observables. This is typically only used in special cases such as merging."""
         self._observables = []
+        self._invalidate_tree_views()
 
     @property
     def children(self):
@@ -879,10 +887,11 @@ class Analysis(TaggableObject, DetectableObject, ProfileObject):
 
         _buffer = []
         for uuid in self._observables:
-            if uuid not in self.root.observable_store:
+            observable = self.root._load_observable(uuid)
+            if observable is None:
                 logging.warning("missing observable with uuid {} in {}".format(uuid, self.root))
             else:
-                _buffer.append(self.root.observable_store[uuid])
+                _buffer.append(observable)
 
         self._observables = _buffer
         #self._observables = [self.root.observable_store[uuid] for uuid in self._observables]
@@ -1214,6 +1223,10 @@ class Observable(TaggableObject, DetectableObject, ProfileObject):
         self._excluded_analysis = []
         self._relationships = []
 
+        # set to True when the Analysis of this Observable is built the first time it is used
+        # (see RootAnalysis._load_observable)
+        self._lazy_analysis = False
+
         if json is not None:
             self.json = json
         else:
@@ -1252,7 +1265,7 @@ class Observable(TaggableObject, DetectableObject, ProfileObject):
         if super().is_suspect:
             return True
 
-        for a in self._analysis.values():
+        for a in self.analysis.values():
             if not a:
                 continue
             if a.has_detection_points():
@@ -1333,6 +1346,7 @@ class Observable(TaggableObject, DetectableObject, ProfileObject):
     def type(self, value):
         assert value in VALID_OBSERVABLE_TYPES
         self._type = value
+        self._invalidate_index()
 
     @property
     def value(self):
@@ -1341,6 +1355,7 @@ class Observable(TaggableObject, DetectableObject, ProfileObject):
     @value.setter
     def value(self, value):
         self._value = value
+        self._invalidate_index()
 
     @property
     def time(self):
@@ -1349,6 +1364,13 @@ class Observable(TaggableObject, DetectableObject, ProfileObject):
     @time.setter
     def time(self, value):
         self._time = value # TODO check value
+        self._invalidate_index()
+
+    def _invalidate_index(self):
+        """Called when the type, value or time changes so the RootAnalysis rebuilds its observable index."""
+        root = getattr(self, 'root', None)
+        if isinstance(root, RootAnalysis):
+            root._observable_index = None
 
     @property
     def directives(self):
@@ -1494,13 +1516,14 @@ class Observable(TaggableObject, DetectableObject, ProfileObject):
                 r = Relationship()
                 r.json = value
 
-                try:
-                    # find the observable this points to and reference that
-                    r.target = self.root._observable_store[r.target]
-                except KeyError:
+                # find the observable this points to and reference that
+                target = self.root._load_observable(r.target)
+                if target is None:
                     logging.error("missing observable uuid {} in {}".format(r.target, self))
                     continue
 
+                r.target = target
+
                 value = r
 
             temp.append(value)
@@ -1554,18 +1577,22 @@ class Observable(TaggableObject, DetectableObject, ProfileObject):
     def analysis(self):
         """The dict of Analysis objects executed against this Observable.
            key = Analysis.module_path, value = Analysis or False."""
+        if self._lazy_analysis:
+            self.root._load_observable_analysis(self)
+
         return self._analysis
 
     @analysis.setter
     def analysis(self, value):
         assert isinstance(value, dict)
         self._analysis = value
+        self._invalidate_tree_views()
 
     @property
     def all_analysis(self):
         """Returns a list of an Analysis objects executed against this Observable."""
         # we skip over lookups that return False here
-        return [a for a in self._analysis.values() if isinstance(a, Analysis)]
+        return [a for a in self.analysis.values() if isinstance(a, Analysis)]
 
     @property
     def children(self):
@@ -1575,7 +1602,7 @@ class Observable(TaggableObject, DetectableObject, ProfileObject):
     @property
     def parents(self):
         """Returns a list of Analysis objects that have this Observable."""
-        return [a for a in self.root.all_analysis if a and a.has_observable(self)]
+        return [a for a in self.root.get_references(self) if a]
 
     @property
     def dependencies(self):
@@ -1731,6 +1758,8 @@ class Observable(TaggableObject, DetectableObject, ProfileObject):
 
             self.analysis[module_path] = a # replace the JSON dict with the actual object
 
+        self._invalidate_tree_views()
+
     def clear_analysis(self):
         """Deletes all analysis records for this observable."""
         self.analysis = {}
@@ -1772,6 +1801,11 @@ class Observable(TaggableObject, DetectableObject, ProfileObject):
            By default does == comparison, can be overridden."""
         return self.value == other_value
 
+    def _index_value(self, value):
+        """Returns the given value the way it is hashed in the observable index of the RootAnalysis.
+           If you override _compare_value then override this so that values that compare equal return equal results."""
+        return value
+
     def __eq__(self, other):
         if not isinstance(other, Observable):
             return False
@@ -2073,6 +2107,9 @@ class RootAnalysis(LocalLockableObject, Analysis):
             # if a location is not specified then we default to locally defined value
             self.location = saq.SAQ_NODE
 
+        # see details_store
+        self._details_store = None
+
         self._storage_dir = None
         if storage_dir:
             self.storage_dir = storage_dir
@@ -2104,9 +2141,35 @@ class RootAnalysis(LocalLockableObject, Analysis):
         # these objects are what are serialized to and from JSON
         self._observable_store = {} # key = uuid, value = Observable object
 
+        # hash index of the observable_store used to find existing observables (see find_observable)
+        # key = tuple(type, time, indexed value), value = Observable object
+        # this is built when it's first needed and rebuilt when the observable_store is replaced
+        self._observable_index = None
+        # the Observable classes that have been indexed for each type (see _index_observable)
+        # key = type, value = dict(key = class, value = an Observable of that class)
+        self._observable_index_classes = None
+
+        # the views of the analysis tree returned by all_analysis, all_observables, all and all_tags
+        # key = VIEW_*, value = tuple
+        # these are built when they are first needed and discarded when the tree changes (see _update_tree_views)
+        self._tree_views = {}
+
+        # the digests of the JSON of each part of this root as it was last written to data.json or the journal
+        # key = observable id (or RootAnalysis.JOURNAL_ROOT for everything else), value = digest (see save)
+        # this is None until data.json has been written or loaded which means the next save rewrites data.json
+        self._journal_digests = None
+        # the size of the journal up to the end of the last complete save
+        self._journal_size = 0
+        # a new id is written to data.json every time it is written and each save in the journal commits with it
+        # so that a journal left behind by a rewrite of data.json that was interrupted is not applied to it
+        self._journal_generation = None
+
         # set to True after load() is called
         self.is_loaded = False
 
+        # set to True by load(lazy=True) until the entire analysis tree has been built (see _load_tree)
+        self._lazy_tree = False
+
         # we keep track of when delayed initially starts here
         # to allow for eventual timeouts when something is wrong
         # key = analysis_module:observable_uuid
@@ -2114,7 +2177,7 @@ class RootAnalysis(LocalLockableObject, Analysis):
         self.delayed_analysis_tracking = {} 
 
         # list of AnalysisDependency objects
-        self.dependency_tracking = []
+        self._dependency_tracking = []
 
         # we fire EVENT_GLOBAL_TAG_ADDED and EVENT_GLOBAL_OBSERVABLE_ADDED when we add tags and observables to anything
         # (note that we also need to add these global event listeners when we deserialize)
@@ -2123,6 +2186,8 @@ class RootAnalysis(LocalLockableObject, Analysis):
 
     def _fire_global_events(self, source, event_type, *args, **kwargs):
         """Fires EVENT_GLOBAL_* events."""
+        self._update_tree_views(source, event_type, *args, **kwargs)
+
         if event_type == EVENT_TAG_ADDED:
             self.fire_event(source, EVENT_GLOBAL_TAG_ADDED, *args, **kwargs)
         elif event_type == EVENT_OBSERVABLE_ADDED:
@@ -2137,6 +2202,23 @@ class RootAnalysis(LocalLockableObject, Analysis):
             self.fire_event(source, EVENT_GLOBAL_ANALYSIS_ADDED, *args, **kwargs)
         else:
             logging.error("unsupported global event type: {}".format(event_type))
+
+    # the names of the views of the analysis tree
+    VIEW_ANALYSIS = 'analysis'
+    VIEW_OBSERVABLES = 'observables'
+    VIEW_ALL = 'all'
+    VIEW_TAGS = 'tags'
+    VIEW_REFERENCES = 'references'
+
+    def _update_tree_views(self, source, event_type, *args, **kwargs):
+        """Discards the views of the analysis tree that are changed by the given event."""
+        if event_type == EVENT_TAG_ADDED:
+            self._tree_views.pop(RootAnalysis.VIEW_TAGS, None)
+        elif event_type == EVENT_OBSERVABLE_ADDED or event_type == EVENT_ANALYSIS_ADDED:
+            # the new object may already have analysis and tags
+            self._tree_views = {}
+            if event_type == EVENT_ANALYSIS_ADDED:
+                args[0].add_event_listener(EVENT_TAG_ADDED, self._update_tree_views)
         
     #
     # the json property is used for internal storage
@@ -2231,6 +2313,19 @@ class RootAnalysis(LocalLockableObject, Analysis):
         if RootAnalysis.KEY_DEPENDECY_TRACKING in value:
             self.dependency_tracking = value[RootAnalysis.KEY_DEPENDECY_TRACKING]
 
+    @property
+    def dependency_tracking(self):
+        """The list of AnalysisDependency objects."""
+        if self._lazy_tree:
+            self._load_tree()
+
+        return self._dependency_tracking
+
+    @dependency_tracking.setter
+    def dependency_tracking(self, value):
+        assert isinstance(value, list)
+        self._dependency_tracking = value
+
     @property
     def uuid(self):
         return self._uuid
@@ -2351,14 +2446,73 @@ class RootAnalysis(LocalLockableObject, Analysis):
     @property
     def observable_store(self):
         """Hash of the actual Observable objects generated during the analysis of this Alert.  key = uuid, value = Observable."""
+        if self._lazy_tree:
+            self._load_tree()
+
         return self._observable_store
 
     @observable_store.setter
     def observable_store(self, value):
         assert isinstance(value, dict)
         self._observable_store = value
+        self._observable_index = None
+        self._tree_views = {}
         self.set_modified()
 
+    @property
+    def observable_index(self):
+        """Returns the hash index of the observable_store, building it if needed."""
+        if self._observable_index is None:
+            self._observable_index = {}
+            self._observable_index_classes = {}
+            for observable in self.observable_store.values():
+                if isinstance(observable, Observable):
+                    self._index_observable(observable)
+
+        return self._observable_index
+
+    def _index_observable(self, observable):
+        # observables of the same type are all (normally) the same class
+        # we keep one of each class to compute the index values for lookups
+        self._observable_index_classes.setdefault(observable.type, {}).setdefault(type(observable), observable)
+        try:
+            # the first one recorded wins (same as a scan of the observable_store would)
+            self._observable_index.setdefault(
+                (observable.type, observable.time, observable._index_value(observable.value)), observable)
+        except TypeError:
+            pass # unhashable value (see find_observable)
+
+    def _scan_observables(self, target):
+        for o in self.observable_store.values():
+            if o == target:
+                return o
+
+        return None
+
+    def find_observable(self, target):
+        """Returns the Observable in the observable_store that is equal to the given Observable, or None."""
+        index = self.observable_index
+        for indexed_observable in list(self._observable_index_classes.get(target.type, {}).values()):
+            try:
+                result = index.get((target.type, target.time, indexed_observable._index_value(target.value)))
+            except TypeError:
+                # unhashable values are never indexed
+                return self._scan_observables(target)
+
+            if result is None:
+                continue
+
+            if result == target:
+                return result
+
+            # the observable was changed after it was indexed
+            logging.debug("observable index of {} is out of date".format(self))
+            self._observable_index = None
+            return self._scan_observables(target)
+
+        # the same observable (by id) is always equal
+        return self.observable_store.get(target.id)
+
     @property
     def storage_dir(self):
         """The base storage directory for output."""
@@ -2370,6 +2524,19 @@ class RootAnalysis(LocalLockableObject, Analysis):
         self._storage_dir = value
         self.set_modified()
 
+        # the details are stored relative to the storage directory
+        if self._details_store is not None:
+            self._details_store.close()
+            self._details_store = None
+
+    @property
+    def details_store(self):
+        """The DetailsStore that holds the details of all the Analysis of this root."""
+        if self._details_store is None:
+            self._details_store = DetailsStore(os.path.join(saq.SAQ_RELATIVE_DIR, self.storage_dir, '.ace'))
+
+        return self._details_store
+
     def initialize_storage(self):
         assert self.storage_dir
         try:
@@ -2404,6 +2571,11 @@ class RootAnalysis(LocalLockableObject, Analysis):
         """Path to the JSON file that stores this alert."""
         return os.path.join(saq.SAQ_RELATIVE_DIR, self.storage_dir, 'data.json')
 
+    @property
+    def journal_path(self):
+        """Path to the journal of the changes made since the JSON file was last written."""
+        return '{}.journal'.format(self.json_path)
+
     @property
     def name(self):
         """An optional property that defines a name for an alert.  
@@ -2648,14 +2820,20 @@ class RootAnalysis(LocalLockableObject, Analysis):
            Returns the new one if recorded or the existing one if not."""
         assert isinstance(observable, Observable)
 
-        # XXX gross this is probably pretty inefficient
-        for o in self.observable_store.values():
-            if o == observable:
-                logging.debug("returning existing observable {} ({}) [{}] <{}> for {} ({}) [{}] <{}>".format(o, id(o), o.id, o.type, observable, id(observable), observable.id, observable.type))
-                return o
+        o = self.find_observable(observable)
+        if o is not None:
+            logging.debug("returning existing observable {} ({}) [{}] <{}> for {} ({}) [{}] <{}>".format(o, id(o), o.id, o.type, observable, id(observable), observable.id, observable.type))
+            return o
 
         observable.root = self
         self.observable_store[observable.id] = observable
+        if self._observable_index is not None:
+            self._index_observable(observable)
+
+        # keep the all_* views up to date as this observable changes
+        observable.add_event_listener(EVENT_ANALYSIS_ADDED, self._update_tree_views)
+        observable.add_event_listener(EVENT_TAG_ADDED, self._update_tree_views)
+        self._update_tree_views(self, EVENT_OBSERVABLE_ADDED, observable)
         logging.debug("recorded observable {} with id {}".format(observable, observable.id))
         self.set_modified()
         return observable
@@ -2689,8 +2867,8 @@ class RootAnalysis(LocalLockableObject, Analysis):
             logging.debug("{} already submitted (not submitting)".format(self))
             return
 
-        # save everything to disk
-        self.save()
+        # save everything to disk (with the journal compacted into data.json)
+        self.compact()
 
         # if a target_company is specified then we look up where to send it
         # otherwise we default to what is in the network_client_ace section (old default)
@@ -2752,8 +2930,21 @@ class RootAnalysis(LocalLockableObject, Analysis):
         # remember that we sent this
         self.alerted = True
 
-    def save(self):
-        """Saves the Alert to disk. Resolves AttachmentLinks into Attachments. Note that this does not insert the Alert into the system."""
+    # journal entry keys
+    JOURNAL_ROOT = 'root'
+    JOURNAL_OBSERVABLE = 'observable'
+    JOURNAL_VALUE = 'value'
+    JOURNAL_REMOVED = 'removed'
+    JOURNAL_COMMIT = 'commit'
+    # the key in data.json of the generation the journal applies to
+    KEY_JOURNAL_GENERATION = 'journal_generation'
+
+    def save(self, compact=False):
+        """Saves the Alert to disk. Resolves AttachmentLinks into Attachments. Note that this does not insert the Alert into the system.
+
+           Once data.json has been written (or loaded) only the parts of the root that changed since then are
+           appended to the journal (see journal_path) unless compact is True (or journaling is disabled) in which case
+           data.json is rewritten and the journal is removed. Only details of Analysis that changed are written."""
         assert self.json_path is not None
         assert self.json is not None
 
@@ -2767,23 +2958,34 @@ class RootAnalysis(LocalLockableObject, Analysis):
         if not os.path.exists(os.path.join(saq.SAQ_RELATIVE_DIR, self.storage_dir, '.ace')):
             os.makedirs(os.path.join(saq.SAQ_RELATIVE_DIR, self.storage_dir, '.ace'))
 
-        # save all analysis
-        for analysis in self.all_analysis:
-            if analysis is not self:
-                analysis.save()
+        # all the details are written together (as a single transaction when they are packed)
+        with self.details_store.batch():
+            # save all analysis
+            for analysis in self.all_analysis:
+                if analysis is not self:
+                    analysis.save()
 
-        # save our own details
-        Analysis.save(self)
+            # save our own details
+            Analysis.save(self)
 
         # now the rest should encode as JSON with the custom JSON encoder
         try:
-            # we use a temporary file to deal with very large JSON files taking a long time to encode
-            # if we don't do this then the GUI will occasionally hit 0-byte data.json files
-            temp_path = '{}.tmp'.format(self.json_path)
-            with open(temp_path, 'w') as fp:
-                fp.write(_JSONEncoder().encode(self))
-                _track_writes()
-            shutil.move(temp_path, self.json_path)
+            codec = get_codec()
+            root_json = self.json
+            del root_json[RootAnalysis.KEY_OBSERVABLE_STORE]
+            parts = { RootAnalysis.JOURNAL_ROOT: codec.encode(root_json) }
+            for observable_id, observable in self.observable_store.items():
+                parts[observable_id] = codec.encode(observable)
+
+            journaled = False
+            if not compact and self._journal_digests is not None and os.path.exists(self.json_path) \
+            and saq.CONFIG['global'].getboolean('analysis_journal', fallback=True):
+                journaled = self._save_journal(parts)
+
+            # the journal is compacted when it gets bigger than data.json
+            if not journaled or self._journal_size > os.path.getsize(self.json_path):
+                self._save_json(parts)
+
         except Exception as e:
             logging.error("json encoding for {0} failed: {1}".format(self, str(e)))
             report_exception()
@@ -2791,8 +2993,160 @@ class RootAnalysis(LocalLockableObject, Analysis):
 
         return True
 
-    def load(self):
-        """Loads the Alert object from the JSON file.  Note that this does NOT load the details property."""
+    def compact(self):
+        """Rewrites data.json with everything in the journal.  This is called when analysis completes."""
+        return self.save(compact=True)
+
+    def _save_json(self, parts):
+        """Writes data.json from the given dict of the encoded parts of this root and removes the journal."""
+        # the observable store goes at the end of the JSON of the root
+        root_json = parts[RootAnalysis.JOURNAL_ROOT]
+        assert root_json.endswith(b'}')
+        observable_store_json = b', '.join([json.dumps(key).encode('utf8') + b': ' + value 
+                                            for key, value in parts.items() if key != RootAnalysis.JOURNAL_ROOT])
+
+        # we use a temporary file to deal with very large JSON files taking a long time to encode
+        # if we don't do this then the GUI will occasionally hit 0-byte data.json files
+        generation = str(uuid.uuid4())
+        temp_path = '{}.tmp'.format(self.json_path)
+        with open(temp_path, 'wb') as fp:
+            fp.write(root_json[:-1])
+            fp.write(', {}: {}'.format(json.dumps(RootAnalysis.KEY_JOURNAL_GENERATION),
+                                       json.dumps(generation)).encode('utf8'))
+            fp.write(', {}: {{'.format(json.dumps(RootAnalysis.KEY_OBSERVABLE_STORE)).encode('utf8'))
+            fp.write(observable_store_json)
+            fp.write(b'}}')
+            _track_writes()
+        shutil.move(temp_path, self.json_path)
+
+        # data.json now has everything in the journal
+        # (a journal left behind if this fails belongs to the previous generation and is ignored when loaded)
+        self._journal_generation = generation
+        if os.path.exists(self.journal_path):
+            os.remove(self.journal_path)
+
+        self._journal_digests = { key: _json_digest(value) for key, value in parts.items() }
+        self._journal_size = 0
+
+    def _save_journal(self, parts):
+        """Appends the parts of this root that changed since they were last written to the journal.
+           Returns False if the journal could not be written."""
+        entries = []
+        digests = {}
+        for key, value in parts.items():
+            digest = _json_digest(value)
+            if self._journal_digests.get(key) == digest:
+                continue
+
+            digests[key] = digest
+            if key == RootAnalysis.JOURNAL_ROOT:
+                entry = '{{"{}": '.format(RootAnalysis.JOURNAL_ROOT)
+            else:
+                entry = '{{"{}": {}, "{}": '.format(RootAnalysis.JOURNAL_OBSERVABLE, json.dumps(key), 
+                                                   RootAnalysis.JOURNAL_VALUE)
+
+            entries.append(entry.encode('utf8') + value + b'}\n')
+
+        removed = [key for key in self._journal_digests.keys() if key not in parts]
+        for key in removed:
+            entries.append('{{"{}": {}}}\n'.format(RootAnalysis.JOURNAL_REMOVED, json.dumps(key)).encode('utf8'))
+
+        if not entries:
+            return True
+
+        # the entries of a save are only used when the journal is loaded if the commit entry was written
+        entries.append('{{"{}": {}}}\n'.format(RootAnalysis.JOURNAL_COMMIT, 
+                                                json.dumps(self._journal_generation)).encode('utf8'))
+        journal_data = b''.join(entries)
+
+        try:
+            with open(self.journal_path, 'ab') as fp:
+                # the journal was removed (or replaced) by something else that saved this root
+                if fp.tell() < self._journal_size:
+                    logging.warning("journal of {} changed since it was loaded".format(self))
+                    return False
+
+                # anything past the last complete save was left by a save that failed part way through
+                # (or by an earlier generation of data.json)
+                if fp.tell() > self._journal_size:
+                    logging.warning("discarding {} bytes of incomplete or stale journal for {}".format(
+                                    fp.tell() - self._journal_size, self))
+                    fp.truncate(self._journal_size)
+                    fp.seek(self._journal_size)
+
+                fp.write(journal_data)
+                _track_writes()
+
+        except Exception as e:
+            logging.error("unable to write journal for {}: {}".format(self, e))
+            report_exception()
+            return False
+
+        self._journal_size += len(journal_data)
+        self._journal_digests.update(digests)
+        for key in removed:
+            del self._journal_digests[key]
+
+        logging.debug("SAVE: appended {} changes for {} to journal ({} bytes)".format(
+                      len(entries) - 1, self, self._journal_size))
+        return True
+
+    def _load_journal(self, data):
+        """Applies the complete saves in the journal to the given JSON dict of data.json.
+           Saves committed for another generation of data.json (see _journal_generation) are ignored.
+           Returns the size of the journal up to the end of the last complete save."""
+        if not os.path.exists(self.journal_path):
+            return 0
+
+        journal_size = 0
+        position = 0
+        pending = []
+        with open(self.journal_path, 'rb') as fp:
+            for line in fp:
+                position += len(line)
+                # a save that was interrupted can leave a partial entry at the end
+                if not line.endswith(b'\n'):
+                    break
+
+                try:
+                    entry = get_codec().decode(line)
+                except ValueError:
+                    break
+
+                if RootAnalysis.JOURNAL_COMMIT not in entry:
+                    pending.append(entry)
+                    continue
+
+                # data.json was rewritten after this was saved but the journal was not removed
+                if entry[RootAnalysis.JOURNAL_COMMIT] != self._journal_generation:
+                    logging.warning("ignoring stale journal of {}".format(self))
+                    _track_reads()
+                    return journal_size
+
+                for entry in pending:
+                    if RootAnalysis.JOURNAL_ROOT in entry:
+                        data.update(entry[RootAnalysis.JOURNAL_ROOT])
+                    elif RootAnalysis.JOURNAL_OBSERVABLE in entry:
+                        data[RootAnalysis.KEY_OBSERVABLE_STORE][entry[RootAnalysis.JOURNAL_OBSERVABLE]] = \
+                            entry[RootAnalysis.JOURNAL_VALUE]
+                    elif RootAnalysis.JOURNAL_REMOVED in entry:
+                        data[RootAnalysis.KEY_OBSERVABLE_STORE].pop(entry[RootAnalysis.JOURNAL_REMOVED], None)
+
+                pending = []
+                journal_size = position
+
+        _track_reads()
+        if pending or journal_size != position:
+            logging.warning("ignoring incomplete save at the end of the journal of {}".format(self))
+
+        return journal_size
+
+    def load(self, lazy=False):
+        """Loads the Alert object from the JSON file.  Note that this does NOT load the details property.
+
+           If lazy is True then only the root itself (uuid, description, event_time, etc...) and the Observables it
+           references are loaded.  The rest of the analysis tree is built as it is used: the Analysis of an Observable
+           when Observable.analysis is used and everything else when observable_store is used."""
         assert self.json_path is not None
         logging.debug("LOAD: called load() on {}".format(self))
 
@@ -2800,12 +3154,34 @@ class RootAnalysis(LocalLockableObject, Analysis):
             logging.warning("alert {} already loaded".format(self))
 
         try:
-            with open(self.json_path, 'r') as fp:
-                self.json = json.load(fp)
+            codec = get_codec()
+            # the decoded JSON has no reference cycles so the garbage collector would only slow this down
+            gc_enabled = gc.isenabled()
+            gc.disable()
+            try:
+                with open(self.json_path, 'rb') as fp:
+                    data = codec.decode(fp.read())
+            finally:
+                if gc_enabled:
+                    gc.enable()
 
             _track_reads()
 
+            # apply the changes saved since data.json was written
+            self._journal_generation = data.pop(RootAnalysis.KEY_JOURNAL_GENERATION, None)
+            self._journal_size = self._load_journal(data)
+
+            # remember what was saved so that only what changes is saved again
+            # (this has to happen before the JSON is turned into runtime objects)
+            # the digest of each Observable is taken when it is built (see _load_observable)
+            root_json = dict(data)
+            root_json.pop(RootAnalysis.KEY_OBSERVABLE_STORE, None)
+            self._journal_digests = { RootAnalysis.JOURNAL_ROOT: _json_digest(codec.encode(root_json)) }
+
+            self.json = data
+
             # translate the json into runtime objects
+            self._lazy_tree = lazy
             self._materialize()
             self.is_loaded = True
             # loaded Alerts are read-only until something is modified
@@ -2831,9 +3207,10 @@ class RootAnalysis(LocalLockableObject, Analysis):
         if not os.path.exists(os.path.join(saq.SAQ_RELATIVE_DIR, self.storage_dir, '.ace')):
             os.makedirs(os.path.join(saq.SAQ_RELATIVE_DIR, self.storage_dir, '.ace'))
 
-        for analysis in self.all_analysis:
-            if analysis is not self:
-                analysis.flush()
+        with self.details_store.batch():
+            for analysis in self.all_analysis:
+                if analysis is not self:
+                    analysis.flush()
 
         freed_items = gc.collect()
         #logging.debug("{} items freed by gc".format(freed_items))
@@ -2881,7 +3258,7 @@ class RootAnalysis(LocalLockableObject, Analysis):
                             logging.debug("copying merged file observable {} to {}".format(src_path, dest_path))
                             if not os.path.isdir(dest_dir):
                                 os.makedirs(dest_dir)
-                            shutil.copy(src_path, dest_path)
+                            copy_file(src_path, dest_path)
                         except Exception as e:
                             logging.error("unable to copy {} to {}: {}".format(src_path, dest_path, e))
                             report_exception()
@@ -2948,36 +3325,27 @@ class RootAnalysis(LocalLockableObject, Analysis):
                 target_analysis.add_observable(existing_observable)
 
     def _materialize(self):
-        """Utility function to replace specific dict() in json with runtime object references."""
-        # in other words, load the JSON
-        self._load_observable_store()
+        """Utility function to replace specific dict() in json with runtime object references.
+           If the root was loaded with load(lazy=True) then only the root itself is loaded here (see _load_tree.)"""
+        # load the Observable references, Tag objects and DetectionPoints of the root itself
+        self._load_observable_references()
+        self.tags = [Tag(json=t) for t in self.tags]
+        self.detections = [DetectionPoint.from_json(dp) for dp in self.detections]
 
-        # load the Analysis objects in the Observables
-        for observable in self.observable_store.values():
-            observable._load_analysis()
+        if not self._lazy_tree:
+            self._load_tree()
 
-        # load the Observable references in the Analysis objects
-        for analysis in self.all_analysis:
-            analysis._load_observable_references()
+    def _load_tree(self):
+        """Builds whatever has not been built yet of the analysis tree."""
+        self._lazy_tree = False
 
-        # load Tag objects for analysis
-        for analysis in self.all_analysis:
-            analysis.tags = [Tag(json=t) for t in analysis.tags]
-
-        # load Tag objects for observables
-        for observable in self.observable_store.values():
-            observable.tags = [Tag(json=t) for t in observable.tags]
-
-        # load DetectionPoints
-        for analysis in self.all_analysis:
-            analysis.detections = [DetectionPoint.from_json(dp) for dp in analysis.detections]
-
-        for observable in self.all_observables:
-            observable.detections = [DetectionPoint.from_json(dp) for dp in observable.detections]
+        # in other words, load the JSON
+        self._load_observable_store()
 
-        # load Relationships
-        for observable in self.all_observables:
-            observable._load_relationships()
+        # load the Analysis objects in the Observables
+        for observable in self._observable_store.values():
+            if observable._lazy_analysis:
+                self._load_observable_analysis(observable)
 
         # load dependency tracking
         _buffer = []
@@ -2994,31 +3362,69 @@ class RootAnalysis(LocalLockableObject, Analysis):
         self.dependency_tracking = _buffer
         for dep in self.dependency_tracking:
             self.link_dependencies(dep)
-        
+
+        self._observable_index = None
+        self._tree_views = {}
+
     def _load_observable_store(self):
+        """Builds every Observable in the observable_store (see _load_observable.)"""
+        for uuid in list(self._observable_store.keys()):
+            self._load_observable(uuid)
+
+    def _load_observable(self, uuid):
+        """Returns the Observable with the given uuid, building it from the JSON in the observable_store if it has
+           not been built yet.  The Analysis of the Observable is built the first time it is used.
+           Returns None if the Observable does not exist or is invalid."""
         from saq.observables import create_observable
-        invalid_uuids = [] # list of uuids that don't load for whatever reason
-        for uuid in self.observable_store.keys():
-            # get the JSON dict from the observable store for this uuid
-            value = self.observable_store[uuid]
-            # create the observable from the type and value
-            o = create_observable(value['type'], value['value'])
-            # basically this is backwards compatibility with old alerts that have invalid values for observables
-            if o:
-                o.root = self
-                o.json = value # this sets everything else
-
-                # set up the EVENT_GLOBAL_* events
-                o.add_event_listener(EVENT_ANALYSIS_ADDED, o.root._fire_global_events)
-                o.add_event_listener(EVENT_TAG_ADDED, o.root._fire_global_events)
-
-                self.observable_store[uuid] = o
-            else:
-                logging.warning("invalid observable type {} value {}".format(value['type'], value['value']))
-                invalid_uuids.append(uuid)
 
-        for uuid in invalid_uuids:
-            del self.observable_store[uuid]
+        # get the JSON dict from the observable store for this uuid
+        value = self._observable_store.get(uuid)
+        if not isinstance(value, dict):
+            return value
+
+        # remember what was loaded (see save)
+        if self._journal_digests is not None:
+            self._journal_digests[uuid] = _json_digest(get_codec().encode(value))
+
+        # create the observable from the type and value
+        o = create_observable(value['type'], value['value'])
+        # basically this is backwards compatibility with old alerts that have invalid values for observables
+        if not o:
+            logging.warning("invalid observable type {} value {}".format(value['type'], value['value']))
+            del self._observable_store[uuid]
+            return None
+
+        o.root = self
+        o.json = value # this sets everything else
+        # replace the JSON dict with the actual object before anything that references it is loaded
+        self._observable_store[uuid] = o
+
+        # set up the EVENT_GLOBAL_* events
+        o.add_event_listener(EVENT_ANALYSIS_ADDED, o.root._fire_global_events)
+        o.add_event_listener(EVENT_TAG_ADDED, o.root._fire_global_events)
+
+        # load Tag objects, DetectionPoints and Relationships
+        o.tags = [Tag(json=t) for t in o.tags]
+        o.detections = [DetectionPoint.from_json(dp) for dp in o.detections]
+        o._load_relationships()
+
+        o._lazy_analysis = True
+        self._observable_index = None
+        self._tree_views = {}
+        return o
+
+    def _load_observable_analysis(self, observable):
+        """Builds the Analysis objects of the given Observable (see _load_observable.)"""
+        observable._lazy_analysis = False
+
+        # load the Analysis objects in the Observable
+        observable._load_analysis()
+
+        # and then the Observable references, Tag objects and DetectionPoints in the Analysis objects
+        for analysis in observable.all_analysis:
+            analysis._load_observable_references()
+            analysis.tags = [Tag(json=t) for t in analysis.tags]
+            analysis.detections = [DetectionPoint.from_json(dp) for dp in analysis.detections]
 
     def reset(self):
         """Removes analysis, dispositions and any observables that did not originally come with the alert."""
@@ -3056,12 +3462,16 @@ class RootAnalysis(LocalLockableObject, Analysis):
                     logging.debug("deleting observable file {}".format(target_path))
 
                     try:
-                        os.remove(target_path)
+                        # this also removes the file from the blob store if nothing else references it
+                        remove_file(target_path, getattr(self.observable_store[uuid], 'sha256_hash', None))
                     except Exception as e:
                         logging.error("unable to remove {}: {}".format(target_path, str(e)))
 
             del self.observable_store[uuid]
 
+        self._observable_index = None
+        self._tree_views = {}
+
         # remove tags from observables
         for o in self.observables:
             o.clear_tags()
@@ -3074,6 +3484,40 @@ class RootAnalysis(LocalLockableObject, Analysis):
         p = Popen(['find', os.path.join(saq.SAQ_HOME, self.storage_dir), '-type', 'd', '-empty', '-delete'])
         p.wait()
 
+    def store_files(self):
+        """Replaces the files of the F_FILE observables with links to the blob store (if it is enabled) so that only
+           one copy of the content of each file is stored.  Returns the number of bytes saved."""
+        blob_store = get_blob_store()
+        if blob_store is None:
+            return 0
+
+        file_count = 0
+        saved_bytes = 0
+        for o in self.all_observables:
+            if o.type != F_FILE:
+                continue
+
+            target_path = os.path.join(saq.SAQ_RELATIVE_DIR, self.storage_dir, o.value)
+            if os.path.islink(target_path) or not os.path.isfile(target_path):
+                continue
+
+            try:
+                size = blob_store.add(target_path, getattr(o, 'sha256_hash', None))
+            except OSError as e:
+                # most likely not on the same file system
+                logging.warning("unable to add {} to the blob store: {}".format(target_path, e))
+                continue
+
+            if size:
+                file_count += 1
+                saved_bytes += size
+
+        if file_count:
+            blob_store.record(**{ STAT_DEDUPLICATED_FILES: file_count, STAT_DEDUPLICATED_BYTES: saved_bytes })
+            logging.info("deduplicated {} files in {} ({} bytes saved)".format(file_count, self, saved_bytes))
+
+        return saved_bytes
+
     def archive(self):
         """Removes the details of analysis and external files.  Keeps observables and tags."""
 
@@ -3106,7 +3550,8 @@ class RootAnalysis(LocalLockableObject, Analysis):
                     logging.debug("deleting observable file {}".format(target_path))
 
                     try:
-                        os.remove(target_path)
+                        # this also removes the file from the blob store if nothing else references it
+                        remove_file(target_path, getattr(o, 'sha256_hash', None))
                     except Exception as e:
                         logging.error("unable to remove {}: {}".format(target_path, str(e)))
 
@@ -3164,6 +3609,10 @@ class RootAnalysis(LocalLockableObject, Analysis):
 
     def delete(self):
         """Deletes everything contained in the storage_dir and marks this RootAnalysis as deleted."""
+        if self._details_store is not None:
+            self._details_store.close()
+            self._details_store = None
+
         try:
             if os.path.exists(self.storage_dir):
                 shutil.rmtree(self.storage_dir)
@@ -3177,7 +3626,12 @@ class RootAnalysis(LocalLockableObject, Analysis):
 
     @property   
     def all_analysis(self):
-        """Returns the list of all Analysis performed for this Alert."""
+        """Returns a read-only sequence of all Analysis performed for this Alert."""
+        try:
+            return self._tree_views[RootAnalysis.VIEW_ANALYSIS]
+        except KeyError:
+            pass
+
         result = []
         result.append(self)
         for observable in self.observable_store.values():
@@ -3185,6 +3639,7 @@ class RootAnalysis(LocalLockableObject, Analysis):
                 if analysis:
                     result.append(analysis)
 
+        result = self._tree_views[RootAnalysis.VIEW_ANALYSIS] = tuple(result)
         return result
 
     def get_analysis_by_type(self, a_type):
@@ -3193,8 +3648,14 @@ class RootAnalysis(LocalLockableObject, Analysis):
 
     @property
     def all_observables(self):
-        """Returns the list of all Observables discovered for this Alert."""
-        return self.observable_store.values()
+        """Returns a read-only sequence of all Observables discovered for this Alert."""
+        try:
+            return self._tree_views[RootAnalysis.VIEW_OBSERVABLES]
+        except KeyError:
+            pass
+
+        result = self._tree_views[RootAnalysis.VIEW_OBSERVABLES] = tuple(self.observable_store.values())
+        return result
 
     def get_observables_by_type(self, o_type):
         """Returns the list of Observables that match the given type."""
@@ -3202,14 +3663,23 @@ class RootAnalysis(LocalLockableObject, Analysis):
 
     @property
     def all(self):
-        """Returns the list of all Observables and Analysis for this RootAnalysis."""
-        result = self.all_analysis
-        result.extend(self.all_observables)
+        """Returns a read-only sequence of all Analysis and Observables for this RootAnalysis."""
+        try:
+            return self._tree_views[RootAnalysis.VIEW_ALL]
+        except KeyError:
+            pass
+
+        result = self._tree_views[RootAnalysis.VIEW_ALL] = self.all_analysis + self.all_observables
         return result
 
     @property
     def all_tags(self):
-        """Return all unique tags for the entire Alert."""
+        """Return a read-only sequence of all unique tags for the entire Alert."""
+        try:
+            return self._tree_views[RootAnalysis.VIEW_TAGS]
+        except KeyError:
+            pass
+
         result = []
         for analysis in self.all_analysis:
             if analysis.tags is not None:
@@ -3218,33 +3688,75 @@ class RootAnalysis(LocalLockableObject, Analysis):
             if observable.tags is not None:
                 result.extend(observable.tags)
 
-        return list(set(result))
+        result = self._tree_views[RootAnalysis.VIEW_TAGS] = tuple(set(result))
+        return result
+
+    @property
+    def reference_index(self):
+        """Returns the reverse reference index of the analysis tree, building it if needed.
+           key = id() of an Observable or Analysis
+           value = tuple of the Analysis objects that have the Observable (in all_analysis order)
+                   or the Observables that have the Analysis (in all_observables order)"""
+        try:
+            return self._tree_views[RootAnalysis.VIEW_REFERENCES]
+        except KeyError:
+            pass
+
+        result = {}
+        for analysis in self.all_analysis:
+            referenced = set()
+            for observable in analysis.observables:
+                # these are still uuids while the JSON is being loaded
+                if not isinstance(observable, Observable) or id(observable) in referenced:
+                    continue
+
+                referenced.add(id(observable))
+                result.setdefault(id(observable), []).append(analysis)
+
+        for observable in self.all_observables:
+            for analysis in observable.all_analysis:
+                result.setdefault(id(analysis), []).append(observable)
+
+        result = self._tree_views[RootAnalysis.VIEW_REFERENCES] = { key: tuple(value) 
+                                                                   for key, value in result.items() }
+        return result
+
+    def get_references(self, target):
+        """Returns a tuple of all objects that refer to target: the Analysis objects that have the given Observable
+           or the Observable that has the given Analysis."""
+        if isinstance(target, Observable):
+            # an Observable that is equal to one in this tree refers to the same thing
+            if self.observable_store.get(target.id) is not target:
+                existing = self.find_observable(target)
+                if existing is not None:
+                    target = existing
+        elif not isinstance(target, Analysis):
+            raise ValueError("invalid type {} passed to get_references".format(type(target)))
+
+        return self.reference_index.get(id(target), ())
 
     def iterate_all_references(self, target):
         """Iterators through all objects that refer to target."""
-        if isinstance(target, Observable):
-            for analysis in self.all_analysis:
-                if target in analysis.observables:
-                    yield analysis
-        elif isinstance(target, Analysis):
-            for observable in self.all_observables:
-                if target in observable.all_analysis:
-                    yield observable
-        else:
+        if not isinstance(target, Observable) and not isinstance(target, Analysis):
             raise ValueError("invalid type {} passed to iterate_all_references".format(type(target)))
 
+        yield from self.get_references(target)
+
     def get_observable(self, uuid):
         """Returns the Observable object for the given uuid."""
+        if self._lazy_tree:
+            # only build the Observable we are looking for (see load)
+            observable = self._load_observable(uuid)
+            if observable is None:
+                raise KeyError(uuid)
+
+            return observable
+
         return self.observable_store[uuid]
 
     def get_observable_by_spec(self, o_type, o_value, o_time=None):
         """Returns the Observable object by type and value, and optionally time, or None if it cannot be found."""
-        target = Observable(o_type, o_value, o_time)
-        for o in self.all_observables:
-            if o == target:
-                return o
-
-        return None
+        return self.find_observable(Observable(o_type, o_value, o_time))
 
     @property
     def all_detection_points(self):
@@ -3283,39 +3795,33 @@ def recurse_down(target, callback):
     assert isinstance(target, Analysis) or isinstance(target, Observable)
     assert isinstance(target.root, RootAnalysis)
 
-    visited = [] # keep track of what we've looked at
     root = target.root 
 
-    def _recurse(target, callback):
-        nonlocal visited, root
-        # make sure we haven't already looked at this one
-        if target in visited:
-            return
+    # are we at the end?
+    if target is root:
+        return
 
-        # are we at the end?
-        if target is root:
-            return
+    # keep track of what we've looked at (by id() so that cycles are only followed once)
+    visited = set([id(target)])
 
-        visited.append(target)
+    # depth first using the reverse reference index of the root (see RootAnalysis.get_references)
+    # each entry is an iterator of the objects that refer to something we've visited
+    stack = [ iter(root.get_references(target)) ]
+    while stack:
+        try:
+            parent = next(stack[-1])
+        except StopIteration:
+            stack.pop()
+            continue
 
-        if isinstance(target, Observable):
-            # find all Analysis objects that reference this Observable
-            for analysis in root.all_analysis:
-                for observable in analysis.observables:
-                    # not sure the == part is needed but just in case I screw up later...
-                    if target is observable or target == observable:
-                        callback(analysis)
-                        _recurse(analysis, callback)
-
-        elif isinstance(target, Analysis):
-            # find all Observable objects that reference this Analysis
-            for observable in root.all_observables:
-                for analysis in observable.all_analysis:
-                    if analysis is target:
-                        callback(observable)
-                        _recurse(observable, callback)
-
-    _recurse(target, callback)
+        callback(parent)
+
+        # make sure we haven't already looked at this one
+        if parent is root or id(parent) in visited:
+            continue
+
+        visited.add(id(parent))
+        stack.append(iter(root.get_references(parent)))
 
 def search_down(target, callback):
     """Searches from target down to RootAnalysis looking for callback(obj) to return True."""
@@ -3336,17 +3842,28 @@ def recurse_tree(target, callback):
     """A utility function to run the given callback on every Observable and Analysis rooted at the given Observable or Analysis object."""
     assert isinstance(target, Analysis) or isinstance(target, Observable)
 
-    def _recurse(target, visited, callback):
-        callback(target)
-        visited.append(target)
-
+    def _children(target):
         if isinstance(target, Analysis):
-            for observable in target.observables:
-                if observable not in visited:
-                    _recurse(observable, visited, callback)
-        elif isinstance(target, Observable):
-            for analysis in target.all_analysis:
-                if analysis and analysis not in visited:
-                    _recurse(analysis, visited, callback)
-
-    _recurse(target, [], callback)
+            return iter(target.observables)
+
+        return iter([analysis for analysis in target.all_analysis if analysis])
+
+    # keep track of what we've looked at (by id() so that cycles are only followed once)
+    visited = set([id(target)])
+    callback(target)
+
+    # depth first, each entry is an iterator of the children of something we've visited
+    stack = [ _children(target) ]
+    while stack:
+        try:
+            child = next(stack[-1])
+        except StopIteration:
+            stack.pop()
+            continue
+
+        if id(child) in visited:
+            continue
+
+        callback(child)
+        visited.add(id(child))
+        stack.append(_children(child))
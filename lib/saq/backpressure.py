@@ -0,0 +1,144 @@
+# vim: sw=4:ts=4:et:cc=120
+#
+# backpressure between collection and analysis
+#
+
+import ctypes
+import logging
+
+from multiprocessing import RawArray, RawValue
+
+BACKPRESSURE_STATE_NORMAL = 0
+BACKPRESSURE_STATE_IDLE = 1
+BACKPRESSURE_STATE_SATURATED = 2
+
+BACKPRESSURE_STATE_NAMES = {
+    BACKPRESSURE_STATE_NORMAL: 'normal',
+    BACKPRESSURE_STATE_IDLE: 'idle',
+    BACKPRESSURE_STATE_SATURATED: 'saturated', }
+
+class BackpressureController(object):
+    """Decides how often and how much the collector of an engine collects based on how busy analysis is.
+
+       The process managers report if they are busy (set_busy) and the queue manager reports how much work the engine
+       is holding (set_engine_depth.) The collector calls update() before each collection with the depth of the
+       queues it can see and then uses interval and batch_size.
+
+       When every process manager is busy and there is at least a full round of work waiting, the state is
+       saturated: the collector holds off and the interval doubles (up to maximum_interval) and the batch size halves.
+       When there are idle process managers and nothing is waiting, the state is idle: the batch size doubles
+       (up to maximum_batch_size) and the interval halves toward minimum_interval as long as the collector keeps
+       finding work (otherwise it goes back to initial_interval.) Otherwise the state is normal: the interval halves
+       and the batch size doubles back toward where they started so the collector recovers from saturation while
+       the process managers drain.
+
+       All the state is kept in shared memory so this must be created before the processes are started."""
+
+    def __init__(self, process_manager_count, initial_interval, maximum_interval, maximum_batch_size,
+                 minimum_interval=0.0):
+        self.process_manager_count = max(process_manager_count, 1)
+        self.initial_interval = float(initial_interval)
+        self.minimum_interval = float(minimum_interval)
+        self.maximum_interval = max(float(maximum_interval), self.initial_interval)
+        self.maximum_batch_size = max(maximum_batch_size, 1)
+        self.initial_batch_size = min(self.process_manager_count, self.maximum_batch_size)
+
+        # set to 1 by each process manager while it is working on something
+        self.busy = RawArray(ctypes.c_byte, self.process_manager_count)
+        # the number of work items held inside of the engine (scheduler, lock queue, pending ready)
+        self._engine_depth = RawValue(ctypes.c_int, 0)
+
+        # the current decisions
+        self._state = RawValue(ctypes.c_int, BACKPRESSURE_STATE_NORMAL)
+        self._interval = RawValue(ctypes.c_double, self.initial_interval)
+        self._batch_size = RawValue(ctypes.c_int, self.initial_batch_size)
+        # the number of times the collector was told to hold off
+        self._holds = RawValue(ctypes.c_long, 0)
+
+    @property
+    def state(self):
+        return self._state.value
+
+    @property
+    def interval(self):
+        return self._interval.value
+
+    @property
+    def batch_size(self):
+        return self._batch_size.value
+
+    @property
+    def holds(self):
+        return self._holds.value
+
+    @property
+    def saturated(self):
+        return self.state == BACKPRESSURE_STATE_SATURATED
+
+    @property
+    def utilization(self):
+        """Returns the fraction of process managers that are busy."""
+        return sum(self.busy) / self.process_manager_count
+
+    def set_busy(self, index, busy):
+        if 0 <= index < self.process_manager_count:
+            self.busy[index] = 1 if busy else 0
+
+    def set_engine_depth(self, depth):
+        self._engine_depth.value = depth
+
+    def update(self, queue_depth, collected=True):
+        """Updates the decisions from the given depth of the queues the collector can see and if the last collection
+           found anything. Returns the new state."""
+        waiting = queue_depth + self._engine_depth.value
+        busy_count = sum(self.busy)
+
+        interval = self._interval.value
+        batch_size = self._batch_size.value
+
+        if busy_count >= self.process_manager_count and waiting >= self.process_manager_count:
+            state = BACKPRESSURE_STATE_SATURATED
+            interval = min(max(interval * 2.0, self.initial_interval, 0.1), self.maximum_interval)
+            batch_size = max(batch_size // 2, 1)
+            self._holds.value += 1
+        elif busy_count < self.process_manager_count and waiting == 0:
+            state = BACKPRESSURE_STATE_IDLE
+            if collected:
+                interval = interval / 2.0
+                if interval < max(self.minimum_interval, 0.01):
+                    interval = self.minimum_interval
+            else:
+                # there was nothing to collect so there is no reason to poll any faster
+                interval = max(self.initial_interval, self.minimum_interval)
+            batch_size = min(batch_size * 2, self.maximum_batch_size)
+        else:
+            state = BACKPRESSURE_STATE_NORMAL
+            # recover from saturation
+            if interval > self.initial_interval:
+                interval = max(interval / 2.0, self.initial_interval)
+            if batch_size < self.initial_batch_size:
+                batch_size = min(batch_size * 2, self.initial_batch_size)
+
+        if state != self._state.value:
+            logging.debug("backpressure state changed from {} to {} (busy {}/{} waiting {} interval {:.2f} "
+                          "batch size {})".format(BACKPRESSURE_STATE_NAMES[self._state.value],
+                                                  BACKPRESSURE_STATE_NAMES[state], busy_count,
+                                                  self.process_manager_count, waiting, interval, batch_size))
+
+        self._state.value = state
+        self._interval.value = interval
+        self._batch_size.value = batch_size
+        return state
+
+    def metrics(self):
+        """Returns a list of tuple(name, labels, value) of the current decisions."""
+        result = [
+            ('backpressure_interval_seconds', None, self.interval),
+            ('backpressure_batch_size', None, self.batch_size),
+            ('backpressure_holds', None, self.holds),
+            ('process_manager_utilization', None, self.utilization), ]
+
+        for state, name in BACKPRESSURE_STATE_NAMES.items():
+            result.append(('backpressure_state', { 'state': name }, 1 if self.state == state else 0))
+
+        return result
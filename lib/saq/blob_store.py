@@ -0,0 +1,249 @@
+# vim: sw=4:ts=4:et:cc=120
+#
+# content-addressed storage of the files of F_FILE observables
+#
+
+import hashlib
+import io
+import logging
+import os, os.path
+import shutil
+import sqlite3
+import uuid
+
+import saq
+
+# the name of the sqlite database (inside of the blob store) that keeps track of what the blob store has saved
+STATS_FILE_NAME = 'stats.db'
+
+# the names of the counters in the stats database
+STAT_DEDUPLICATED_FILES = 'deduplicated_files'
+STAT_DEDUPLICATED_BYTES = 'deduplicated_bytes'
+STAT_LINKED_FILES = 'linked_files'
+STAT_LINKED_BYTES = 'linked_bytes'
+STATS = [ STAT_DEDUPLICATED_FILES, STAT_DEDUPLICATED_BYTES, STAT_LINKED_FILES, STAT_LINKED_BYTES ]
+
+def compute_sha256(path):
+    """Returns the sha256 (hex) of the content of the given file."""
+    hasher = hashlib.sha256()
+    with open(path, 'rb') as fp:
+        while True:
+            data = fp.read(io.DEFAULT_BUFFER_SIZE)
+            if data == b'':
+                break
+
+            hasher.update(data)
+
+    return hasher.hexdigest()
+
+class BlobStore(object):
+    """Stores a single copy of the content of each file by sha256.
+
+       The files of the F_FILE observables of the roots are hard links to the copy in the blob store, so the number
+       of links to a blob is the number of files that reference it (plus one for the blob itself.)  Deleting the
+       files (or the entire storage directory) of a root releases the references.  A blob is removed when nothing
+       references it anymore (see remove and collect.)
+
+       The blob store must be on the same file system as the storage directories of the roots.  Files that are in
+       the blob store must never be modified in place because the content is shared by every root that has it."""
+
+    def __init__(self, path):
+        self.path = path
+        self.stats_path = os.path.join(path, STATS_FILE_NAME)
+
+    def blob_path(self, sha256):
+        return os.path.join(self.path, sha256[0:2], sha256)
+
+    def _is_blob(self, blob_path, path):
+        """Returns True if the given file is a link to the given blob."""
+        try:
+            return os.path.samefile(blob_path, path)
+        except FileNotFoundError:
+            return False
+
+    def _link(self, source_path, target_path):
+        """Atomically replaces (or creates) target_path with a hard link to source_path."""
+        temp_path = '{}.{}.link'.format(target_path, str(uuid.uuid4()))
+        os.link(source_path, temp_path)
+        try:
+            os.replace(temp_path, target_path)
+        except Exception:
+            os.remove(temp_path)
+            raise
+
+    def _get_blob(self, path, sha256):
+        """Returns the path to the blob with the content of the given file.  The file becomes the blob if there isn't
+           one yet, in which case the returned path is the same file as the given path."""
+        blob_path = self.blob_path(sha256)
+        while True:
+            if os.path.exists(blob_path):
+                return blob_path
+
+            os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+            try:
+                os.link(path, blob_path)
+                return blob_path
+            except FileExistsError:
+                # another process added it at the same time
+                continue
+
+    def add(self, path, sha256=None):
+        """Replaces the given file with a link to the blob with the same content.
+           sha256 is only used to check if the file is already in the blob store.
+           Returns the number of bytes saved (zero if this is the first copy of this content.)"""
+        if sha256 is not None and self._is_blob(self.blob_path(sha256), path):
+            return 0
+
+        sha256 = compute_sha256(path)
+        while True:
+            blob_path = self._get_blob(path, sha256)
+            if self._is_blob(blob_path, path):
+                return 0
+
+            try:
+                self._link(blob_path, path)
+                return os.path.getsize(path)
+            except FileNotFoundError:
+                # the blob was removed (see remove) before we could link to it
+                continue
+
+    def copy(self, source_path, target_path):
+        """Copies the given file by linking the target to the blob with the same content instead of writing another
+           copy.  Returns the number of bytes that were not written."""
+        sha256 = compute_sha256(source_path)
+        while True:
+            blob_path = self._get_blob(source_path, sha256)
+            try:
+                self._link(blob_path, target_path)
+                return os.path.getsize(target_path)
+            except FileNotFoundError:
+                continue
+
+    def remove(self, path, sha256=None):
+        """Removes the given file.  If the file is a link to the blob with the given sha256 then the blob is also
+           removed if nothing else references it."""
+        blob_path = None
+        if sha256 is not None and self._is_blob(self.blob_path(sha256), path):
+            blob_path = self.blob_path(sha256)
+
+        os.remove(path)
+        if blob_path is not None:
+            self._release(blob_path)
+
+    def _release(self, blob_path):
+        """Removes the given blob if it is no longer referenced.
+           Returns the size of the blob if it was removed, None otherwise."""
+        try:
+            stat = os.stat(blob_path)
+            # a root that links to the blob after this point keeps a valid (but no longer shared) copy
+            if stat.st_nlink == 1:
+                os.remove(blob_path)
+                logging.debug("removed unreferenced blob {}".format(blob_path))
+                return stat.st_size
+        except FileNotFoundError:
+            pass
+
+        return None
+
+    def _blob_paths(self):
+        if not os.path.isdir(self.path):
+            return
+
+        for dir_name in os.listdir(self.path):
+            dir_path = os.path.join(self.path, dir_name)
+            if not os.path.isdir(dir_path):
+                continue
+
+            for file_name in os.listdir(dir_path):
+                yield os.path.join(dir_path, file_name)
+
+    def collect(self):
+        """Removes every blob that is no longer referenced.  Returns a tuple of (count, bytes) removed."""
+        count = 0
+        size = 0
+        for blob_path in self._blob_paths():
+            removed_size = self._release(blob_path)
+            if removed_size is not None:
+                count += 1
+                size += removed_size
+
+        logging.info("removed {} unreferenced blobs ({} bytes) from {}".format(count, size, self.path))
+        return count, size
+
+    def record(self, **counts):
+        """Adds the given counts to the stats of the blob store (see STATS.)"""
+        os.makedirs(self.path, exist_ok=True)
+        connection = sqlite3.connect(self.stats_path, timeout=30)
+        try:
+            with connection:
+                connection.execute('CREATE TABLE IF NOT EXISTS stats ( name TEXT PRIMARY KEY, value INTEGER )')
+                for name, value in counts.items():
+                    connection.execute('INSERT OR IGNORE INTO stats ( name, value ) VALUES ( ?, 0 )', (name,))
+                    connection.execute('UPDATE stats SET value = value + ? WHERE name = ?', (value, name))
+        finally:
+            connection.close()
+
+    def stats(self):
+        """Returns a dict of the current state of the blob store (blobs, references and the space they use) along
+           with the counters of everything that was saved (see STATS.)"""
+        result = {
+            'blobs': 0,
+            'blob_bytes': 0,
+            'references': 0,
+            'referenced_bytes': 0, }
+
+        for blob_path in self._blob_paths():
+            stat = os.stat(blob_path)
+            result['blobs'] += 1
+            result['blob_bytes'] += stat.st_size
+            result['references'] += stat.st_nlink - 1
+            result['referenced_bytes'] += stat.st_size * (stat.st_nlink - 1)
+
+        # without the blob store every reference would be a separate copy
+        result['saved_bytes'] = result['referenced_bytes'] - result['blob_bytes']
+
+        for name in STATS:
+            result[name] = 0
+
+        if os.path.exists(self.stats_path):
+            connection = sqlite3.connect(self.stats_path, timeout=30)
+            try:
+                for name, value in connection.execute('SELECT name, value FROM stats'):
+                    result[name] = value
+            except sqlite3.OperationalError:
+                pass
+            finally:
+                connection.close()
+
+        return result
+
+def get_blob_store():
+    """Returns the BlobStore if blob_store_enabled is set in the [global] section, otherwise None."""
+    if not saq.CONFIG['global'].getboolean('blob_store_enabled', fallback=False):
+        return None
+
+    return BlobStore(os.path.join(saq.SAQ_HOME, saq.CONFIG['global'].get('blob_store_dir', fallback='data/blobs')))
+
+def copy_file(source_path, target_path):
+    """Copies the given file.  If the blob store is enabled the target is linked to the content in the blob store
+       instead of being written again."""
+    blob_store = get_blob_store()
+    if blob_store is not None:
+        try:
+            size = blob_store.copy(source_path, target_path)
+            blob_store.record(**{ STAT_LINKED_FILES: 1, STAT_LINKED_BYTES: size })
+            logging.debug("linked {} to {} ({} bytes not written)".format(target_path, source_path, size))
+            return
+        except OSError as e:
+            # most likely not on the same file system
+            logging.warning("unable to link {} to {} in the blob store: {}".format(source_path, target_path, e))
+
+    shutil.copy(source_path, target_path)
+
+def remove_file(path, sha256=None):
+    """Removes the given file (and the blob it is linked to if nothing else references it.)"""
+    blob_store = get_blob_store()
+    if blob_store is not None:
+        blob_store.remove(path, sha256)
+    else:
+        os.remove(path)
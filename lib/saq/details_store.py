@@ -0,0 +1,260 @@
+# vim: sw=4:ts=4:et:cc=120
+#
+# storage of the details of analysis
+#
+
+import contextlib
+import logging
+import os, os.path
+import sqlite3
+
+import saq
+
+DETAILS_STORE_FILES = 'files'
+DETAILS_STORE_SQLITE = 'sqlite'
+VALID_DETAILS_STORES = [ DETAILS_STORE_FILES, DETAILS_STORE_SQLITE ]
+
+# the name of the sqlite database inside of the .ace directory
+PACKED_DETAILS_FILE_NAME = 'details.db'
+
+class FileDetailsStore(object):
+    """Stores the details of each analysis in a separate file in the .ace directory of the root."""
+
+    def __init__(self, path):
+        # the .ace directory of the root
+        self.path = path
+
+    def _path(self, name):
+        return os.path.join(self.path, name)
+
+    def read(self, name):
+        """Returns the stored details (bytes) for the given name, or None if they do not exist."""
+        try:
+            with open(self._path(name), 'rb') as fp:
+                return fp.read()
+        except FileNotFoundError:
+            return None
+
+    def write(self, name, data):
+        try:
+            fp = open(self._path(name), 'wb')
+        except FileNotFoundError:
+            os.makedirs(self.path, exist_ok=True)
+            fp = open(self._path(name), 'wb')
+
+        with fp:
+            fp.write(data)
+
+    def delete(self, name):
+        """Deletes the stored details for the given name.  Returns True if they existed."""
+        try:
+            os.remove(self._path(name))
+            return True
+        except FileNotFoundError:
+            return False
+
+    def exists(self, name):
+        return os.path.exists(self._path(name))
+
+    def size(self, name):
+        """Returns the size (in bytes) of the stored details for the given name, or None if they do not exist."""
+        try:
+            return os.path.getsize(self._path(name))
+        except FileNotFoundError:
+            return None
+
+    def names(self):
+        """Returns the list of names of everything stored."""
+        if not os.path.isdir(self.path):
+            return []
+
+        return [file_name for file_name in os.listdir(self.path)
+                if not file_name.startswith(PACKED_DETAILS_FILE_NAME) and os.path.isfile(self._path(file_name))]
+
+    @contextlib.contextmanager
+    def batch(self):
+        yield
+
+    def close(self):
+        pass
+
+class PackedDetailsStore(object):
+    """Stores the details of all the analysis of a root in a single sqlite database in the .ace directory.
+       Every write (or batch of writes) is a transaction.  The database is only created when something is written."""
+
+    def __init__(self, path):
+        # the .ace directory of the root
+        self.path = path
+        self.db_path = os.path.join(path, PACKED_DETAILS_FILE_NAME)
+        self.connection = None
+        # set to True while inside of batch()
+        self.batching = False
+
+    def _connect(self, create=False):
+        """Returns the connection to the database, or None if it does not exist and create is False."""
+        if self.connection is not None:
+            return self.connection
+
+        if not create and not os.path.exists(self.db_path):
+            return None
+
+        if create:
+            os.makedirs(self.path, exist_ok=True)
+
+        self.connection = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+        self.connection.execute('PRAGMA synchronous = NORMAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS details ( name TEXT PRIMARY KEY, data BLOB NOT NULL )')
+        return self.connection
+
+    def read(self, name):
+        connection = self._connect()
+        if connection is None:
+            return None
+
+        row = connection.execute('SELECT data FROM details WHERE name = ?', (name,)).fetchone()
+        return None if row is None else bytes(row[0])
+
+    def write(self, name, data):
+        connection = self._connect(create=True)
+        connection.execute('INSERT OR REPLACE INTO details ( name, data ) VALUES ( ?, ? )',
+                           (name, sqlite3.Binary(data)))
+
+    def delete(self, name):
+        connection = self._connect()
+        if connection is None:
+            return False
+
+        return connection.execute('DELETE FROM details WHERE name = ?', (name,)).rowcount > 0
+
+    def exists(self, name):
+        return self.size(name) is not None
+
+    def size(self, name):
+        connection = self._connect()
+        if connection is None:
+            return None
+
+        row = connection.execute('SELECT length(data) FROM details WHERE name = ?', (name,)).fetchone()
+        return None if row is None else row[0]
+
+    def names(self):
+        connection = self._connect()
+        if connection is None:
+            return []
+
+        return [row[0] for row in connection.execute('SELECT name FROM details ORDER BY name')]
+
+    @contextlib.contextmanager
+    def batch(self):
+        """All the writes made inside of this context are made in a single transaction."""
+        if self.batching:
+            yield
+            return
+
+        connection = self._connect(create=True)
+        connection.execute('BEGIN IMMEDIATE')
+        self.batching = True
+        try:
+            yield
+        except Exception:
+            connection.execute('ROLLBACK')
+            raise
+        else:
+            connection.execute('COMMIT')
+        finally:
+            self.batching = False
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+class DetailsStore(object):
+    """The details of the analysis of a root.
+
+       New details are written to the configured store (see analysis_details_store in the [global] section.)
+       Details are read from the configured store first and then from the other one so that roots saved with
+       either layout (or both) can be loaded.  Use migrate() to move everything to one layout."""
+
+    def __init__(self, path, backend=None):
+        if backend is None:
+            backend = saq.CONFIG['global'].get('analysis_details_store', fallback=DETAILS_STORE_FILES)
+
+        if backend not in VALID_DETAILS_STORES:
+            logging.error("invalid analysis_details_store {} (using {})".format(backend, DETAILS_STORE_FILES))
+            backend = DETAILS_STORE_FILES
+
+        self.path = path
+        self.backend = backend
+        self.stores = {
+            DETAILS_STORE_FILES: FileDetailsStore(path),
+            DETAILS_STORE_SQLITE: PackedDetailsStore(path), }
+
+        self.primary = self.stores[backend]
+        self.secondary = self.stores[DETAILS_STORE_SQLITE if backend == DETAILS_STORE_FILES else DETAILS_STORE_FILES]
+
+    def read(self, name):
+        data = self.primary.read(name)
+        if data is None:
+            data = self.secondary.read(name)
+
+        return data
+
+    def write(self, name, data):
+        self.primary.write(name, data)
+
+    def delete(self, name):
+        # delete from both (the primary one comes last so it's not reported as missing)
+        deleted = self.secondary.delete(name)
+        return self.primary.delete(name) or deleted
+
+    def exists(self, name):
+        return self.primary.exists(name) or self.secondary.exists(name)
+
+    def size(self, name):
+        result = self.primary.size(name)
+        if result is None:
+            result = self.secondary.size(name)
+
+        return result
+
+    def names(self):
+        return sorted(set(self.primary.names()) | set(self.secondary.names()))
+
+    def batch(self):
+        return self.primary.batch()
+
+    def migrate(self, backend):
+        """Moves all the details to the given store.  Returns the number of details moved."""
+        target = self.stores[backend]
+        count = 0
+        with target.batch():
+            for store in self.stores.values():
+                if store is target:
+                    continue
+
+                for name in store.names():
+                    # whatever read() returns is what is current
+                    target.write(name, self.read(name))
+                    count += 1
+
+        for store in self.stores.values():
+            if store is target:
+                continue
+
+            for name in store.names():
+                store.delete(name)
+
+            store.close()
+
+        # the database is removed when everything is moved out of it
+        packed = self.stores[DETAILS_STORE_SQLITE]
+        if packed is not target and os.path.exists(packed.db_path):
+            os.remove(packed.db_path)
+
+        logging.debug("migrated {} details in {} to {}".format(count, self.path, backend))
+        return count
+
+    def close(self):
+        for store in self.stores.values():
+            store.close()
@@ -1,17 +1,22 @@
 # vim: ts=4:sw=4:et:cc=120
 
 import collections
+import csv
 import datetime
 import gc
 import importlib
 import inspect
 import io
+import itertools
 import logging
 import os, os.path
+import pickle
 import queue
+import random
 import shutil
 import signal
 import socket
+import sqlite3
 import ssl
 import stat
 import sys
@@ -19,6 +24,7 @@ import threading
 import time
 import uuid
 
+from contextlib import closing
 from multiprocessing import Process, Queue, Semaphore, Event, Pipe
 from queue import PriorityQueue, Empty, Full
 from subprocess import Popen, PIPE
@@ -26,18 +32,30 @@ from subprocess import Popen, PIPE
 import saq
 import saq.analysis
 import saq.database
+import saq.metrics
 
 from saq.analysis import Observable, Analysis, RootAnalysis, ProfilePoint, ProfilePointAnalyzer
 from saq.anp import *
 from saq.constants import *
 from saq.database import Alert, get_db_connection, release_cached_db_connection, enable_cached_db_connections
 from saq.error import report_exception
+from saq.exclusions import ObservableExclusions
+from saq.log_buffer import AnalysisLogBuffer
+from saq.profiler import SamplingProfiler
 from saq.lock import LockableObject, LocalLockableObject, initialize_locking
+from saq.metrics import MetricsServer, SharedMetrics, initialize_metrics, set_metrics_slot, increment_metric, \
+                        observe_metric, render_gauges, hdr_buckets, parse_labels, write_histogram_rollup, \
+                        ROLLUP_HEADER
 from saq.modules import AnalysisModule, PostAnalysisModule
 from saq.performance import record_metric
+from saq.prefetch import IOPrefetcher
+from saq.result_cache import ModuleResultCache
+from saq.scheduler import WorkScheduler
 from saq.util import human_readable_size
+from saq.watchdog import AnalysisWatchdog
+from saq.zygote import Zygote
+from saq.backpressure import BackpressureController, BACKPRESSURE_STATE_SATURATED
 
-import iptools
 import psutil
 
 # the workload database configuration section name
@@ -48,6 +66,10 @@ DB_CONFIG = 'workload'
 # only one engine runs per process
 CURRENT_ENGINE = None
 
+# the columns of stats/modules/ENGINE/YYYYMMDD/root_memory.csv (see Engine.record_root_memory)
+ROOT_MEMORY_HEADER = [ 'timestamp', 'pid', 'uuid', 'storage_dir', 'start_rss', 'high_water_rss', 'details_evicted', 
+                       'observables', 'analysis', 'seconds' ]
+
 class AnalysisTimeoutError(RuntimeError):
     pass
 
@@ -92,6 +114,30 @@ def submit_sql_work_item(workload_name, path):
         report_exception()
         raise e
 
+def claim_sql_work_items(db, workload_name, count, on_claim=None):
+    """Claims up to count work items from the given sql workload in a single transaction.
+       Returns a list of tuple(id, path) of the claimed items, which are removed from the workload.
+       If on_claim is given it is called with the claimed items before the transaction is committed."""
+    c = db.cursor()
+    c.execute("""SELECT id, path FROM workload WHERE name = %s ORDER BY id ASC LIMIT %s FOR UPDATE""", 
+              (workload_name, count))
+    claimed = list(c.fetchall())
+    if not claimed:
+        db.commit()
+        return []
+
+    if on_claim is not None:
+        on_claim(claimed)
+
+    ids = [_id for _id, path in claimed]
+    c.execute("""DELETE FROM workload WHERE id IN ( {} )""".format(','.join(['%s' for _ in ids])), tuple(ids))
+    if c.rowcount != len(ids):
+        logging.error("deleted {} rows when trying to delete {} rows from workload {}".format(
+                      c.rowcount, len(ids), workload_name))
+
+    db.commit()
+    return claimed
+
 def signal_process(p, sig):
     """Sends a single to the specified multiprocessing.Process object logging any errors.  Returns True on success."""
     log_message = "sending signal {} to {}".format(sig, p.pid)
@@ -250,11 +296,22 @@ class Engine(object):
         self.analysis_pool_size = self.config.getint('analysis_pool_size')
 
         # a single process is started to manage each child process executed to analyze
-        self.process_managers = [] # of Process objects
+        self.process_managers = [] # of saq.zygote.ZygoteChild objects
 
         # used to start and stop the process managers
         self.process_manager_event = Event()
 
+        # the process managers are forked from a zygote process that has the modules loaded (see start_zygote)
+        self.zygote = None
+
+        # set inside of a process manager to the Event used to stop just that process manager
+        self.process_manager_stop_event = None
+
+        # when the process managers are restarted each one has this many seconds to finish what it's working on
+        # before it is sent SIGTERM (0 to wait for as long as it takes)
+        self.process_manager_stop_timeout = self.get_engine_option('getint', 'process_manager_stop_timeout', 
+                                                                   fallback=300)
+
         # every N minutes we act as though we received a SIGHUP
         self.next_auto_refresh_time = None
 
@@ -271,7 +328,18 @@ class Engine(object):
         self.analysis_modules = []
 
         # things we do *not* want to analyze
-        self.observable_exclusions = {} # key = o_type, value = [] of values
+        self.observable_exclusions = ObservableExclusions() # key = o_type, value = [] of values
+
+        # the analysis modules that could possibly accept a given observable type (see build_module_dispatch_index)
+        self.module_dispatch_index = {} # key = o_type, value = [] of tuple(AnalysisModule, required_directives)
+        # the analysis modules that could accept observable types not in the index
+        self.module_dispatch_default = [] # of tuple(AnalysisModule, required_directives)
+        # the number of analysis modules that would be checked without the index
+        self.module_dispatch_count = 0
+
+        # the number of calls to AnalysisModule.accepts() made and avoided by using the dispatch index
+        self.accepts_calls = 0
+        self.accepts_calls_avoided = 0
 
         # this is the queue that is shared between the processes
         # NOTE the size limit of the queue
@@ -281,10 +349,42 @@ class Engine(object):
         # holds a list of LockableObject waiting for locks to become available
         self.lock_queue = []
 
+        # work items pulled off the work_queue wait here until they are scheduled
+        # items are ordered across the priority lanes defined by the priority_lanes configuration option
+        self.work_scheduler = self.create_work_scheduler()
+        # the maximum number of work items we pull from the work_queue into the scheduler
+        self.scheduler_buffer_size = self.get_engine_option('getint', 'scheduler_buffer_size', fallback=100)
+        # the last time we logged the scheduler metrics
+        self.last_scheduler_metrics_time = datetime.datetime.now()
+
+        # optional http endpoint that serves runtime metrics (host:port or unix:path)
+        self.metrics_listen = self.config.get('metrics_listen', fallback=None)
+        self.metrics_server = None
+        # tuple(time, roots analyzed) from the last time the metrics were rendered
+        self.last_metrics_sample = None
+
+        # shared memory histograms of how long each analysis module takes per observable type
+        self.module_timings = None # SharedMetrics
+        # the histograms as of the last time they were written to the stats dir
+        self.module_timings_flushed = {}
+        # how often (in seconds) the module timing histograms are written to the stats dir
+        self.module_stats_flush_frequency = saq.CONFIG['global'].getint('module_stats_flush_frequency', fallback=60)
+        self.last_module_stats_flush = time.time()
+
+        # adjusts the collection interval and batch size based on how busy analysis is (see initialize_backpressure)
+        self.backpressure_enabled = self.get_engine_option('getboolean', 'backpressure_enabled', fallback=True)
+        self.backpressure = None # BackpressureController
+        # set inside of a process manager to the index of the process manager
+        self.process_manager_index = None
+        # the number of work items added by the collector (see add_work_item)
+        self.collected_count = 0
+
         # shared queue that contains the next job to process
-        self.ready_queue = Queue(maxsize=1)
+        self.ready_queue_size = self.get_engine_option('getint', 'ready_queue_size', fallback=1)
+        self.ready_queue = Queue(maxsize=self.ready_queue_size)
         self.current_ready = None # the current object we want to place on the ready_queue
-        self.current_active = None # the current object that is ON the ready_queue (ready to be sent out)
+        # the objects that might be ON the ready_queue (ready to be sent out)
+        self.current_active = collections.deque(maxlen=self.ready_queue_size)
         
         # the last time we sent keep alives for chronos locks
         self.last_lock_update_time = datetime.datetime.now()
@@ -313,6 +413,11 @@ class Engine(object):
         self.sigusr1_received = False
         self.sigusr2_received = False
 
+        # SIGUSR2 starts and stops the sampling profiler in the process managers (see toggle_sampling_profiler)
+        self.sampling_profiler = None
+        # profiles are written here when the profiler stops
+        self.profile_dir = os.path.join(saq.STATS_DIR, 'profiles', self.name)
+
         # auto reload frequency (in seconds)
         # every so often we give the analysis modules a chance to "reload"
         self.auto_reload_frequency = self.config.getint('auto_reload_frequency')
@@ -340,8 +445,59 @@ class Engine(object):
         self.delayed_analysis_startup_event = threading.Event()
 
         # the file path used for saving outstanding delayed analysis requests on shutdown
+        # NOTE this is no longer written to but is still loaded (once) if it exists (see ACE.load_delayed_analysis)
         self.delayed_analysis_path = os.path.join(self.var_dir, 'delayed_analysis')
 
+        # every delayed analysis request is written to this store as it is made
+        # and removed when it is processed, so outstanding requests survive a crash
+        self.delayed_analysis_store = DelayedAnalysisStore(os.path.join(self.var_dir, 'delayed_analysis.db'))
+
+        # analysis modules that enable caching share results across roots (and engines) on this node
+        self.module_result_cache = ModuleResultCache(os.path.join(saq.SAQ_HOME, 
+            saq.CONFIG['global'].get('module_result_cache_path', fallback='var/module_results.db')))
+        # how often (in seconds) expired results are deleted from the cache
+        self.module_result_cache_purge_frequency = saq.CONFIG['global'].getint('module_result_cache_purge_frequency', 
+                                                                                fallback=600)
+        self.last_module_result_cache_purge = time.time()
+
+        # the state of analysis is periodically saved so that it can be resumed if it is interrupted
+        # how often (in seconds) a checkpoint is made while analyzing a root (0 to disable)
+        self.analysis_checkpoint_frequency = self.get_engine_option('getint', 'analysis_checkpoint_frequency', 
+                                                                    fallback=0)
+        # the maximum number of times the analysis of a root is resumed
+        self.analysis_checkpoint_max_resume = self.get_engine_option('getint', 'analysis_checkpoint_max_resume', 
+                                                                     fallback=3)
+        self.analysis_checkpoint_store = AnalysisCheckpointStore(os.path.join(self.var_dir, 'checkpoints.db'))
+        # the last time a checkpoint was made for the current root
+        self.last_analysis_checkpoint = None
+        # set to True when a checkpoint exists for the current root
+        self.analysis_checkpoint_saved = False
+        # set to True when the analysis of the current root was interrupted and checkpointed
+        self.analysis_checkpointed = False
+        # the CheckpointedAnalysisRequest the current root is being resumed from (or None)
+        self.analysis_checkpoint_request = None
+
+        # the maximum amount of memory (in bytes) a process manager should use while analyzing a root (0 to disable)
+        # when a process manager goes over this the details of finished analysis are written out and dropped
+        self.memory_budget = self.config.getint('memory_budget', 
+            fallback=saq.CONFIG['global'].getint('process_manager_memory_budget', fallback=2048)) * 1024 * 1024
+        # how often (in seconds) the memory usage is checked while analyzing a root
+        self.memory_check_frequency = saq.CONFIG['global'].getfloat('memory_check_frequency', fallback=1.0)
+        self.last_memory_check = 0
+        # the memory usage (rss) when analysis of the current root started and the highest seen since then
+        self.root_memory_start = 0
+        self.root_memory_high_water = 0
+        # the number of Analysis objects that had their details evicted while analyzing the current root
+        self.root_details_evicted = 0
+        # the memory usage when details were last evicted for the current root (0 if they have not been)
+        self.last_eviction_memory_usage = 0
+        # psutil.Process object for the current process (see current_memory_usage)
+        self._memory_process = None
+
+        # set to True after the outstanding requests have been loaded from the store
+        # we only do this once per process since the requests stay in delayed_analysis_queue across restarts
+        self.delayed_analysis_loaded = False
+
         # the current delayed analysis request being waited on
         self.current_delayed_analysis_request = None
 
@@ -380,6 +536,33 @@ class Engine(object):
         # maximum amount of time (in seconds) that an individual analysis module should take
         self.maximum_analysis_time = saq.CONFIG['global'].getint('maximum_analysis_time')
 
+        # a single thread per process manager watches how long each analysis module takes
+        self.analysis_watchdog = AnalysisWatchdog(
+            self.maximum_analysis_time,
+            enforcement=saq.CONFIG['global']['analysis_deadline_enforcement'],
+            hard_time=saq.CONFIG['global'].getint('hard_maximum_analysis_time'),
+            record_path=os.path.join(self.var_dir, 'hung_analysis.log'),
+            kill_handler=self.analysis_killed)
+
+        # the number of threads each process manager uses to execute the i/o of I/O bound modules (0 to disable)
+        self.io_pool_size = saq.CONFIG['global'].getint('io_pool_size', fallback=8)
+        # how many observables ahead on the work stack to start executing i/o for
+        self.io_prefetch_depth = saq.CONFIG['global'].getint('io_prefetch_depth', fallback=16)
+        # created in the process that performs analysis (see initialize_io_prefetcher)
+        self.io_prefetcher = None
+
+        # the log of each root is kept in memory (up to this many records) and only written to saq.log when needed
+        # defaults to 0 which writes the logs of every root directly to saq.log
+        self.analysis_log_buffer_size = saq.CONFIG['global'].getint('analysis_log_buffer_size', fallback=0)
+        # the buffered logs are written if anything is logged at this level (or higher)
+        self.analysis_log_flush_level = logging.getLevelName(
+            saq.CONFIG['global'].get('analysis_log_flush_level', fallback='WARNING').upper())
+        if not isinstance(self.analysis_log_flush_level, int):
+            logging.error("invalid analysis_log_flush_level - using WARNING")
+            self.analysis_log_flush_level = logging.WARNING
+        # the fraction of roots that have their buffered logs written anyways
+        self.analysis_log_sample_rate = saq.CONFIG['global'].getfloat('analysis_log_sample_rate', fallback=0.0)
+
         # the threads that manages the execution of the maintenance routines of analysis modules
         # there is one thread per analysis module that has a maintenance_frequency > 0
         self.maintenance_threads = []
@@ -437,6 +620,29 @@ class Engine(object):
             except Exception as e:
                 logging.error("unable to create directory {}: {}".format(d, e))
 
+        try:
+            self.delayed_analysis_store.initialize()
+        except Exception as e:
+            logging.error("unable to initialize delayed analysis store {}: {}".format(
+                          self.delayed_analysis_store.path, e))
+            report_exception()
+
+        try:
+            self.analysis_checkpoint_store.initialize()
+        except Exception as e:
+            logging.error("unable to initialize analysis checkpoint store {}: {}".format(
+                          self.analysis_checkpoint_store.path, e))
+            report_exception()
+
+        try:
+            self.module_result_cache.initialize()
+        except Exception as e:
+            logging.error("unable to initialize module result cache {}: {}".format(self.module_result_cache.path, e))
+            report_exception()
+        finally:
+            # every process opens its own connection
+            self.module_result_cache.close()
+
         # initialize locking
         initialize_locking()
 
@@ -579,6 +785,74 @@ class Engine(object):
                                 analysis_module))
 
         logging.debug("finished loading {} modules".format(len(self.analysis_modules)))
+        self.build_module_dispatch_index()
+
+    def build_module_dispatch_index(self):
+        """Builds the index of observable type to the analysis modules that could possibly accept that type.
+           Modules that are not in the list for a given type would always return False from accepts()."""
+
+        self.module_dispatch_index = {}
+        self.module_dispatch_default = []
+        self.module_dispatch_count = 0
+
+        # list of tuple(entry, valid_types) where valid_types is None if the module accepts any type
+        entries = []
+        for analysis_module in self.analysis_modules:
+            # these only execute in post analysis
+            if isinstance(analysis_module, PostAnalysisModule):
+                continue
+
+            self.module_dispatch_count += 1
+
+            try:
+                # can this module analyze observables at all?
+                target_type = analysis_module.valid_analysis_target_type
+                if target_type is not None and not issubclass(Observable, target_type) \
+                                           and not issubclass(target_type, Observable):
+                    logging.debug("{} does not analyze observables".format(analysis_module))
+                    continue
+
+                valid_types = analysis_module.valid_observable_types
+                if isinstance(valid_types, str):
+                    valid_types = [valid_types]
+
+                if valid_types is not None:
+                    valid_types = set(valid_types)
+
+                required_directives = tuple(analysis_module.required_directives)
+
+            except Exception as e:
+                # let accepts() sort it out at runtime
+                logging.warning("unable to index analysis module {}: {}".format(analysis_module, e))
+                valid_types = None
+                required_directives = ()
+
+            entries.append(((analysis_module, required_directives), valid_types))
+
+        # the order of the modules needs to stay the same as self.analysis_modules
+        all_types = set()
+        for entry, valid_types in entries:
+            if valid_types is not None:
+                all_types.update(valid_types)
+
+        for o_type in all_types:
+            self.module_dispatch_index[o_type] = [entry for entry, valid_types in entries 
+                                                  if valid_types is None or o_type in valid_types]
+
+        self.module_dispatch_default = [entry for entry, valid_types in entries if valid_types is None]
+
+        logging.debug("indexed {} analysis modules for {} observable types".format(
+                      self.module_dispatch_count, len(self.module_dispatch_index)))
+
+    def get_dispatch_modules(self, observable):
+        """Returns the list of analysis modules that could possibly accept the given Observable."""
+        try:
+            candidates = self.module_dispatch_index[observable.type]
+        except KeyError:
+            candidates = self.module_dispatch_default
+
+        return [analysis_module for analysis_module, required_directives in candidates
+                if all([observable.has_directive(directive) for directive in required_directives])]
 
     def initialize_profile_points(self):
         """Initializes all the enabled profile points for this engine if profile points are enabled."""
@@ -649,7 +923,7 @@ class Engine(object):
         seconds = float(seconds)
         while not self.maintenance_shutdown and seconds > 0:
             # we also want to support sleeping for less than a second
-            time.sleep(1.0 if seconds > 0 else seconds)
+            time.sleep(min(1.0, seconds))
             seconds -= 1.0
 
     def maintenance_loop(self, _module):
@@ -687,6 +961,9 @@ class Engine(object):
     @property
     def process_manager_shutdown(self):
         """Returns True if the process managers are shutting down."""
+        if self.process_manager_stop_event is not None and self.process_manager_stop_event.is_set():
+            return True
+
         return self.shutdown or self.process_manager_event.is_set()
 
     @property
@@ -729,6 +1006,7 @@ class Engine(object):
             return
 
         self.initialize()
+        self.initialize_backpressure()
         self.start_collection()
         if not self.start_engine():
             self.stop_collection()
@@ -764,7 +1042,8 @@ class Engine(object):
 
         while True:
             # run queue management and analysis until queues are empty
-            while self.work_queue.qsize() or self.ready_queue.qsize() or len(self.lock_queue):
+            while self.work_queue.qsize() or len(self.work_scheduler) or self.ready_queue.qsize() or \
+                  len(self.lock_queue):
                 self.queue_manager_execute()
                 self.execute()
 
@@ -818,8 +1097,19 @@ class Engine(object):
     @property
     def cancel_analysis_flag(self):
         """Returns True if analysis has been cancelled."""
+        if self.analysis_checkpoint_frequency and self.analysis_interrupted:
+            return True
+
         return self.shutdown or self._cancel_analysis_flag
 
+    @property
+    def analysis_interrupted(self):
+        """Returns True if the engine or the current process manager is stopping."""
+        if self.process_manager_stop_event is not None and self.process_manager_stop_event.is_set():
+            return True
+
+        return self.shutdown
+
     #
     # COLLECTION
     # ------------------------------------------------------------------------
@@ -860,6 +1150,35 @@ class Engine(object):
         # custom initialization
         self.initialize_collection()
 
+    def initialize_backpressure(self):
+        """Creates the BackpressureController shared between the collector, the engine and the process managers.
+           NOTE this must be called before any of the processes are started."""
+        if not self.backpressure_enabled:
+            self.backpressure = None
+            return
+
+        self.backpressure = BackpressureController(
+            self.analysis_pool_size,
+            initial_interval=self.collection_frequency,
+            minimum_interval=self.backpressure_minimum_interval,
+            maximum_interval=self.get_engine_option('getfloat', 'backpressure_maximum_interval', 
+                                                    fallback=max(self.collection_frequency, 1) * 10),
+            maximum_batch_size=self.get_engine_option('getint', 'backpressure_maximum_batch_size', 
+                                                      fallback=self.analysis_pool_size))
+
+    @property
+    def backpressure_minimum_interval(self):
+        """The shortest time (in seconds) the collector waits between collections when analysis is idle."""
+        return self.get_engine_option('getfloat', 'backpressure_minimum_interval', fallback=0.0)
+
+    @property
+    def collection_batch_size(self):
+        """The maximum number of work items to collect at once."""
+        if self.backpressure is not None:
+            return self.backpressure.batch_size
+
+        return self.analysis_pool_size
+
     def collection_loop(self):
 
         self.initialize_sighup_handler()
@@ -876,6 +1195,7 @@ class Engine(object):
         self.collection_startup_pipe_c = None
 
         logging.info("started collection loop on process {0}".format(os.getpid()))
+        last_collected_count = self.collected_count
         while not self.collection_shutdown:
             try:
                 if self.sighup_received:
@@ -890,6 +1210,18 @@ class Engine(object):
                         logging.error("unable to initialize collection: {0}".format(str(e)))
                         report_exception()
                     
+                # hold off collecting while analysis is saturated
+                if self.backpressure is not None:
+                    if self.backpressure.update(self.work_queue.qsize() + self.ready_queue.qsize(), 
+                                                collected=self.collected_count > last_collected_count) \
+                       == BACKPRESSURE_STATE_SATURATED:
+                        logging.debug("analysis saturated - holding off collection for {:.2f} seconds".format(
+                                      self.backpressure.interval))
+                        self.sleep(self.backpressure.interval)
+                        continue
+
+                last_collected_count = self.collected_count
+
                 try:
                     self.collect()
                 except Exception as e:
@@ -901,7 +1233,10 @@ class Engine(object):
                     logging.debug("detected collection ended flag")
                     break
 
-                self.sleep(self.collection_frequency)
+                if self.backpressure is not None:
+                    self.sleep(self.backpressure.interval)
+                else:
+                    self.sleep(self.collection_frequency)
 
             except KeyboardInterrupt:
                 logging.warning("caught user interrupt in collection_loop")
@@ -1043,18 +1378,72 @@ class Engine(object):
             logging.error("unable to start tracking delayed analysis: {}".format(e))
             report_exception()
 
+        request = DelayedAnalysisRequest(root, observable.id, analysis_module.config_section, next_analysis)
+
+        # persist the request before anything else happens to it
+        try:
+            self.delayed_analysis_store.save(next_analysis.timestamp(), request)
+        except Exception as e:
+            logging.error("unable to persist {}: {}".format(request, e))
+            report_exception()
+
         # add it to the priority queue for processing
         # note that it's a tuple: (timestamp, request)
-        self.delayed_analysis_buffer.append((next_analysis.timestamp(), 
-                                             DelayedAnalysisRequest(root, 
-                                                                    observable.id,
-                                                                    analysis_module.config_section,
-                                                                    next_analysis)))
+        self.delayed_analysis_buffer.append((next_analysis.timestamp(), request))
         return True
 
-    def _initialize_delayed_analysis(self):
-        self.initialize_delayed_analysis()
-        self.load_delayed_analysis()
+    def load_delayed_analysis(self):
+        """Loads the outstanding delayed analysis requests from the delayed analysis store."""
+        if self.delayed_analysis_loaded:
+            return
+
+        self.delayed_analysis_loaded = True
+        for next_time, request in self.delayed_analysis_store.load():
+            # make sure these are unlocked as they go into the queues
+            if request.is_locked():
+                request.unlock()
+
+            self.delayed_analysis_queue.put((next_time, request), block=False)
+
+        if self.delayed_analysis_queue.qsize():
+            logging.info("loaded {} outstanding delayed analysis requests".format(self.delayed_analysis_queue.qsize()))
+            self.delayed_analysis_sync_event.set()
+
+    def load_analysis_checkpoints(self):
+        """Queues the analysis that was interrupted (see checkpoint_analysis) to be resumed."""
+        try:
+            requests = self.analysis_checkpoint_store.load()
+        except Exception as e:
+            logging.error("unable to load analysis checkpoints: {}".format(e))
+            report_exception()
+            return
+
+        for request in requests:
+            if not self.count_analysis_resume(request):
+                continue
+
+            if request.is_locked():
+                request.unlock()
+
+            self.delayed_analysis_queue.put((request.next_analysis.timestamp(), request), block=False)
+
+        if requests:
+            logging.info("loaded {} analysis checkpoints".format(len(requests)))
+            self.delayed_analysis_sync_event.set()
+
+    def count_analysis_resume(self, request):
+        """Records that analysis of the given CheckpointedAnalysisRequest is about to be resumed (again.)
+           Returns False (and deletes the checkpoint) if it was already resumed analysis_checkpoint_max_resume times."""
+        # a root that keeps taking the process manager down with it is not resumed forever
+        if request.resume_count >= self.analysis_checkpoint_max_resume:
+            logging.error("analysis of {} was resumed {} times - giving up".format(
+                          request.storage_dir, request.resume_count))
+            self.analysis_checkpoint_store.delete(request.uuid)
+            return False
+
+        request.resume_count += 1
+        self.analysis_checkpoint_store.save(request)
+        return True
 
     def _cleanup_delayed_analysis(self):
         self.cleanup_delayed_analysis()
@@ -1071,6 +1460,16 @@ class Engine(object):
             logging.error("failed to initialize delayed analysis: {}".format(e))
             report_exception()
 
+        # checkpoints are loaded along with the delayed analysis requests (once)
+        if not self.delayed_analysis_loaded:
+            self.load_analysis_checkpoints()
+
+        try:
+            self.load_delayed_analysis()
+        except Exception as e:
+            logging.error("failed to load delayed analysis: {}".format(e))
+            report_exception()
+
         self.delayed_analysis_shutdown_event.clear()
         self.delayed_analysis_xfer_startup_event.clear()
         self.delayed_analysis_startup_event.clear()
@@ -1186,7 +1585,7 @@ class Engine(object):
     def _process_delayed_analysis_request(self, request):
         # add it to the work queue
         # NOTE that we don't try to lock() here -- the queue manager does that for us
-        assert isinstance(request, DelayedAnalysisRequest)
+        assert isinstance(request, DelayedAnalysisRequest) or isinstance(request, CheckpointedAnalysisRequest)
         self.add_work_item(request)
 
     def delayed_analysis_execute(self):
@@ -1321,13 +1720,14 @@ class Engine(object):
                 self.last_lock_update_time = datetime.datetime.now()
             
             if send_keepalives:
-                # first we need to manage the keep alive for object that is currently waiting to get picked up
-                if self.current_active and isinstance(self.current_active, LockableObject):
-                    # is it still there?
-                    # this kind of sucks since the documentation says this is unreliable
-                    # worst case scenario, we ask for a keep alive on a lock that is released
-                    if self.ready_queue.qsize():
-                        self.current_active.refresh_lock()
+                # first we need to manage the keep alive for objects that are currently waiting to get picked up
+                # is it still there?
+                # this kind of sucks since the documentation says this is unreliable
+                # worst case scenario, we ask for a keep alive on a lock that is released
+                if self.ready_queue.qsize():
+                    for active in list(self.current_active)[-self.ready_queue.qsize():]:
+                        if isinstance(active, LockableObject):
+                            active.refresh_lock()
                     
             # are we already trying to add something to the ready queue?
             # if so, that is our only task in this routine
@@ -1339,7 +1739,7 @@ class Engine(object):
                 try:
                     logging.debug("placing {} on ready queue".format(self.current_ready))
                     self.ready_queue.put(self.current_ready, block=not saq.SINGLE_THREADED, timeout=0.05)
-                    self.current_active = self.current_ready # keep track of what is currently on the queue
+                    self.current_active.append(self.current_ready) # keep track of what is currently on the queue
                     self.current_ready = None # clear this up for the next loop iteration
                 except Full:
                     # if we are unable to place the item on the queue then it times out after 1 second
@@ -1358,8 +1758,10 @@ class Engine(object):
                     #return
 
                 # can we lock it?
+                increment_metric('lock_attempts')
                 if not lockable.lock():
                     logging.debug("still unable to lock {}".format(lockable))
+                    increment_metric('lock_failures')
                     continue
 
                 self.current_ready = lockable
@@ -1371,18 +1773,26 @@ class Engine(object):
 
             # nothing is available or ready in the lock queue
             # so look for new stuff on the incoming work_queue
-            try:
-                self.current_ready = self.work_queue.get(block=not saq.SINGLE_THREADED, timeout=0.05)
-                logging.debug("got {} from work queue".format(self.current_ready))
-            except Empty:
+            self.fill_work_scheduler()
+            self.log_scheduler_metrics()
+
+            # let the collector know how much work we are already holding
+            if self.backpressure is not None:
+                self.backpressure.set_engine_depth(len(self.lock_queue) + len(self.work_scheduler))
+
+            # and then pick the next thing to work on across the priority lanes
+            self.current_ready = self.work_scheduler.get()
+            if self.current_ready is None:
                 return
 
             # is this object lockable?
             # some engines (brotex, carbon black) create work items that are specific to the engine
             # and don't require locks 
             if isinstance(self.current_ready, LockableObject):
+                increment_metric('lock_attempts')
                 if not self.current_ready.lock():
                     logging.debug("unable to lock {}: moving to lock queue".format(self.current_ready))
+                    increment_metric('lock_failures')
                     if self.current_ready in self.lock_queue:
                         logging.error("{} already in lock queue".format(self.current_ready))
                     else:
@@ -1392,12 +1802,106 @@ class Engine(object):
             # at this point we have somthing to do
             # so we continue the loop
 
+    def get_engine_option(self, getter, option, fallback=None):
+        """Returns the value of the given option from the section of this engine, or from the [global] section if the
+           engine does not set it. getter is the name of the configparser method to use (get, getint, getfloat, etc.)"""
+        return getattr(self.config, getter)(option, 
+                                            fallback=getattr(saq.CONFIG['global'], getter)(option, fallback=fallback))
+
+    def create_work_scheduler(self):
+        """Returns a new WorkScheduler configured from the priority_lanes options of the engine."""
+        lanes = []
+        # priority_lanes is a comma separated list of name:weight
+        priority_lanes = self.get_engine_option('get', 'priority_lanes', fallback='')
+        for lane_spec in [x.strip() for x in priority_lanes.split(',') if x.strip()]:
+            name, weight = lane_spec.split(':', 1) if ':' in lane_spec else (lane_spec, '1')
+            lanes.append((name.strip(), int(weight)))
+
+        # how long something can wait before it goes to the front of the line
+        max_wait = self.get_engine_option('getint', 'priority_lane_max_wait', fallback=300)
+
+        # map the alert types and priority scores to the lanes
+        self.priority_lane_alert_types = {} # key = alert_type, value = lane name
+        self.priority_lane_min_priority = [] # of tuple(priority, lane name)
+        for name, weight in lanes:
+            alert_types = self.get_engine_option('get', 'priority_lane_{}_alert_types'.format(name), fallback='')
+            for alert_type in alert_types.split(','):
+                if alert_type.strip():
+                    self.priority_lane_alert_types[alert_type.strip()] = name
+
+            min_priority = self.get_engine_option('get', 'priority_lane_{}_min_priority'.format(name), fallback='')
+            if min_priority:
+                self.priority_lane_min_priority.append((int(min_priority), name))
+
+        self.priority_lane_min_priority.sort(reverse=True)
+
+        return WorkScheduler(lanes, 
+                             default_lane=self.get_engine_option('get', 'priority_lane_default') or None, 
+                             max_wait=max_wait if max_wait else None)
+
+    def get_work_item_lane(self, work_item):
+        """Returns the name of the priority lane the given work item is scheduled in, or None for the default lane.
+           Override this routine to schedule engine specific work items."""
+        # was a lane explicitly requested?
+        lane = getattr(work_item, 'priority_lane', None)
+        if lane in self.work_scheduler.lanes:
+            return lane
+
+        alert_type = getattr(work_item, 'alert_type', None)
+        if alert_type in self.priority_lane_alert_types:
+            return self.priority_lane_alert_types[alert_type]
+
+        priority = getattr(work_item, 'priority', None)
+        if isinstance(priority, int):
+            for min_priority, lane in self.priority_lane_min_priority:
+                if priority >= min_priority:
+                    return lane
+
+        return None
+
+    def fill_work_scheduler(self):
+        """Moves work items from the work_queue into the scheduler."""
+        # if we don't have anything to do then we wait a bit for something to show up
+        # I'm using this blocking get() call to throttle the use of the CPU (FYI)
+        block = not saq.SINGLE_THREADED and not len(self.work_scheduler)
+        while len(self.work_scheduler) < self.scheduler_buffer_size:
+            try:
+                work_item = self.work_queue.get(block=block, timeout=0.05)
+                logging.debug("got {} from work queue".format(work_item))
+            except Empty:
+                return
+
+            block = False
+
+            try:
+                lane = self.get_work_item_lane(work_item)
+            except Exception as e:
+                logging.error("unable to get priority lane for {}: {}".format(work_item, e))
+                report_exception()
+                lane = None
+
+            self.work_scheduler.put(work_item, lane)
+
+    def log_scheduler_metrics(self):
+        if self.statistic_dump_frequency == 0 or len(self.work_scheduler.lanes) < 2:
+            return
+
+        if (datetime.datetime.now() - self.last_scheduler_metrics_time).total_seconds() < self.statistic_dump_frequency:
+            return
+
+        self.last_scheduler_metrics_time = datetime.datetime.now()
+        for lane, metrics in self.work_scheduler.metrics().items():
+            logging.debug("priority lane {} depth {} dequeued {} average wait {:.2f} max wait {:.2f} "
+                          "oldest wait {:.2f}".format(lane, metrics['depth'], metrics['dequeued'], 
+                          metrics['average_wait'], metrics['max_wait'], metrics['oldest_wait']))
+
     def add_work_item(self, item):
         """Adds the given item to the work queue.  Blocks until the item can be added, or the engine has shut down."""
         start_time = datetime.datetime.now()
         while not self.shutdown:
             try:
                 self.work_queue.put(item, block=not saq.SINGLE_THREADED, timeout=1)
+                self.collected_count += 1
                 logging.debug("added work item {} in {} seconds".format(item, 
                               (datetime.datetime.now() - start_time).total_seconds()))
                 return
@@ -1431,11 +1935,22 @@ class Engine(object):
 
         return True
 
+    @property
+    def engine_pid_path(self):
+        """Path to the file that contains the PID of the engine process (see ace profile.)"""
+        return os.path.join(self.var_dir, 'engine.pid')
+
     def engine_loop(self):
         logging.info("started engine {} on process {}".format(self.name, os.getpid()))
 
         self.initialize_sighup_handler()
 
+        try:
+            with open(self.engine_pid_path, 'w') as fp:
+                fp.write(str(os.getpid()))
+        except Exception as e:
+            logging.error("unable to write {}: {}".format(self.engine_pid_path, e))
+
         # add the capability for a graceful shutdown
         def handle_sigterm(signum, frame):
             logging.warning("received SIGTERM in engine")
@@ -1447,8 +1962,16 @@ class Engine(object):
         self.initialize_profile_points()
         self.initialize_engine()
 
+        # slot 0 is for the engine process, the rest are for the process managers
+        # NOTE this has to happen before the process managers are started
+        initialize_metrics(self.analysis_pool_size + 1)
+        self.module_timings = SharedMetrics(self.analysis_pool_size + 1, 
+                                            saq.CONFIG['global'].getint('module_stats_series_capacity', fallback=1024),
+                                            buckets=hdr_buckets())
+
         if not saq.SINGLE_THREADED:
-            self.start_process_managers() # this needs to come first here
+            self.start_zygote() # this needs to come first here
+            self.start_process_managers()
             self.start_queue_manager()
             self.start_delayed_analysis()
 
@@ -1457,6 +1980,7 @@ class Engine(object):
                                               seconds=self.auto_refresh_frequency)
 
         self.start_maintenance_threads()
+        self.start_metrics_server()
 
         # let the parent process know that we've started
         self.engine_startup_pipe_c.send(True)
@@ -1480,6 +2004,7 @@ class Engine(object):
                     self.stop_delayed_analysis()
                     self.stop_queue_manager()
                     self.stop_maintenance_threads()
+                    self.stop_metrics_server()
 
                     if self.sighup_received:
                         # we re-load the config when we receive SIGHUP
@@ -1489,10 +2014,27 @@ class Engine(object):
                     self.initialize_modules()
                     self.initialize_profile_points()
                     self.initialize_engine()
-                    self.restart_process_managers() # this needs to come first here
+
+                    # the new zygote is forked while nothing else is running in this process
+                    # the existing process managers keep working until they are replaced below
+                    old_zygote = self.zygote
+                    self.start_zygote() # this needs to come first here
                     self.start_queue_manager()
                     self.start_delayed_analysis()
                     self.start_maintenance_threads()
+                    self.start_metrics_server()
+                    self.restart_process_managers(old_zygote)
+
+                if not saq.SINGLE_THREADED:
+                    self.check_process_managers()
+
+                if time.time() - self.last_module_stats_flush >= self.module_stats_flush_frequency:
+                    self.flush_module_timings()
+
+                if time.time() - self.last_module_result_cache_purge >= self.module_result_cache_purge_frequency:
+                    self.last_module_result_cache_purge = time.time()
+                    logging.debug("purged {} expired results from the module result cache".format(
+                                  self.module_result_cache.purge()))
 
                 if self.sigusr1_received:
                     try:
@@ -1532,6 +2074,7 @@ class Engine(object):
                   self.delayed_analysis_queue.qsize() or 
                   self.current_delayed_analysis_request or 
                   self.work_queue.qsize() or 
+                  len(self.work_scheduler) or 
                   self.lock_queue or 
                   self.ready_queue.qsize() ):
 
@@ -1543,6 +2086,8 @@ class Engine(object):
                     logging.debug("queue status: current_delayed_analysis_request = {}".format(self.current_delayed_analysis_request))
                 if self.work_queue.qsize():
                     logging.debug("queue status: work_queue = {}".format(self.work_queue.qsize()))
+                if len(self.work_scheduler):
+                    logging.debug("queue status: work_scheduler = {}".format(len(self.work_scheduler)))
                 if self.lock_queue:
                     logging.debug("queue status: lock_queue = {}".format(self.lock_queue))
                 if self.ready_queue.qsize():
@@ -1572,18 +2117,126 @@ class Engine(object):
         except KeyboardInterrupt:
             logging.warning("caught user interrupt in engine_loop")
 
+        self.stop_metrics_server()
+        self.flush_module_timings()
         logging.debug("ended engine loop")
 
+    def flush_module_timings(self):
+        """Appends the change in the module timing histograms to stats/modules/ENGINE/YYYYMMDD/module_timings.csv"""
+        self.last_module_stats_flush = time.time()
+        if self.module_timings is None:
+            return
+
+        try:
+            current = { parse_labels(labels): values for name, kind, labels, values in self.module_timings.collect() }
+            subdir_name = os.path.join(self.stats_dir, datetime.datetime.now().strftime('%Y%m%d'))
+            if not os.path.isdir(subdir_name):
+                os.makedirs(subdir_name)
+
+            rollup_path = os.path.join(subdir_name, 'module_timings.csv')
+            write_header = not os.path.exists(rollup_path)
+            with open(rollup_path, 'a', newline='') as fp:
+                if write_header:
+                    fp.write('{}\n'.format(','.join(ROLLUP_HEADER)))
+
+                write_histogram_rollup(fp, datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'), self.name,
+                                       self.module_timings.buckets, current, self.module_timings_flushed)
+
+            self.module_timings_flushed = current
+
+        except Exception as e:
+            logging.error("unable to record module timings: {}".format(e))
+            report_exception()
+
+    def start_metrics_server(self):
+        if not self.metrics_listen:
+            return
+
+        try:
+            self.metrics_server = MetricsServer(self.metrics_listen, self.render_metrics)
+            self.metrics_server.start()
+        except Exception as e:
+            logging.error("unable to start metrics server on {}: {}".format(self.metrics_listen, e))
+            report_exception()
+            self.metrics_server = None
+
+    def stop_metrics_server(self):
+        if self.metrics_server is None:
+            return
+
+        try:
+            self.metrics_server.stop()
+        except Exception as e:
+            logging.error("unable to stop metrics server: {}".format(e))
+            report_exception()
+
+        self.metrics_server = None
+
+    def get_metrics_gauges(self):
+        """Returns a list of tuple(name, labels, value) of the current state of the engine.
+           Override this routine to add engine specific metrics (call super.)"""
+        gauges = [
+            ('work_queue_depth', None, self.work_queue.qsize()),
+            ('ready_queue_depth', None, self.ready_queue.qsize()),
+            ('lock_queue_depth', None, len(self.lock_queue)),
+            ('delayed_analysis_queue_depth', None, self.delayed_analysis_queue.qsize()),
+            ('process_managers_alive', None, len([p for p in self.process_managers if p.is_alive()])), ]
+
+        if self.backpressure is not None:
+            gauges.extend(self.backpressure.metrics())
+
+        for lane, metrics in self.work_scheduler.metrics().items():
+            gauges.append(('scheduler_lane_depth', { 'lane': lane }, metrics['depth']))
+            gauges.append(('scheduler_lane_average_wait_seconds', { 'lane': lane }, metrics['average_wait']))
+            gauges.append(('scheduler_lane_oldest_wait_seconds', { 'lane': lane }, metrics['oldest_wait']))
+
+        # roots per second since the last time we were asked
+        if saq.metrics.shared_metrics is not None:
+            roots_analyzed = sum([values for name, kind, labels, values in saq.metrics.shared_metrics.collect()
+                                  if name == 'roots_analyzed'])
+            now = time.time()
+            if self.last_metrics_sample is not None and now > self.last_metrics_sample[0]:
+                gauges.append(('roots_per_second', None, 
+                              (roots_analyzed - self.last_metrics_sample[1]) / (now - self.last_metrics_sample[0])))
+
+            self.last_metrics_sample = (now, roots_analyzed)
+
+        return gauges
+
+    def render_metrics(self):
+        """Returns the metrics of this engine in the prometheus text exposition format."""
+        extra_labels = { 'engine': self.name }
+        result = render_gauges(self.get_metrics_gauges(), extra_labels=extra_labels)
+        if saq.metrics.shared_metrics is not None:
+            result += saq.metrics.shared_metrics.render(extra_labels=extra_labels)
+
+        return result
+
+    def start_zygote(self):
+        """Forks a new zygote process that has the current modules loaded. Process managers are forked from the zygote.
+           NOTE before you call this make sure you don't have any threads running
+           because the zygote will inherit running threads"""
+        self.zygote = Zygote(self.zygote_process_manager_loop, self.analysis_pool_size, 
+                             name='{} Process Manager'.format(self.name))
+        self.zygote.start()
+
+    def zygote_process_manager_loop(self, index, stop_event):
+        # slot 0 of the metrics is for the engine process
+        self.process_manager_loop(index + 1, stop_event)
+
+    def start_process_manager(self, index):
+        """Starts a new process manager forked from the current zygote in the given position."""
+        p = self.zygote.fork(index)
+        logging.debug("started process manager {}".format(p.pid))
+        return p
+
     def start_process_managers(self):
         logging.debug("starting process managers")
         self.process_manager_event.clear()
         self.process_managers = []
 
         for i in range(self.analysis_pool_size):
-            p = Process(target=self.process_manager_loop, name='{} Process Manager'.format(self.name))
-            p.start()
-            logging.debug("started process manager {}".format(p.pid))
-            self.process_managers.append(p)
+            self.process_managers.append(self.start_process_manager(i))
 
     def stop_process_managers(self):
         logging.debug("stopping process managers")
@@ -1594,54 +2247,70 @@ class Engine(object):
             pm.join()
             logging.debug("process manager {} stopped".format(pm.pid))
 
-    def restart_process_managers(self):
-        logging.info("restarting process managers for {}".format(self.name))
-        #
-        # NOTE before you call this make sure you don't have any threads running
-        # because new processes will inherit running threads
-        #
-        # keep track of which ones we've restarted
-        restarted = [False for p in self.process_managers]
-        
-        # the new list of process managers
-        new_process_managers = []
+        if self.zygote is not None:
+            self.zygote.shutdown()
+            self.zygote = None
 
-        # tell them all to stop
-        self.stop_process_managers()
+    def check_process_managers(self):
+        """Replaces any process managers that exited on their own (for example, killed by the analysis watchdog.)"""
+        if self.process_manager_shutdown:
+            return
 
-        # create a new event to use to control the new process managers
-        # the existing process managers will still have references to the old event that is now set
-        self.process_manager_event = Event()
+        for index, p in enumerate(self.process_managers):
+            if p.is_alive():
+                continue
 
-        while not self.shutdown:
-            # as each of them stop, start up a new one
-            for index, p in enumerate(self.process_managers):
-                if restarted[index]:
-                    continue
+            p.join()
+            logging.warning("process manager {} exited unexpectedly with exit code {} - starting new process "
+                            "manager".format(p.pid, p.exitcode))
+            self.process_managers[index] = self.start_process_manager(index)
+            increment_metric('process_manager_restarts', labels={ 'reason': 'exited' })
+
+    def restart_process_managers(self, old_zygote):
+        """Replaces the process managers forked from old_zygote with ones forked from the current zygote.
+           The process managers are replaced one at a time so that the engine never drops below 
+           analysis_pool_size - 1 process managers."""
+        logging.info("restarting process managers for {}".format(self.name))
 
+        for index, p in enumerate(self.process_managers):
+            if self.shutdown:
+                break
+
+            # ask this one process manager to stop after it finishes what it's working on
+            logging.debug("stopping process manager {}".format(p.pid))
+            p.stop()
+            stop_time = time.time()
+            while not self.shutdown and p.is_alive():
                 p.join(0.1)
-                if p.is_alive():
-                    continue
 
-                logging.debug("process manager {} stopped".format(p.pid))
-                new_process = Process(target=self.process_manager_loop, 
-                                      name='{} Process Manager'.format(self.name))
-                new_process.start()
-                new_process_managers.append(new_process)
-                restarted[index] = True
-                continue
+                # a hung analysis module would otherwise stall the engine here for good
+                if self.process_manager_stop_timeout and \
+                   time.time() - stop_time >= self.process_manager_stop_timeout:
+                    logging.warning("process manager {} did not stop within {} seconds - sending SIGTERM".format(
+                                    p.pid, self.process_manager_stop_timeout))
+                    signal_process(p, signal.SIGTERM)
+                    p.join(10)
+                    if p.is_alive():
+                        logging.warning("sending SIGKILL to process manager {}".format(p.pid))
+                        signal_process(p, signal.SIGKILL)
+                        p.join(10)
+
+                    break
 
-            if all(restarted):
+            if self.shutdown:
                 break
 
-        # we now have a new list of process managers
-        old_process_managers = self.process_managers
-        self.process_managers = new_process_managers
+            logging.debug("process manager {} stopped".format(p.pid))
+            self.process_managers[index] = self.start_process_manager(index)
+            increment_metric('process_manager_restarts', labels={ 'reason': 'reload' })
 
         # if we broke out while we are shutting down then it's possible that there are
         # child processes still running that haven't stop yet
         if self.shutdown:
-            for p in old_process_managers:
+            for p in self.process_managers:
+                if p.zygote is not old_zygote or not p.is_alive():
+                    continue
+
                 logging.warning("sending SIGTERM to remaining child process {}".format(p.pid))
                 signal_process(p, signal.SIGTERM)
                 p.join(10)
@@ -1649,11 +2318,20 @@ class Engine(object):
                     logging.warning("sending SIGKILL to remaining child process {}".format(p.pid))
                     signal_process(p, signal.SIGKILL)
 
+        # everything forked from the old zygote is gone at this point
+        if old_zygote is not None:
+            old_zygote.shutdown(timeout=10)
+
         logging.info("finished restarting process managers for {}".format(self.name))
 
-    def process_manager_loop(self):
+    def process_manager_loop(self, metrics_slot=0, stop_event=None):
         logging.info("started process manager loop on process {}".format(os.getpid()))
+        self.process_manager_stop_event = stop_event
+        self.process_manager_index = metrics_slot - 1
         enable_cached_db_connections()
+        set_metrics_slot(metrics_slot)
+        if self.module_timings is not None:
+            self.module_timings.set_slot(metrics_slot)
 
         def handle_sigusr1(signum, frame):
             self.sigusr1_received = True
@@ -1663,6 +2341,8 @@ class Engine(object):
 
         signal.signal(signal.SIGUSR1, handle_sigusr1)
         signal.signal(signal.SIGUSR2, handle_sigusr2)
+
+        self.analysis_watchdog.start()
         
         while not self.process_manager_shutdown:
             if self.sigusr1_received:
@@ -1682,9 +2362,10 @@ class Engine(object):
 
             if self.sigusr2_received:
                 try:
-                    pass
+                    self.toggle_sampling_profiler()
                 except Exception as e:
-                    logging.error(str(e))
+                    logging.error("unable to toggle sampling profiler: {}".format(e))
+                    report_exception()
 
                 self.sigusr2_received = False
 
@@ -1699,8 +2380,37 @@ class Engine(object):
                 time.sleep(1)
 
         logging.debug("process manager {} exiting".format(os.getpid()))
+        # don't lose what we've profiled so far
+        if self.sampling_profiler is not None and self.sampling_profiler.running:
+            self.toggle_sampling_profiler()
+
+        self.analysis_watchdog.stop()
+        if self.io_prefetcher is not None:
+            self.io_prefetcher.shutdown()
+            self.io_prefetcher = None
+
         release_cached_db_connection()
 
+    def toggle_sampling_profiler(self):
+        """Starts the sampling profiler for the current process, or stops it and writes out what it collected.
+           Returns the path to the profile that was written, or None if the profiler was started."""
+        if self.sampling_profiler is None or not self.sampling_profiler.running:
+            self.sampling_profiler = SamplingProfiler(
+                interval=saq.CONFIG['global'].getfloat('profiler_sample_interval', fallback=0.01))
+            self.sampling_profiler.start()
+            return None
+
+        self.sampling_profiler.stop()
+        if not os.path.isdir(self.profile_dir):
+            os.makedirs(self.profile_dir)
+
+        path = os.path.join(self.profile_dir, '{}-{}.folded'.format(
+                            datetime.datetime.now().strftime('%Y%m%d%H%M%S'), os.getpid()))
+        self.sampling_profiler.write(path)
+        logging.info("wrote {} profiler samples to {}".format(self.sampling_profiler.sample_count, path))
+        self.sampling_profiler = None
+        return path
+
     def log_process_statistics(self):
         if self.statistic_dump_frequency == 0:
             return
@@ -1738,25 +2448,41 @@ class Engine(object):
                         logging.error("unable to auto-reload {}: {}".format(analysis_module, e))
                         report_exception()
 
+                # the modules may have changed what they accept
+                self.build_module_dispatch_index()
+
         target_function = None
 
         # reset state flags
         self._cancel_analysis_flag = False
 
-        # if the work item is a delayed analysis request then it goes straight to processing
-        if isinstance(work_item, DelayedAnalysisRequest):
+        self.analysis_checkpointed = False
+
+        # if the work item is a delayed analysis request (or resumed analysis) then it goes straight to processing
+        if isinstance(work_item, DelayedAnalysisRequest) or isinstance(work_item, CheckpointedAnalysisRequest):
             target_function = self.analyze
         # did this come from processing?
         else:
             # otherwise the work_item is abstract and given to the process function for processing
             target_function = self.process
 
+        if self.backpressure is not None and self.process_manager_index is not None:
+            self.backpressure.set_busy(self.process_manager_index, True)
+
         # TODO start a thread to the side that logs the process statistics
         try:
             target_function(work_item)
         except Exception as e:
             logging.error("processing of {} failed: {}".format(work_item, e))
             report_exception()
+        finally:
+            if self.backpressure is not None and self.process_manager_index is not None:
+                self.backpressure.set_busy(self.process_manager_index, False)
+
+        # interrupted analysis is not done yet
+        if self.analysis_checkpointed:
+            logging.info("not calling cleanup for checkpointed {}".format(work_item))
+            return
 
         # ensure the engine has a chance to clean up
         try:
@@ -1766,6 +2492,13 @@ class Engine(object):
             logging.error("unable to cleanup work item {}: {}".format(work_item, e))
             report_exception()
 
+    def _delete_delayed_analysis_request(self, request):
+        try:
+            self.delayed_analysis_store.delete(request)
+        except Exception as e:
+            logging.error("unable to delete {} from delayed analysis store: {}".format(request, e))
+            report_exception()
+
     def child_process_wrapper(self, target_function, *args, **kwargs):
         try:
             target_function(*args, **kwargs)
@@ -1773,7 +2506,8 @@ class Engine(object):
             logging.warning("caught user interrupt in child_process_wrapper")
 
     def analyze(self, target):
-        assert isinstance(target, saq.analysis.RootAnalysis) or isinstance(target, DelayedAnalysisRequest)
+        assert isinstance(target, saq.analysis.RootAnalysis) or isinstance(target, DelayedAnalysisRequest) \
+               or isinstance(target, CheckpointedAnalysisRequest)
     
         # make sure root analysis has it's storage directory available
         if isinstance(target, saq.analysis.RootAnalysis):
@@ -1793,6 +2527,26 @@ class Engine(object):
 
         self.root = target # usually this is the RootAnalysis
         self.delayed_analysis_request = None
+        self.analysis_checkpoint_request = None
+        self.analysis_checkpoint_saved = False
+        self.analysis_checkpointed = False
+        self.last_analysis_checkpoint = time.time()
+
+        # are we resuming analysis that was interrupted?
+        if isinstance(target, CheckpointedAnalysisRequest):
+            self.analysis_checkpoint_request = target
+            self.analysis_checkpoint_saved = True
+            self.root = target.target_type(storage_dir=target.storage_dir)
+
+            if not os.path.isdir(self.root.storage_dir):
+                logging.warning("storage directory {} missing - already processed?".format(self.root.storage_dir))
+                target.unlock()
+                self.analysis_checkpoint_store.delete(target.uuid)
+                return
+
+            self.root.load()
+            target.transfer_locks_to(self.root)
+            logging.info("resuming analysis of {} ({} work items)".format(self.root, len(target.work)))
 
         # are we completing an analysis request?
         if isinstance(target, DelayedAnalysisRequest):
@@ -1810,6 +2564,7 @@ class Engine(object):
                 logging.warning("storage directory {} missing - already processed?".format(self.root.storage_dir))
                 # don't leave locks behind
                 self.delayed_analysis_request.unlock()
+                self._delete_delayed_analysis_request(self.delayed_analysis_request)
                 return
 
             # load from JSON
@@ -1818,8 +2573,8 @@ class Engine(object):
             # transfer locks from the DelayedAnalysisRequest
             self.delayed_analysis_request.transfer_locks_to(self.root)
 
-            # at this point the delayed analysis *request* is done (even though we are currently analyzing)
-            # so we delete the tracking we're doing
+            # the request stays in the delayed analysis store until the analysis it requested has been saved
+
             try:
                 observable = self.root.get_observable(self.delayed_analysis_request.observable_uuid)
                 analysis_module = None
@@ -1854,7 +2609,11 @@ class Engine(object):
             analysis_module.root = self.root
 
         # when something goes wrong it helps to have the logs specific to this analysis
-        logging_handler = logging.FileHandler(os.path.join(self.root.storage_dir, 'saq.log'))
+        if self.analysis_log_buffer_size:
+            logging_handler = AnalysisLogBuffer(self.analysis_log_buffer_size)
+        else:
+            logging_handler = logging.FileHandler(os.path.join(self.root.storage_dir, 'saq.log'))
+
         logging_handler.setLevel(logging.getLogger().level)
         logging_handler.setFormatter(logging.getLogger().handlers[0].formatter)
         logging.getLogger().addHandler(logging_handler)
@@ -1865,6 +2624,15 @@ class Engine(object):
 
         elapsed_time = None
         error_report_path = None
+        analysis_failed = False
+
+        self.initialize_io_prefetcher()
+
+        if self.memory_budget:
+            self.root_memory_start = self.root_memory_high_water = self.current_memory_usage()
+            self.root_details_evicted = 0
+            self.last_eviction_memory_usage = 0
+            self.last_memory_check = time.time()
 
         try:
             start_time = time.time()
@@ -1873,11 +2641,15 @@ class Engine(object):
                 self.execute_module_analysis()
 
             elapsed_time = time.time() - start_time
-            logging.info("completed analysis {} in {:.2f} seconds".format(target, elapsed_time))
 
-            if self.root.delayed:
+            if self.analysis_checkpointed:
+                # this gets resumed by the engine (see checkpoint_analysis)
+                logging.info("checkpointed interrupted analysis {} after {:.2f} seconds".format(target, elapsed_time))
+            elif self.root.delayed:
+                logging.info("completed analysis {} in {:.2f} seconds".format(target, elapsed_time))
                 self.root.save()
             else:
+                logging.info("completed analysis {} in {:.2f} seconds".format(target, elapsed_time))
                 self.execute_module_post_analysis()
                 self.execute_profile_point_analysis()
 
@@ -1885,15 +2657,30 @@ class Engine(object):
                 # it may want to do something with it like create an alert to notify someone
                 self.post_analysis(self.root)
 
-                # save all the changes we've made
-                self.root.save() # TODO this is saving even before we may be about to delete
+                # keep a single copy of each file (if the blob store is enabled)
+                try:
+                    self.root.store_files()
+                except Exception as e:
+                    logging.error("unable to store the files of {}: {}".format(self.root, e))
+                    report_exception()
+
+                # save all the changes we've made (and compact the journal into data.json)
+                self.root.compact() # TODO this is saving even before we may be about to delete
 
                 # notify that we've fully completed analysis for this
                 self.root_analysis_completed(self.root)
 
+            if self.analysis_checkpointed:
+                increment_metric('roots_checkpointed')
+            else:
+                increment_metric('roots_analyzed')
+                observe_metric('root_analysis_seconds', elapsed_time)
+
         except Exception as e:
             elapsed_time = time.time() - start_time
             logging.error("anaysis failed on {}: {}".format(self.root, e))
+            increment_metric('roots_failed')
+            analysis_failed = True
             error_report_path = report_exception()
 
             try:
@@ -1906,9 +2693,51 @@ class Engine(object):
             # make sure we remove the logging handler that we added
             logging.getLogger().removeHandler(logging_handler)
 
+            # drop any i/o results for this root
+            if self.io_prefetcher is not None:
+                self.io_prefetcher.reset()
+
             # turn off the root lock manager
             self.stop_root_lock_manager()
 
+        if self.memory_budget:
+            try:
+                self.record_root_memory(elapsed_time)
+            except Exception as e:
+                logging.error("unable to record memory usage of {}: {}".format(self.root, e))
+                report_exception()
+
+        # the delayed analysis request is done once the delayed analysis has executed and the root has been saved
+        # if analysis failed it stays in the store and is loaded again when the engine restarts
+        if self.delayed_analysis_request is not None:
+            if not analysis_failed:
+                self._delete_delayed_analysis_request(self.delayed_analysis_request)
+            else:
+                logging.warning("keeping {} in the delayed analysis store after failed analysis".format(
+                                self.delayed_analysis_request))
+
+        # the checkpoint is only needed if analysis was interrupted
+        if self.analysis_checkpoint_saved and not self.analysis_checkpointed:
+            try:
+                self.analysis_checkpoint_store.delete(self.root.uuid)
+            except Exception as e:
+                logging.error("unable to delete analysis checkpoint for {}: {}".format(self.root, e))
+                report_exception()
+
+        # buffered logs are only kept when analysis failed, something was logged at analysis_log_flush_level or above, 
+        # or the root was randomly sampled
+        if isinstance(logging_handler, AnalysisLogBuffer):
+            try:
+                if error_report_path or logging_handler.max_level >= self.analysis_log_flush_level \
+                or random.random() < self.analysis_log_sample_rate:
+                    if os.path.isdir(self.root.storage_dir):
+                        logging_handler.write(os.path.join(self.root.storage_dir, 'saq.log'))
+            except Exception as e:
+                logging.error("unable to write analysis log for {}: {}".format(self.root, e))
+                report_exception()
+
+        logging_handler.close()
+
         # unlock the root if it isn't already
         if isinstance(self.root, LockableObject):
             self.root.unlock()
@@ -1944,47 +2773,83 @@ class Engine(object):
             except Exception as e:
                 logging.error("unable to create error reporting stats dir {}: {}".format(error_report_stats_dir, e))
 
-        # save module execution time metrics
-        try:
-            # how long did all the analysis take combined?
-            _total = 0.0
-            for key in self.total_analysis_time.keys():
-                _total += self.total_analysis_time[key]
-
-            for key in self.total_analysis_time.keys():
-                subdir_name = os.path.join(self.stats_dir, datetime.datetime.now().strftime('%Y%m%d'))
-                if not os.path.isdir(subdir_name):
-                    try:
-                        os.mkdir(subdir_name)
-                    except Exception as e:
-                        logging.error("unable to create new stats subdir {}: {}".format(subdir_name, e))
-                        continue
-
-                percentage = '?'
-                if elapsed_time:
-                    percentage = '{0:.2f}%'.format((self.total_analysis_time[key] / elapsed_time) * 100.0)
-                if not elapsed_time:
-                    elapsed_time = 0
-
-                output_line = '{} ({}) [{:.2f}:{:.2f}] - {}\n'.format(
-                              datetime.timedelta(seconds=self.total_analysis_time[key]),
-                              percentage,
-                              _total,
-                              elapsed_time,
-                              self.root.uuid)
-
-                with open(os.path.join(subdir_name, '{}.stats'.format(key)), 'a') as fp:
-                    fp.write(output_line)
+        # module execution time for every root is kept in self.module_timings (see flush_module_timings)
+        # here we save the module execution time metrics of analysis that failed for review
+        if error_report_stats_dir:
+            try:
+                # how long did all the analysis take combined?
+                _total = 0.0
+                for key in self.total_analysis_time.keys():
+                    _total += self.total_analysis_time[key]
+
+                for key in self.total_analysis_time.keys():
+                    percentage = '?'
+                    if elapsed_time:
+                        percentage = '{0:.2f}%'.format((self.total_analysis_time[key] / elapsed_time) * 100.0)
+                    if not elapsed_time:
+                        elapsed_time = 0
+
+                    output_line = '{} ({}) [{:.2f}:{:.2f}] - {}\n'.format(
+                                  datetime.timedelta(seconds=self.total_analysis_time[key]),
+                                  percentage,
+                                  _total,
+                                  elapsed_time,
+                                  self.root.uuid)
 
-                if error_report_stats_dir:
                     with open(os.path.join(error_report_stats_dir, '{}.stats'.format(key)), 'a') as fp:
                         fp.write(output_line)
 
-        except Exception as e:
-            logging.error("unable to record statistics: {}".format(e))
+            except Exception as e:
+                logging.error("unable to record statistics: {}".format(e))
 
         return
 
+    def initialize_io_prefetcher(self):
+        """Creates the IOPrefetcher for the current process if it is enabled and does not exist yet."""
+        if not self.io_pool_size:
+            return
+
+        # the threads of the pool do not survive a fork
+        if self.io_prefetcher is not None and self.io_prefetcher.pid == os.getpid():
+            return
+
+        self.io_prefetcher = IOPrefetcher(self.io_pool_size)
+
+    def prefetch_io(self, observables):
+        """Starts executing the i/o of the I/O bound analysis modules that will analyze the given observables."""
+        for observable in observables:
+            if observable.has_tag('whitelisted') or observable.has_directive(DIRECTIVE_EXCLUDE_ALL):
+                continue
+
+            if self.observable_exclusions.is_excluded(observable):
+                continue
+
+            for analysis_module in self.get_dispatch_modules(observable):
+                if not analysis_module.io_bound or isinstance(analysis_module, PostAnalysisModule):
+                    continue
+
+                if observable.limited_analysis and type(analysis_module).__name__ not in observable.limited_analysis:
+                    continue
+
+                # already analyzed (or already refused to)
+                if observable.get_analysis(analysis_module.generated_analysis_type) is not None:
+                    continue
+
+                try:
+                    # accepts() has side effects (the cooldown) that only belong to actual analysis
+                    if not analysis_module.is_valid_target(observable):
+                        continue
+
+                    # no need for the i/o if the module is going to use a cached result
+                    if analysis_module.result_cache is not None \
+                    and analysis_module.result_cache.get(analysis_module.cache_key(observable)) is not None:
+                        continue
+
+                    self.io_prefetcher.submit(analysis_module, observable)
+                except Exception as e:
+                    logging.error("unable to prefetch i/o for {} with {}: {}".format(observable, analysis_module, e))
+                    report_exception()
+
     # ------------------------------------------------------------------------
     # This is the main processing loop of analysis in ACE.
     #
@@ -2048,6 +2913,13 @@ class Engine(object):
         # our list of things to analyze (of type WorkTarget)
         work_stack = WorkStack()
 
+        # the ids of the observables we've already started the i/o for (see prefetch_io)
+        io_prefetched = set()
+
+        # so we can report how many accepts() calls were made for this root
+        accepts_calls = self.accepts_calls
+        accepts_calls_avoided = self.accepts_calls_avoided
+
         # temporary work stack buffer
         work_stack_buffer = []
 
@@ -2068,6 +2940,22 @@ class Engine(object):
             if len(work_stack) != 1:
                 raise RuntimeError("delayed analysis request {} references missing analysis module".format(
                                     self.delayed_analysis_request))
+
+        # if we are resuming analysis that was interrupted then we pick up where we left off
+        elif self.analysis_checkpoint_request is not None:
+            for observable_id, config_section in self.analysis_checkpoint_request.work:
+                observable = self.root.get_observable(observable_id)
+                if observable is None:
+                    continue
+
+                if config_section is None:
+                    work_stack.append(observable)
+                    continue
+
+                for analysis_module in self.analysis_modules:
+                    if analysis_module.config_section == config_section:
+                        work_stack.append(WorkTarget(observable=observable, analysis_module=analysis_module))
+                        break
         else:
             # otherwise we analyze everything
             for analysis in self.root.all_analysis:
@@ -2129,6 +3017,13 @@ class Engine(object):
         # then we iterate through all the analysis modules executing the execute_final_analysis function
         # this gives modules the ability to delay their analysis until everything else is done
         final_analysis_mode = False
+        if self.analysis_checkpoint_request is not None:
+            final_analysis_mode = self.analysis_checkpoint_request.final_analysis_mode
+
+        # set to True when there is nothing left to do
+        analysis_completed = False
+        # the current WorkTarget
+        work_item = None
 
         # when we started analyzing this
         start_time = datetime.datetime.now()
@@ -2152,6 +3047,15 @@ class Engine(object):
             if elapsed_time >= self.maximum_cumulative_analysis_fail_time:
                 raise AnalysisTimeoutError("ACE took too long to analyze {}".format(self.root))
 
+            # keep the memory used by this root within budget
+            if self.memory_budget and time.time() - self.last_memory_check >= self.memory_check_frequency:
+                self.check_memory_budget()
+
+            # save where we're at every so often so that we can resume from here if we're interrupted
+            if self.analysis_checkpoint_frequency and \
+               time.time() - self.last_analysis_checkpoint >= self.analysis_checkpoint_frequency:
+                self.checkpoint_analysis(work_stack.work, final_analysis_mode)
+
             # are we done?
             logging.debug("work stack size {} active dependencies {}".format(len(work_stack), len(self.root.active_dependencies)))
             if len(work_stack) == 0 and len(self.root.active_dependencies) == 0:
@@ -2159,6 +3063,7 @@ class Engine(object):
                 # are we in final analysis mode?
                 if final_analysis_mode:
                     # then we are truly done
+                    analysis_completed = True
                     break
 
                 # should we enter into final analysis mode?
@@ -2174,6 +3079,7 @@ class Engine(object):
 
                 else:
                     logging.info("not entering final analysis mode for {} (delayed analysis waiting)".format(self.root))
+                    analysis_completed = True
                     break
 
             # get the next thing to analyze
@@ -2249,24 +3155,7 @@ class Engine(object):
                     continue
 
                 # is this observable excluded?
-                excluded = False
-                if work_item.observable.type in self.observable_exclusions:
-
-                    # XXX this is where you'd want specific types for observables with overloaded ==
-                    # so special case for ipv4 so you can allow cidr
-                    exclusions = self.observable_exclusions[work_item.observable.type]
-                    if work_item.observable.type == F_IPV4:
-                        exclusions = [iptools.IpRange(x) for x in exclusions]
-                    for exclusion in exclusions:
-                        try:
-                            if work_item.observable.value in exclusion:
-                                excluded = True
-                                break
-                        except Exception as e:
-                            logging.debug("{} probably is not an IP address".format(work_item.observable.value))
-                            #report_exception()
-
-                if excluded:
+                if self.observable_exclusions.is_excluded(work_item.observable):
                     logging.debug("ignoring globally excluded observable {}".format(work_item.observable))
                     if work_item.dependency:
                         work_item.dependency.set_status_failed('globally excluded observable')
@@ -2282,6 +3171,15 @@ class Engine(object):
                         work_item.dependency.increment_status()
                     continue
 
+            # start the i/o for this observable and the ones coming up next so that they execute concurrently
+            if self.io_prefetcher is not None and work_item.observable and not final_analysis_mode:
+                upcoming = [work_item.observable]
+                upcoming.extend([t.observable for t in itertools.islice(work_stack.work, self.io_prefetch_depth) 
+                                 if t.observable])
+                upcoming = [o for o in upcoming if o.id not in io_prefetched]
+                io_prefetched.update([o.id for o in upcoming])
+                self.prefetch_io(upcoming)
+
             # select the analysis modules we want to use
             # normally we want to analyze with all the enabled modules
             analysis_modules = self.analysis_modules
@@ -2303,6 +3201,11 @@ class Engine(object):
             else:
                 logging.debug("analysis for {} not limited".format(work_item))
 
+                # only check the analysis modules that could possibly accept this observable
+                if work_item.observable:
+                    analysis_modules = self.get_dispatch_modules(work_item.observable)
+                    self.accepts_calls_avoided += self.module_dispatch_count - len(analysis_modules)
+
             # analyze this thing with the analysis modules we've selected
             for analysis_module in analysis_modules:
 
@@ -2315,6 +3218,7 @@ class Engine(object):
 
                 if work_item.observable:
                     # does this module accept this observable type?
+                    self.accepts_calls += 1
                     if not analysis_module.accepts(work_item.observable):
                         if work_item.dependency:
                             work_item.dependency.set_status_failed('unaccepted for analysis')
@@ -2339,37 +3243,31 @@ class Engine(object):
                         logging.debug("analyzing {} with {} (final analysis={})".format(
                                        work_item.observable, analysis_module, final_analysis_mode))
 
-                        def _monitor(monitor_event, monitor_module, monitor_target):
-                            monitor_start_time = datetime.datetime.now()
-                            monitor_event.wait(timeout=self.maximum_analysis_time)
-                            monitor_elapsed_time = (datetime.datetime.now() - monitor_start_time).total_seconds()
-                            if monitor_elapsed_time > self.maximum_analysis_time:
-                                while True:
-                                    logging.warning("excessive time - analysis module {} has been analyzing {} for {} seconds".format(
-                                                     monitor_module, monitor_target, monitor_elapsed_time))
-
-                                    # repeat warning every 10 seconds until we bail
-                                    # TODO possibly kill the analysis somehow
-                                    if monitor_event.wait(timeout=10):
-                                        break
-
-                        # start a side thread that watches how long a single analysis request can take
-                        monitor_event = threading.Event()
-                        monitor_thread = threading.Thread(target=_monitor, args=(monitor_event, 
-                                                                                 analysis_module, 
-                                                                                 work_item.observable))
-                        monitor_thread.daemon = True
-                        monitor_thread.start()
+                        # the watchdog thread keeps track of how long a single analysis request can take
+                        deadline = self.analysis_watchdog.register(analysis_module, work_item.observable, 
+                                                                   self.root.uuid)
 
                         # we indicate that the analysis module refused to generate analysis (for whatever reason)
                         # by returning False here
+                        # profiler samples are grouped by analysis module and observable type
+                        if self.sampling_profiler is not None:
+                            self.sampling_profiler.context = (analysis_module.config_section, 
+                                                              work_item.observable.type)
+
                         try:
                             module_start_time = datetime.datetime.now()
                             analysis_result = analysis_module.analyze(work_item.observable, final_analysis_mode)
                         finally:
-                            # make sure we stop the monitor thread
-                            monitor_event.set()
-                            monitor_thread.join()
+                            self.analysis_watchdog.clear(deadline)
+                            if self.sampling_profiler is not None:
+                                self.sampling_profiler.context = None
+
+                        # if the watchdog cancelled this module then let it continue with the next observable
+                        if deadline.enforced:
+                            logging.warning("analysis module {} was cancelled analyzing {}".format(
+                                            analysis_module, work_item.observable))
+                            if not self.cancel_analysis_flag:
+                                analysis_module.cancel_analysis_flag = False
 
                         # this should always return a boolean
                         # but just warn if it doesn't
@@ -2455,6 +3353,18 @@ class Engine(object):
                     self.total_analysis_time[analysis_module.config_section] = 0
 
                 self.total_analysis_time[analysis_module.config_section] += (module_end_time - module_start_time).total_seconds()
+                observe_metric('module_analysis_seconds', (module_end_time - module_start_time).total_seconds(),
+                               labels={ 'module': analysis_module.config_section })
+
+                if self.module_timings is not None:
+                    try:
+                        self.module_timings.observe('module_timing', 
+                                                    (module_end_time - module_start_time).total_seconds(),
+                                                    labels={ 'module': analysis_module.config_section,
+                                                             'observable_type': work_item.observable.type 
+                                                                                if work_item.observable else '' })
+                    except Exception as e:
+                        logging.error("unable to record module timing: {}".format(e))
 
                 # when analyze() executes it populates the work_stack_buffer with things that need to be analyzed
                 # if the thing that was just analyzed turned out to be whitelisted (tagged with 'whitelisted')
@@ -2486,11 +3396,172 @@ class Engine(object):
                         # then we exit final analysis mode so that everything can get a chance to execute again
                         final_analysis_mode = False
 
+        logging.debug("made {} calls to accepts() ({} avoided) for {}".format(
+                      self.accepts_calls - accepts_calls, self.accepts_calls_avoided - accepts_calls_avoided, self.root))
+
+        # were we stopped before we could finish?
+        if not analysis_completed and self.analysis_checkpoint_frequency and self.analysis_interrupted:
+            logging.info("analysis of {} was interrupted with {} work items left".format(self.root, len(work_stack)))
+            # the work item we were on may not have been analyzed by every module yet
+            # (modules do not analyze the same thing twice so it's OK to do it again)
+            work = list(work_stack.work)
+            if work_item is not None:
+                work.insert(0, work_item)
+
+            if self.checkpoint_analysis(work, final_analysis_mode):
+                self.analysis_checkpointed = True
+                # hand it back to the engine to resume (if the engine is also stopping it gets loaded from the store)
+                if not self.shutdown and self.count_analysis_resume(self.analysis_checkpoint_request):
+                    self.delayed_analysis_xfer_queue.put_nowait((time.time(), self.analysis_checkpoint_request))
+
+                return
+
         # did analysis complete when there was work left to do?
         if len(work_stack):
             logging.info("work on {} was incomplete".format(self.root))
             self.work_incomplete(self.root)
 
+    def current_memory_usage(self):
+        """Returns the resident memory (in bytes) used by the current process."""
+        if self._memory_process is None or self._memory_process.pid != os.getpid():
+            self._memory_process = psutil.Process()
+
+        return self._memory_process.memory_info().rss
+
+    def check_memory_budget(self):
+        """Evicts the details of finished analysis if the current process is over the memory budget."""
+        self.last_memory_check = time.time()
+        memory_usage = self.current_memory_usage()
+        if memory_usage > self.root_memory_high_water:
+            self.root_memory_high_water = memory_usage
+
+        if memory_usage <= self.memory_budget:
+            return
+
+        # the rss rarely goes back down after the details are dropped so we only evict again once memory has grown
+        # by another tenth of the budget (otherwise every check would evict whatever was loaded again since then)
+        if self.last_eviction_memory_usage and \
+           memory_usage < self.last_eviction_memory_usage + self.memory_budget / 10:
+            return
+
+        self.last_eviction_memory_usage = memory_usage
+        evicted = self.evict_analysis_details()
+        self.root_details_evicted += evicted
+        increment_metric('analysis_details_evicted', evicted)
+        logging.info("process {} using {} MB (budget {} MB) analyzing {} - evicted details of {} analysis".format(
+                     os.getpid(), int(memory_usage / 1024 / 1024), int(self.memory_budget / 1024 / 1024), 
+                     self.root, evicted))
+
+    def evict_analysis_details(self):
+        """Writes out and drops the details of the Analysis objects that are finished.
+           The details are loaded back from disk if they are used again. Returns the number of details evicted."""
+        evicted = 0
+        for analysis in self.root.all_analysis:
+            # the details of the root are always kept
+            if analysis is self.root:
+                continue
+
+            # nothing loaded
+            if analysis._details is None:
+                continue
+
+            # still being worked on
+            if not analysis.completed or analysis.delayed:
+                continue
+
+            if analysis.observable is not None and \
+               [d for d in analysis.observable.dependencies if not d.resolved and not d.failed]:
+                continue
+
+            try:
+                analysis.flush()
+                evicted += 1
+            except Exception as e:
+                logging.error("unable to evict details of {}: {}".format(analysis, e))
+                report_exception()
+
+        return evicted
+
+    def record_root_memory(self, elapsed_time):
+        """Appends the memory high-water mark of the current root to stats/modules/ENGINE/YYYYMMDD/root_memory.csv"""
+        # analysis is over (and the storage directory may already be gone) so nothing is evicted here
+        memory_usage = self.current_memory_usage()
+        if memory_usage > self.root_memory_high_water:
+            self.root_memory_high_water = memory_usage
+
+        observe_metric('root_memory_growth_bytes', self.root_memory_high_water - self.root_memory_start)
+
+        subdir_name = os.path.join(self.stats_dir, datetime.datetime.now().strftime('%Y%m%d'))
+        if not os.path.isdir(subdir_name):
+            os.makedirs(subdir_name)
+
+        path = os.path.join(subdir_name, 'root_memory.csv')
+        write_header = not os.path.exists(path)
+        with open(path, 'a', newline='') as fp:
+            writer = csv.writer(fp)
+            if write_header:
+                writer.writerow(ROOT_MEMORY_HEADER)
+
+            writer.writerow([ datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'), 
+                              os.getpid(),
+                              self.root.uuid,
+                              self.root.storage_dir,
+                              self.root_memory_start,
+                              self.root_memory_high_water,
+                              self.root_details_evicted,
+                              len(self.root.all_observables),
+                              len(self.root.all_analysis),
+                              '{:.2f}'.format(elapsed_time) if elapsed_time is not None else '' ])
+
+    def analysis_killed(self, deadline):
+        """Called by the analysis watchdog (on its own thread) right before it kills this process because an analysis 
+           module hung. The lock on the root is released and the last checkpoint of the root (if there is one) is 
+           handed back to the engine so that the process manager that replaces this one resumes from there.
+
+           The analysis tree still belongs to the thread that is stuck in the module so none of it is saved here."""
+        if self.root is None or self.root.uuid != deadline.root_uuid:
+            return
+
+        try:
+            if self.analysis_checkpoint_frequency and self.analysis_checkpoint_saved \
+            and self.analysis_checkpoint_request is not None \
+            and self.count_analysis_resume(self.analysis_checkpoint_request):
+                logging.info("resuming {} from the last checkpoint after killing process {}".format(
+                             self.root, os.getpid()))
+                self.delayed_analysis_xfer_queue.put_nowait((time.time(), self.analysis_checkpoint_request))
+                # the queue is written to by a thread that does not survive os._exit
+                self.delayed_analysis_xfer_queue.close()
+                self.delayed_analysis_xfer_queue.join_thread()
+        finally:
+            self.stop_root_lock_manager()
+            if isinstance(self.root, LockableObject):
+                self.root.unlock()
+
+    def checkpoint_analysis(self, work, final_analysis_mode):
+        """Saves the current root and the given work (of WorkTarget objects) so analysis can be resumed later.
+           Returns True if the checkpoint was saved."""
+        self.last_analysis_checkpoint = time.time()
+        resume_count = 0
+        if self.analysis_checkpoint_request is not None:
+            resume_count = self.analysis_checkpoint_request.resume_count
+
+        try:
+            request = CheckpointedAnalysisRequest(self.root, 
+                [(target.observable.id, target.analysis_module.config_section if target.analysis_module else None)
+                 for target in work if target.observable], final_analysis_mode, resume_count)
+
+            self.root.save()
+            self.analysis_checkpoint_store.save(request)
+            self.analysis_checkpoint_request = request
+            self.analysis_checkpoint_saved = True
+            logging.debug("checkpointed {} with {} work items".format(self.root, len(request.work)))
+            return True
+
+        except Exception as e:
+            logging.error("unable to checkpoint analysis of {}: {}".format(self.root, e))
+            report_exception()
+            return False
+
     def execute_module_post_analysis(self):
         logging.debug("executing post analysis on {}".format(self.root))
         for analysis_module in self.analysis_modules:
@@ -2568,7 +3639,7 @@ class Engine(object):
         seconds = float(seconds)
         while not self.shutdown and seconds > 0:
             # we also want to support sleeping for less than a second
-            time.sleep(1.0 if seconds > 0 else seconds)
+            time.sleep(min(1.0, seconds))
             seconds -= 1.0
 
 class DelayedAnalysisRequest(LocalLockableObject):
@@ -2635,6 +3706,197 @@ class DelayedAnalysisRequest(LocalLockableObject):
     def __lt__(self, other):
         return False
 
+class SQLiteObjectStore(object):
+    """Persists pickled objects by key to a table in a local sqlite database.
+       Objects are loaded back in the order of the value stored in the sort column.
+       Subclasses set TABLE, KEY_COLUMN, SORT_COLUMN and (optionally) SORT_INDEX."""
+
+    TABLE = None
+    KEY_COLUMN = 'key'
+    SORT_COLUMN = None
+    SORT_INDEX = None
+
+    def __init__(self, path):
+        self.path = path
+
+    def _connect(self):
+        return closing(sqlite3.connect(self.path, timeout=30))
+
+    def initialize(self):
+        with self._connect() as db:
+            db.execute("""CREATE TABLE IF NOT EXISTS {} (
+                              {} TEXT PRIMARY KEY,
+                              {} REAL NOT NULL,
+                              request BLOB NOT NULL )""".format(self.TABLE, self.KEY_COLUMN, self.SORT_COLUMN))
+            if self.SORT_INDEX:
+                db.execute("""CREATE INDEX IF NOT EXISTS {} ON {} ( {} )""".format(
+                           self.SORT_INDEX, self.TABLE, self.SORT_COLUMN))
+            db.commit()
+
+    def _save(self, key, sort_value, obj):
+        with self._connect() as db:
+            db.execute("""INSERT OR REPLACE INTO {} ( {}, {}, request ) VALUES ( ?, ?, ? )""".format(
+                       self.TABLE, self.KEY_COLUMN, self.SORT_COLUMN), (key, sort_value, pickle.dumps(obj)))
+            db.commit()
+
+    def _delete(self, key, sort_value=None):
+        """Deletes the object stored with the given key. If sort_value is not None then it is only deleted if it 
+           was saved with that sort value (and not replaced since then.)"""
+        with self._connect() as db:
+            if sort_value is None:
+                db.execute("""DELETE FROM {} WHERE {} = ?""".format(self.TABLE, self.KEY_COLUMN), (key,))
+            else:
+                db.execute("""DELETE FROM {} WHERE {} = ? AND {} = ?""".format(
+                           self.TABLE, self.KEY_COLUMN, self.SORT_COLUMN), (key, sort_value))
+
+            db.commit()
+
+    def _load(self):
+        """Returns the list of tuple(sort_value, object) in sort order.
+           Anything that cannot be unpickled is logged and removed."""
+        result = []
+        invalid_keys = []
+        with self._connect() as db:
+            c = db.cursor()
+            c.execute("""SELECT {key}, {sort}, request FROM {table} ORDER BY {sort} ASC""".format(
+                      key=self.KEY_COLUMN, sort=self.SORT_COLUMN, table=self.TABLE))
+            for key, sort_value, obj in c:
+                try:
+                    result.append((sort_value, pickle.loads(obj)))
+                except Exception as e:
+                    logging.error("unable to load {} from {}: {}".format(key, self.TABLE, e))
+                    invalid_keys.append(key)
+
+            for key in invalid_keys:
+                db.execute("""DELETE FROM {} WHERE {} = ?""".format(self.TABLE, self.KEY_COLUMN), (key,))
+
+            db.commit()
+
+        return result
+
+    def count(self):
+        """Returns the number of objects in the store."""
+        with self._connect() as db:
+            c = db.cursor()
+            c.execute("""SELECT COUNT(*) FROM {}""".format(self.TABLE))
+            return c.fetchone()[0]
+
+class DelayedAnalysisStore(SQLiteObjectStore):
+    """Persists DelayedAnalysisRequest objects to a local sqlite database.
+       Requests are saved as they are made (by the process managers) and deleted as they are processed.
+       Anything left in the database when the engine starts is outstanding work that gets loaded back in."""
+
+    TABLE = 'delayed_analysis'
+    SORT_COLUMN = 'next_analysis'
+    SORT_INDEX = 'idx_next_analysis'
+
+    @staticmethod
+    def request_key(request):
+        """Returns the key used to store the given DelayedAnalysisRequest."""
+        # there can only be one outstanding request per root, observable and analysis module
+        return '{}:{}:{}'.format(request.uuid, request.observable_uuid, request.analysis_module)
+
+    def save(self, next_time, request):
+        """Saves (or replaces) the given DelayedAnalysisRequest scheduled for next_time (epoch)."""
+        assert isinstance(request, DelayedAnalysisRequest)
+        self._save(self.request_key(request), next_time, request)
+
+    def delete(self, request):
+        """Removes the given DelayedAnalysisRequest from the store, unless it was replaced by a newer request for the 
+           same root, observable and analysis module (the delayed analysis was delayed again.)"""
+        assert isinstance(request, DelayedAnalysisRequest)
+        self._delete(self.request_key(request), request.next_analysis.timestamp())
+
+    def load(self):
+        """Returns the list of tuple(next_time, DelayedAnalysisRequest) in the order they should run."""
+        return self._load()
+
+class CheckpointedAnalysisRequest(LocalLockableObject):
+    """Encapsulates the state of the analysis of a root that was interrupted (or might be) so that it can be resumed."""
+    def __init__(self, target, work, final_analysis_mode, resume_count=0, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        assert isinstance(target, RootAnalysis)
+
+        self.storage_dir = target.storage_dir
+        self.target_type = type(target) # we end up using this in the analyze() call
+        self.uuid = target.uuid
+        # list of tuple(observable_id, analysis_module config_section or None) left on the work stack
+        self.work = work
+        self.final_analysis_mode = final_analysis_mode
+        # the number of times analysis of this root has been resumed (see Engine.load_analysis_checkpoints)
+        self.resume_count = resume_count
+        # resumed as soon as possible (this is used by the delayed analysis loop)
+        self.next_analysis = datetime.datetime.now()
+
+        # if the target is lockable then we use a "lock proxy" to managing that locking
+        # see lib/saq/lock.py for details
+        self.lock_proxy = None
+        if isinstance(target, LockableObject):
+            self.lock_proxy = target.create_lock_proxy()
+
+    def lock(self):
+        if self.lock_proxy:
+            return self.lock_proxy.lock()
+
+        return super().lock()
+
+    def unlock(self):
+        if self.lock_proxy:
+            return self.lock_proxy.unlock()
+
+        return super().unlock()
+
+    def is_locked(self):
+        if self.lock_proxy:
+            return self.lock_proxy.is_locked()
+
+        return super().is_locked()
+
+    def refresh_lock(self):
+        if self.lock_proxy:
+            return self.lock_proxy.refresh_lock()
+
+        return super().refresh_lock()
+
+    def transfer_locks_to(self, lockable):
+        if self.lock_proxy:
+            self.lock_proxy.transfer_locks_to(lockable)
+            return
+
+        super().transfer_locks_to(lockable)
+
+    def __str__(self):
+        return "CheckpointedAnalysisRequest for {} type {} ({} work items)".format(
+                self.storage_dir, str(self.target_type), len(self.work))
+
+    def __repr__(self):
+        return self.__str__()
+
+    def __lt__(self, other):
+        return False
+
+class AnalysisCheckpointStore(SQLiteObjectStore):
+    """Persists the latest CheckpointedAnalysisRequest of each root being analyzed to a local sqlite database.
+       Anything left in the database when the engine starts is analysis that was interrupted and gets resumed."""
+
+    TABLE = 'analysis_checkpoints'
+    KEY_COLUMN = 'uuid'
+    SORT_COLUMN = 'checkpoint_time'
+
+    def save(self, request):
+        """Saves (or replaces) the checkpoint of the root of the given CheckpointedAnalysisRequest."""
+        assert isinstance(request, CheckpointedAnalysisRequest)
+        self._save(request.uuid, time.time(), request)
+
+    def delete(self, uuid):
+        """Removes the checkpoint of the given root uuid from the store."""
+        self._delete(uuid)
+
+    def load(self):
+        """Returns the list of CheckpointedAnalysisRequest objects in the order they were checkpointed."""
+        return [request for checkpoint_time, request in self._load()]
+
 class SSLNetworkServer(Engine):
     """An Engine that implements an SSL socket to receive work."""
 
@@ -2953,6 +4215,11 @@ class MySQLCollectionEngine(Engine):
                             self.collection_frequency))
             self.collection_frequency = 1
 
+    @property
+    def backpressure_minimum_interval(self):
+        # same reason as above
+        return max(1.0, super().backpressure_minimum_interval)
+
     def initialize_collection(self, *args, **kwargs):
         super().initialize_collection(*args, **kwargs)
 
@@ -2964,38 +4231,92 @@ class MySQLCollectionEngine(Engine):
         except Exception as e:
             logging.critical("unable to initialize sql collection: {}".format(e))
         
+    @property
+    def claimed_work_path(self):
+        """Path to the file that contains the work items claimed from the database but not yet collected."""
+        return os.path.join(self.var_dir, 'claimed_sql_work')
+
+    @property
+    def collection_batch_size(self):
+        """The maximum number of work items claimed from the database at once."""
+        # in single threaded mode the work queue can only hold a single item
+        if saq.SINGLE_THREADED:
+            return 1
+
+        # there is no point in claiming more than what the engine can hold
+        batch_size = self.get_engine_option('getint', 'collection_batch_size', fallback=100)
+        # or more than what analysis is currently keeping up with
+        if self.backpressure is not None:
+            batch_size = min(batch_size, self.backpressure.batch_size)
+
+        return max(1, min(batch_size, self.scheduler_buffer_size + self.ready_queue_size))
+
+    def save_claimed_work(self, paths):
+        """Records the given list of claimed paths so they can be collected again if we don't finish."""
+        if not paths:
+            if os.path.exists(self.claimed_work_path):
+                os.remove(self.claimed_work_path)
+            return
+
+        temp_path = '{}.tmp'.format(self.claimed_work_path)
+        with open(temp_path, 'w') as fp:
+            for path in paths:
+                fp.write('{}\n'.format(path))
+
+        os.rename(temp_path, self.claimed_work_path)
+
+    def load_claimed_work(self):
+        """Returns the list of paths that were claimed but not collected."""
+        if not os.path.exists(self.claimed_work_path):
+            return []
+
+        with open(self.claimed_work_path, 'r') as fp:
+            return [line.rstrip('\n') for line in fp if line.rstrip('\n')]
+
+    def collect_claimed_work(self, paths):
+        """Adds the given claimed paths as work items. Returns True if all of them were added."""
+        for index, path in enumerate(paths):
+            if self.shutdown or self.collection_shutdown:
+                # whatever is left gets collected when we start back up
+                self.save_claimed_work(paths[index:])
+                return False
+
+            logging.debug("got path {}".format(path))
+            self.add_work_item(path)
+
+        self.save_claimed_work([])
+        return True
+
     def collect(self):
-        # get the next thing to do from the local sql database
+        # anything we claimed the last time we ran but did not collect goes first
+        try:
+            claimed_paths = self.load_claimed_work()
+            if claimed_paths:
+                logging.info("collecting {} previously claimed work items".format(len(claimed_paths)))
+                if not self.collect_claimed_work(claimed_paths):
+                    return
+        except Exception as e:
+            logging.error("unable to collect previously claimed work from {}: {}".format(self.claimed_work_path, e))
+            report_exception()
+
+        # get the next batch of things to do from the local sql database
         while not self.collection_shutdown:
             logging.debug("checking for new work from sql database...")
             with get_db_connection(DB_CONFIG) as db:
-                c = db.cursor()
-                c.execute("""SELECT id, path FROM workload WHERE name = %s ORDER BY id ASC LIMIT 1""", 
-                          (self.workload_name,))
-
-                try:
-                    _id, path = c.fetchone()
-                except Exception as e:
-                    if saq.SINGLE_THREADED:
-                        time.sleep(1)
-                        continue
-                    
-                    return
-
-                logging.debug("got path {} id {}".format(path, _id))
+                # we record what we claimed before the claim is committed in case we don't get to it all
+                claimed = claim_sql_work_items(db, self.workload_name, self.collection_batch_size,
+                                               on_claim=lambda rows: self.save_claimed_work([p for i, p in rows]))
 
-                #if not os.path.exists(path):
-                    #logging.error("file {} does not exist".format(path))
-                #else:
-                    ## submit the file for processing
-                self.add_work_item(path)
-
-                # remove it from the database workload
-                c.execute("""DELETE FROM workload WHERE id = %s""", (_id,))
-                if c.rowcount != 1:
-                    logging.error("no rows were deleted when trying to delete rowid {}".format(_id))
+            if not claimed:
+                if saq.SINGLE_THREADED:
+                    time.sleep(1)
+                    continue
+                
+                return
 
-                db.commit()
+            logging.debug("claimed {} work items from {}".format(len(claimed), self.workload_name))
+            if not self.collect_claimed_work([path for _id, path in claimed]):
+                break
         
             # if we're executing in single threaded mode then we only need to submit one thing
             if saq.SINGLE_THREADED:
@@ -29,11 +29,14 @@ from sqlalchemy.sql.expression import and_
 from sqlalchemy.orm.exc import NoResultFound
 
 class AnalysisRequest(ACEAlertLock):
-    def __init__(self, uuid, storage_dir, alert_id, *args, **kwargs):
+    def __init__(self, uuid, storage_dir, alert_id, alert_type=None, priority=None, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.id = alert_id
         self.uuid = uuid
         self.storage_dir = storage_dir
+        # used to select the priority lane this request is scheduled in
+        self.alert_type = alert_type
+        self.priority = priority
 
     def __str__(self):
         return "AnalysisRequest(uuid({}),storage_dir({}),alert_id({}),lock_id({})".format(
@@ -172,7 +175,8 @@ class ACE(SSLNetworkServer):
             # if there is nothing currently assigned then go ahead and assign some
             # (there is some sql trickery in here to do subselect magic in MySQL)
 
-            if assigned_count < self.analysis_pool_size:
+            batch_size = self.collection_batch_size
+            if assigned_count < batch_size:
 
                 sql = """
                 UPDATE 
@@ -192,8 +196,8 @@ class ACE(SSLNetworkServer):
                             w.id DESC
                         LIMIT %s ) as t)"""
 
-                # the number of assigned work should equal the our analysis_pool_size
-                execute_with_retry(c, sql, ( saq.SAQ_NODE, saq.SAQ_NODE, self.analysis_pool_size - assigned_count ), attempts=10)
+                # the number of assigned work should equal the our collection_batch_size
+                execute_with_retry(c, sql, ( saq.SAQ_NODE, saq.SAQ_NODE, batch_size - assigned_count ), attempts=10)
                 db.commit()
 
                 if c.rowcount != -1 and c.rowcount is not None:
@@ -204,13 +208,14 @@ class ACE(SSLNetworkServer):
             # no we'll actually go *get* them, add them to the workload, and remove from the database
             # we go ahead and remove the item from the database *before* we're able to execute the analysis
 
-            sql = "SELECT w.id, a.id, a.uuid, a.storage_dir FROM workload w JOIN alerts a ON w.alert_id = a.id WHERE w.node = %s"
+            sql = """SELECT w.id, a.id, a.uuid, a.storage_dir, a.alert_type, a.priority 
+                     FROM workload w JOIN alerts a ON w.alert_id = a.id WHERE w.node = %s"""
             c.execute(sql, (saq.SAQ_NODE,))
 
             # we'll keep a list of these so we can remove them later
             assigned_workload_ids = [] # of workload_id
 
-            for workload_id, alert_id, uuid, storage_dir in c:
+            for workload_id, alert_id, uuid, storage_dir, alert_type, priority in c:
                 logging.debug("got workload {} alert {} uuid {} storage_dir {}".format(
                               workload_id, alert_id, uuid, storage_dir))
 
@@ -220,7 +225,8 @@ class ACE(SSLNetworkServer):
                     continue
 
                 # add this alert to the workload
-                self.add_work_item(AnalysisRequest(uuid, storage_dir, alert_id))
+                self.add_work_item(AnalysisRequest(uuid, storage_dir, alert_id, alert_type=alert_type, 
+                                                   priority=priority))
                 assigned_workload_ids.append(workload_id)
 
             for workload_id in assigned_workload_ids:
@@ -321,72 +327,41 @@ class ACE(SSLNetworkServer):
             if disposition:
                 self.cancel_analysis()
 
-    def save_delayed_analysis(self):
-        """Called as the engine shuts down to save outstanding delayed analysis requests."""
-
-        # we pickle out the current contents of the queue as a list of tuples(next_time, request)
-        output_data = []
-        while True:
-            try:
-                next_time, request = self.delayed_analysis_queue.get(block=False)
-                output_data.append((next_time, request))
-            except Empty:
-                # exit and return to loop to check shutdown status
-                break
-
-        # also take a look at the ready queue, might be one there too
-        try:
-            request = self.ready_queue.get(block=False)
-            if isinstance(request, DelayedAnalysisRequest):
-                output_data.append((datetime.datetime.now().timestamp(), request))
-        except Empty:
-            pass
-
-        if not len(output_data):
-            return
-
-        logging.info("saving {} delayed analysis requests".format(len(output_data)))
-        try:
-            with open(self.delayed_analysis_path, 'wb') as fp:
-                pickle.dump(output_data, fp)
-        except Exception as e:
-            logging.error("unable to save delayed analysis requests: {}".format(e))
-            report_exception()
-            try:
-                os.remove(self.delayed_analysis_path)
-            except:
-                pass
-
     def load_delayed_analysis(self):
         """Called as the engine starts up to load saved delayed analysis requests."""
 
-        if not os.path.exists(self.delayed_analysis_path):
-            return
-
-        with open(self.delayed_analysis_path, 'rb') as fp:
-            input_data = pickle.load(fp)
+        # older versions of the engine pickled the delayed analysis queue to disk at shutdown
+        # if we find one of these then we move those requests into the delayed analysis store
+        if not self.delayed_analysis_loaded and os.path.exists(self.delayed_analysis_path):
+            try:
+                with open(self.delayed_analysis_path, 'rb') as fp:
+                    input_data = pickle.load(fp)
 
-        for next_time, request in input_data:
-            # make sure these are unlocked as they go into the queues
-            if request.is_locked():
-                request.unlock()
+                for next_time, request in input_data:
+                    self.delayed_analysis_store.save(next_time, request)
 
-            self.delayed_analysis_queue.put((next_time, request), block=False)
+                logging.info("migrated {} delayed analysis requests from {}".format(
+                             len(input_data), self.delayed_analysis_path))
 
-        logging.info("loaded {} outstanding delayed analysis requests".format(self.delayed_analysis_queue.qsize()))
+            except Exception as e:
+                # keep the file around so the requests can be recovered manually
+                failed_path = '{}.failed'.format(self.delayed_analysis_path)
+                logging.error("unable to migrate delayed analysis requests from {} (moved to {}): {}".format(
+                              self.delayed_analysis_path, failed_path, e))
+                report_exception()
 
-        try:
-            os.remove(self.delayed_analysis_path)
-        except:
-            pass
+                try:
+                    os.rename(self.delayed_analysis_path, failed_path)
+                except Exception as e:
+                    logging.error("unable to rename {} to {}: {}".format(self.delayed_analysis_path, failed_path, e))
 
-    def initialize_delayed_analysis(self):
-        super().initialize_delayed_analysis()
-        self.load_delayed_analysis()
+            else:
+                try:
+                    os.remove(self.delayed_analysis_path)
+                except Exception as e:
+                    logging.error("unable to delete {}: {}".format(self.delayed_analysis_path, e))
 
-    def cleanup_delayed_analysis(self):
-        super().cleanup_delayed_analysis()
-        self.save_delayed_analysis()
+        super().load_delayed_analysis()
 
     def initialize_collection(self):
         super().initialize_collection()
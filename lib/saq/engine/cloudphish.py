@@ -78,7 +78,7 @@ class CloudPhishEngine(Engine):
             # go ahead and allocate a batch of URLs to process
             c.execute("""UPDATE workload SET node = %s WHERE sha256_url IN ( SELECT sha256_url FROM ( 
                        SELECT sha256_url FROM workload 
-                       WHERE node IS NULL OR node = %s ORDER BY node, insert_date ASC LIMIT {}) as t)""".format(self.analysis_pool_size), 
+                       WHERE node IS NULL OR node = %s ORDER BY node, insert_date ASC LIMIT {}) as t)""".format(self.collection_batch_size), 
                        ( self.node, self.node ))
             db.commit()
 
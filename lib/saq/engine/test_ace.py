@@ -78,8 +78,8 @@ class ACECoreEngineTestCase(ACEEngineTestCase):
     def test_ace_engine_002_persistent_engine(self):
 
         engine = CustomACEEngine()
-        if os.path.exists(engine.delayed_analysis_path):
-            os.remove(engine.delayed_analysis_path)
+        if os.path.exists(engine.delayed_analysis_store.path):
+            os.remove(engine.delayed_analysis_store.path)
 
         engine.enable_module('analysis_module_test_delayed_analysis')
         self.start_engine(engine)
@@ -99,9 +99,8 @@ class ACECoreEngineTestCase(ACEEngineTestCase):
         self.assertTrue(self.wait_for_condition(callback))
         self.kill_engine(engine)
         
-        self.assertTrue(os.path.exists(engine.delayed_analysis_path))
-        with open(engine.delayed_analysis_path, 'rb') as fp:
-            delayed_analysis = pickle.load(fp)
+        # the outstanding requests are still in the delayed analysis store
+        delayed_analysis = engine.delayed_analysis_store.load()
 
         if len(delayed_analysis) > 1:
             for item in delayed_analysis:
@@ -144,15 +143,15 @@ class ACECoreEngineTestCase(ACEEngineTestCase):
         self.assertEquals(analysis.request_count, 2)
         self.assertTrue(analysis.completed)
 
-        self.assertFalse(os.path.exists(engine.delayed_analysis_path))
+        self.assertEquals(engine.delayed_analysis_store.count(), 0)
 
     @cleanup_delayed_analysis
     def test_ace_engine_003_persistent_engine_multiple(self):
-        """Multiple delayed analysis requests are saved at shutdown and reloaded at startup."""
+        """Multiple delayed analysis requests are persisted and reloaded at startup."""
 
         engine = CustomACEEngine()
-        if os.path.exists(engine.delayed_analysis_path):
-            os.remove(engine.delayed_analysis_path)
+        if os.path.exists(engine.delayed_analysis_store.path):
+            os.remove(engine.delayed_analysis_store.path)
 
         tracking = {}  # key = storage_dir, value = observable uuid
 
@@ -176,9 +175,8 @@ class ACECoreEngineTestCase(ACEEngineTestCase):
 
         self.kill_engine(engine)
         
-        self.assertTrue(os.path.exists(engine.delayed_analysis_path))
-        with open(engine.delayed_analysis_path, 'rb') as fp:
-            delayed_analysis = pickle.load(fp)
+        # the outstanding requests are still in the delayed analysis store
+        delayed_analysis = engine.delayed_analysis_store.load()
 
         self.assertEquals(len(delayed_analysis), 3)
 
@@ -211,4 +209,4 @@ class ACECoreEngineTestCase(ACEEngineTestCase):
             self.assertEquals(analysis.request_count, 2)
             self.assertTrue(analysis.completed)
 
-        self.assertFalse(os.path.exists(engine.delayed_analysis_path))
+        self.assertEquals(engine.delayed_analysis_store.count(), 0)
@@ -1,5 +1,6 @@
 # vim: sw=4:ts=4:et
 
+import csv
 import logging
 import os, os.path
 import pickle
@@ -18,7 +19,8 @@ from saq.anp import *
 from saq.analysis import RootAnalysis, _get_io_read_count, _get_io_write_count, Observable
 from saq.constants import *
 from saq.database import get_db_connection
-from saq.engine import Engine, DelayedAnalysisRequest, SSLNetworkServer, MySQLCollectionEngine, ANPNodeEngine
+from saq.engine import Engine, DelayedAnalysisRequest, SSLNetworkServer, MySQLCollectionEngine, ANPNodeEngine, \
+                       CheckpointedAnalysisRequest
 from saq.lock import LocalLockableObject
 from saq.network_client import submit_alerts
 from saq.observables import create_observable
@@ -146,6 +148,9 @@ class MySQLEngine(MySQLCollectionEngine, AnalysisEngine):
             c.execute("""DELETE FROM workload""") 
             db.commit()
 
+        if os.path.exists(self.claimed_work_path):
+            os.remove(self.claimed_work_path)
+
 class ANPEnabledEngine(ANPNodeEngine, AnalysisEngine):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -1188,10 +1193,17 @@ class EngineTestCase(ACEEngineTestCase):
         # this should have a single stats file in it
         stats_files = os.listdir(os.path.join(os.path.join(saq.MODULE_STATS_DIR, 'unittest', subdir)))
         self.assertEquals(len(stats_files), 1)
+        self.assertEquals(stats_files[0], 'module_timings.csv')
+
+        # and it should have the timing of the module we ran
+        with open(os.path.join(saq.MODULE_STATS_DIR, 'unittest', subdir, stats_files[0]), 'r') as fp:
+            rows = [row for row in csv.DictReader(fp)]
 
-        # and it should not be empty
-        self.assertGreater(os.path.getsize(os.path.join(os.path.join(saq.MODULE_STATS_DIR, 'unittest', 
-                                                                     subdir, stats_files[0]))), 0)
+        self.assertEquals(len(rows), 1)
+        self.assertEquals(rows[0]['engine'], 'unittest')
+        self.assertEquals(rows[0]['module'], 'analysis_module_basic_test')
+        self.assertEquals(rows[0]['observable_type'], F_TEST)
+        self.assertGreaterEqual(int(rows[0]['count']), 1)
 
     def test_engine_040_exclusion(self):
         
@@ -1512,3 +1524,270 @@ class EngineTestCase(ACEEngineTestCase):
 
         self.assertTrue(control_event.wait(5))
         server.stop()
+
+    @cleanup_delayed_analysis
+    def test_engine_047_delayed_analysis_store(self):
+        engine = AnalysisEngine()
+        engine.initialize()
+        self.assertTrue(os.path.exists(engine.delayed_analysis_store.path))
+        self.assertEquals(engine.delayed_analysis_store.count(), 0)
+
+        root = create_root_analysis(uuid=str(uuid.uuid4()))
+        root.initialize_storage()
+        observable = root.add_observable(F_TEST, 'test_1')
+        root.save()
+
+        import datetime
+        next_analysis = datetime.datetime.now() + datetime.timedelta(seconds=10)
+        request = DelayedAnalysisRequest(root, observable.id, 'analysis_module_test_delayed_analysis', next_analysis)
+        engine.delayed_analysis_store.save(next_analysis.timestamp(), request)
+        # saving the same request again replaces it
+        engine.delayed_analysis_store.save(next_analysis.timestamp(), request)
+        self.assertEquals(engine.delayed_analysis_store.count(), 1)
+
+        # a new engine (as if after a crash) loads the outstanding request
+        engine = AnalysisEngine()
+        engine.load_delayed_analysis()
+        self.assertEquals(engine.delayed_analysis_queue.qsize(), 1)
+        next_time, loaded_request = engine.delayed_analysis_queue.get_nowait()
+        self.assertEquals(next_time, next_analysis.timestamp())
+        self.assertEquals(loaded_request.storage_dir, root.storage_dir)
+        self.assertEquals(loaded_request.observable_uuid, observable.id)
+        self.assertEquals(loaded_request.next_analysis, next_analysis)
+
+        # requests are only loaded once per engine
+        engine.load_delayed_analysis()
+        self.assertEquals(engine.delayed_analysis_queue.qsize(), 0)
+
+        # a request that was delayed again is not deleted by the request it replaced
+        next_analysis = next_analysis + datetime.timedelta(seconds=10)
+        new_request = DelayedAnalysisRequest(root, observable.id, 'analysis_module_test_delayed_analysis', 
+                                             next_analysis)
+        engine.delayed_analysis_store.save(next_analysis.timestamp(), new_request)
+        engine.delayed_analysis_store.delete(loaded_request)
+        self.assertEquals(engine.delayed_analysis_store.count(), 1)
+
+        engine.delayed_analysis_store.delete(new_request)
+        self.assertEquals(engine.delayed_analysis_store.count(), 0)
+
+    def test_engine_048_module_dispatch_index(self):
+        engine = AnalysisEngine()
+        engine.enable_module('analysis_module_basic_test')
+        engine.initialize_modules()
+
+        from saq.modules.test import BasicTestAnalyzer
+        self.assertEquals(len(engine.analysis_modules), 1)
+        self.assertTrue(isinstance(engine.analysis_modules[0], BasicTestAnalyzer))
+        self.assertEquals(engine.module_dispatch_count, 1)
+
+        # the basic test module only accepts F_TEST observables
+        self.assertEquals(engine.get_dispatch_modules(create_observable(F_TEST, 'test_1')), engine.analysis_modules)
+        self.assertEquals(engine.get_dispatch_modules(create_observable(F_IPV4, '1.2.3.4')), [])
+
+    def test_engine_049_mysql_engine_claimed_work(self):
+        class _custom_engine(MySQLEngine):
+            def process(self, work_item):
+                if isinstance(work_item, TerminatingMarker):
+                    return AnalysisEngine.process(self, work_item)
+
+                root = RootAnalysis(storage_dir=work_item)
+                root.load()
+                send_test_message(root.details)
+
+        engine = _custom_engine()
+        engine.reset()
+
+        roots = []
+        for i in range(3):
+            root = create_root_analysis(uuid=str(uuid.uuid4()))
+            root.details = 'test{}'.format(i)
+            root.save()
+            roots.append(root)
+
+        # work that was claimed from the database (as if before a crash) but never collected
+        if not os.path.isdir(engine.var_dir):
+            os.makedirs(engine.var_dir)
+
+        engine.save_claimed_work([root.storage_dir for root in roots[:2]])
+        self.assertEquals(engine.load_claimed_work(), [root.storage_dir for root in roots[:2]])
+
+        self.start_engine(engine)
+        engine.add_sql_work_item(roots[2].storage_dir)
+
+        messages = [recv_test_message() for _ in roots]
+        self.assertEquals(sorted(messages), sorted([root.details for root in roots]))
+        self.assertFalse(os.path.exists(engine.claimed_work_path))
+        
+        engine.queue_work_item(TerminatingMarker())
+        self.wait_engine(engine)
+
+    def test_engine_050_module_result_cache(self):
+        engine = AnalysisEngine()
+        engine.enable_module('analysis_module_cache_test')
+        for path in [ engine.module_result_cache.path, engine.module_result_cache.path + '-wal', 
+                      engine.module_result_cache.path + '-shm' ]:
+            if os.path.exists(path):
+                os.remove(path)
+
+        self.start_engine(engine)
+
+        roots = []
+        for i in range(2):
+            root = create_root_analysis(uuid=str(uuid.uuid4()))
+            root.initialize_storage()
+            observable = root.add_observable(F_TEST, 'test_cache')
+            # the module adds this tag again, which the cached result still has to include
+            # and the child it adds already has a tag in this root that the cached result must not include
+            if i == 0:
+                observable.add_tag('cached_tag')
+                root.add_observable(F_TEST, 'cached_observable').add_tag('uncached_tag')
+
+            root.save()
+            roots.append(root)
+
+        # the second root is analyzed after the first so it uses the cached result
+        engine.queue_work_item(roots[0].storage_dir)
+        engine.queue_work_item(roots[1].storage_dir)
+        engine.queue_work_item(TerminatingMarker())
+        self.wait_engine(engine)
+
+        from saq.modules.test import CacheTestAnalysis
+
+        results = []
+        children = []
+        for root in roots:
+            root = create_root_analysis(storage_dir=root.storage_dir)
+            root.load()
+            observable = root.get_observable_by_spec(F_TEST, 'test_cache')
+            self.assertTrue(observable.has_tag('cached_tag'))
+            analysis = observable.get_analysis(CacheTestAnalysis)
+            self.assertIsNotNone(analysis)
+            self.assertEquals(len(analysis.observables), 1)
+            self.assertEquals(analysis.observables[0].value, 'cached_observable')
+            self.assertTrue(analysis.observables[0].has_tag('cached_child_tag'))
+            children.append(analysis.observables[0])
+            results.append(analysis.test_result)
+
+        self.assertIsNotNone(results[0])
+        self.assertEquals(results[0], results[1])
+        # the tag the child had in the first root was not cached
+        self.assertTrue(children[0].has_tag('uncached_tag'))
+        self.assertFalse(children[1].has_tag('uncached_tag'))
+
+    @reset_config
+    def test_engine_051_buffered_analysis_log(self):
+        saq.CONFIG['global']['analysis_log_buffer_size'] = '100'
+        saq.CONFIG['global']['analysis_log_flush_level'] = 'WARNING'
+        saq.CONFIG['global']['analysis_log_sample_rate'] = '0.0'
+
+        def _analyze(value):
+            engine = AnalysisEngine()
+            engine.enable_module('analysis_module_basic_test')
+            self.start_engine(engine)
+
+            root = create_root_analysis(uuid=str(uuid.uuid4()))
+            root.initialize_storage()
+            root.add_observable(F_TEST, value)
+            root.save()
+            engine.queue_work_item(root.storage_dir)
+            engine.queue_work_item(TerminatingMarker())
+            self.wait_engine(engine)
+            return root
+
+        # nothing went wrong so the buffered log was discarded
+        root = _analyze('test_1')
+        self.assertFalse(os.path.exists(os.path.join(root.storage_dir, 'saq.log')))
+
+        # test_3 does not return a boolean value which logs a warning
+        root = _analyze('test_3')
+        self.assertTrue(os.path.exists(os.path.join(root.storage_dir, 'saq.log')))
+
+        # analysis that fails writes the log before the root is copied into error_reports
+        saq.CONFIG['global']['maximum_cumulative_analysis_fail_time'] = '0'
+        error_reports_dir = os.path.join(saq.SAQ_HOME, 'error_reports')
+        existing_reports = set(os.listdir(error_reports_dir)) if os.path.isdir(error_reports_dir) else set()
+        root = _analyze('test_3')
+        self.assertTrue(os.path.exists(os.path.join(root.storage_dir, 'saq.log')))
+
+        new_reports = [os.path.join(error_reports_dir, _) for _ in os.listdir(error_reports_dir)
+                       if _ not in existing_reports]
+        report_dirs = [_ for _ in new_reports if os.path.isdir(_)]
+        self.assertEquals(len(report_dirs), 1)
+        self.assertTrue(os.path.exists(os.path.join(report_dirs[0], 'saq.log')))
+
+        for path in new_reports:
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
+
+    @cleanup_delayed_analysis
+    def test_engine_052_resume_analysis_checkpoint(self):
+        engine = AnalysisEngine()
+        engine.initialize()
+
+        root = create_root_analysis(uuid=str(uuid.uuid4()))
+        root.initialize_storage()
+        observable = root.add_observable(F_TEST, 'test_1')
+        root.save()
+
+        # every time analysis is resumed counts toward analysis_checkpoint_max_resume
+        request = CheckpointedAnalysisRequest(root, [ (observable.id, None) ], False)
+        for i in range(engine.analysis_checkpoint_max_resume):
+            self.assertTrue(engine.count_analysis_resume(request))
+
+        self.assertEquals(request.resume_count, engine.analysis_checkpoint_max_resume)
+        self.assertFalse(engine.count_analysis_resume(request))
+        self.assertEquals(len(engine.analysis_checkpoint_store.load()), 0)
+
+        # as if the engine was stopped right before analyzing the observable
+        engine.analysis_checkpoint_store.save(CheckpointedAnalysisRequest(root, [ (observable.id, None) ], False))
+        self.assertEquals(len(engine.analysis_checkpoint_store.load()), 1)
+
+        engine = AnalysisEngine()
+        engine.enable_module('analysis_module_basic_test')
+        self.start_engine(engine)
+        engine.queue_work_item(TerminatingMarker())
+        self.wait_engine(engine)
+
+        from saq.modules.test import BasicTestAnalysis
+
+        root = create_root_analysis(storage_dir=root.storage_dir)
+        root.load()
+        observable = root.get_observable(observable.id)
+        self.assertIsNotNone(observable.get_analysis(BasicTestAnalysis))
+
+        # the checkpoint is deleted once analysis completes
+        self.assertEquals(len(engine.analysis_checkpoint_store.load()), 0)
+
+    def test_engine_053_memory_budget(self):
+        # everything is over budget
+        saq.CONFIG['global']['process_manager_memory_budget'] = '1'
+        saq.CONFIG['global']['memory_check_frequency'] = '0'
+        engine = AnalysisEngine()
+        engine.enable_module('analysis_module_basic_test')
+        self.start_engine(engine)
+
+        root = create_root_analysis(uuid=str(uuid.uuid4()))
+        root.initialize_storage()
+        observable = root.add_observable(F_TEST, 'test_1')
+        root.save()
+        engine.queue_work_item(root.storage_dir)
+        engine.queue_work_item(TerminatingMarker())
+        self.wait_engine(engine)
+
+        from saq.modules.test import BasicTestAnalysis
+
+        root = create_root_analysis(storage_dir=root.storage_dir)
+        root.load()
+        self.assertIsNotNone(root.get_observable(observable.id).get_analysis(BasicTestAnalysis))
+
+        # the high-water mark of the root was recorded
+        import csv, datetime
+        path = os.path.join(engine.stats_dir, datetime.datetime.now().strftime('%Y%m%d'), 'root_memory.csv')
+        self.assertTrue(os.path.exists(path))
+        with open(path, 'r') as fp:
+            rows = [row for row in csv.DictReader(fp) if row['uuid'] == root.uuid]
+
+        self.assertEquals(len(rows), 1)
+        self.assertTrue(int(rows[0]['high_water_rss']) >= int(rows[0]['start_rss']))
@@ -0,0 +1,102 @@
+# vim: sw=4:ts=4:et:cc=120
+#
+# observable exclusion matching
+#
+
+import bisect
+import logging
+
+from saq.analysis import Observable
+from saq.constants import F_IPV4
+
+import iptools
+
+class ObservableExclusions(dict):
+    """A dict of observable type to the list of excluded values that also maintains compiled lookup tables.
+
+       The matching follows Observable.matches: values must match exactly, except for F_IPV4 which can also be
+       excluded with CIDR notation. Exact values are kept in a set and CIDR ranges are merged into a sorted list of
+       non-overlapping intervals, so checking an observable is a hash lookup plus a binary search."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._exact = {} # key = o_type, value = set() of o_value
+        self._ranges = [] # of tuple(start, end) of the F_IPV4 CIDR exclusions
+        self._range_starts = None # sorted starting addresses of the merged ranges (None when needs compiling)
+        self._range_ends = None # matching ending addresses
+
+    def add(self, o_type, o_value):
+        """Adds the given exclusion. Returns True if it was added, False if it already existed."""
+        if o_type in self._exact and o_value in self._exact[o_type]:
+            return False
+
+        if o_type not in self:
+            self[o_type] = []
+            self._exact[o_type] = set()
+
+        self[o_type].append(o_value)
+        self._exact[o_type].add(o_value)
+
+        if o_type == F_IPV4 and '/' in o_value:
+            try:
+                ip_range = iptools.IpRange(o_value)
+                self._ranges.append((ip_range.startIp, ip_range.endIp))
+                self._range_starts = None
+            except Exception as e:
+                logging.error("invalid ipv4 exclusion {}: {}".format(o_value, e))
+
+        return True
+
+    def compile(self):
+        """Merges the CIDR ranges into sorted non-overlapping intervals. Called automatically as needed."""
+        starts = []
+        ends = []
+        for start, end in sorted(self._ranges):
+            if ends and start <= ends[-1] + 1:
+                ends[-1] = max(ends[-1], end)
+            else:
+                starts.append(start)
+                ends.append(end)
+
+        self._range_starts = starts
+        self._range_ends = ends
+
+    def matches(self, o_type, o_value):
+        """Returns True if the given observable type and value is excluded."""
+        try:
+            if o_value in self._exact[o_type]:
+                return True
+        except KeyError:
+            return False
+        except TypeError:
+            # unhashable value
+            return o_value in self[o_type]
+
+        if o_type != F_IPV4 or not self._ranges:
+            return False
+
+        if self._range_starts is None:
+            self.compile()
+
+        address = iptools.ipv4.ip2long(o_value) if isinstance(o_value, str) else None
+        if address is None:
+            logging.debug("{} probably is not an IP address".format(o_value))
+            return False
+
+        index = bisect.bisect_right(self._range_starts, address) - 1
+        return index >= 0 and address <= self._range_ends[index]
+
+    def is_excluded(self, observable):
+        """Returns True if the given Observable is excluded."""
+        if observable.type not in self:
+            return False
+
+        # observables that provide their own matching logic have to be checked one at a time
+        if observable.type != F_IPV4 and type(observable).matches is not Observable.matches:
+            for exclusion_value in self[observable.type]:
+                if observable.matches(exclusion_value):
+                    return True
+
+            return False
+
+        return self.matches(observable.type, observable.value)
@@ -1,5 +1,6 @@
 # vim: sw=4:ts=4:et:cc=120
 
+import ctypes
 import datetime
 import logging
 import os
@@ -7,13 +8,16 @@ import os.path
 import time
 import uuid
 import multiprocessing
+import zlib
 
 import saq
 from saq.error import report_exception, report_condition
 
-local_lock_manager = None
-local_lock_sync = None
-local_lock_ids = None
+# the backend that stores the local locks (see initialize_locking)
+local_lock_table = None
+
+LOCAL_LOCK_BACKEND_MANAGER = 'manager'
+LOCAL_LOCK_BACKEND_SHARED_MEMORY = 'shared_memory'
 
 def lock_expired(lock_time):
     """Utility function to return True if the given lock_time has expired."""
@@ -22,39 +26,275 @@ def lock_expired(lock_time):
     minutes, seconds = map(int, saq.CONFIG['global']['lock_timeout'].split(':'))
     return elapsed_time >= (minutes * 60) + seconds
 
+class ManagerLockTable(object):
+    """Stores local locks in a multiprocessing.Manager().dict() protected by a single manager RLock.
+       Every operation is an IPC round trip to the manager process."""
+
+    def __init__(self):
+        self.manager = multiprocessing.Manager()
+        self._sync = self.manager.RLock()
+        # key = uuid, value = tuple(custom uuid, datetime.datetime.now().timestamp)
+        self.lock_ids = self.manager.dict()
+
+    def sync(self, key):
+        return self._sync
+
+    def __getitem__(self, key):
+        return self.lock_ids[key]
+
+    def __setitem__(self, key, value):
+        self.lock_ids[key] = value
+
+    def __delitem__(self, key):
+        del self.lock_ids[key]
+
+    def clear(self):
+        with self._sync:
+            self.lock_ids = self.manager.dict()
+
+    def cleanup(self):
+        # in the case where processes die and locks have expired with no chance
+        # of anything ever locking it again, we just need to keep from having a memory leak here
+        with self._sync:
+            expired_lock_ids = []
+            for lock_uuid in self.lock_ids.keys():
+                lock_id, lock_time = self.lock_ids[lock_uuid]
+                if lock_expired(datetime.datetime.fromtimestamp(lock_time)):
+                    logging.warning("detected expired lock {}".format(lock_id))
+                    expired_lock_ids.append(lock_uuid)
+
+            for lock_uuid in expired_lock_ids:
+                del self.lock_ids[lock_uuid]
+
+    def shutdown(self):
+        self.manager.shutdown()
+
+class _LockEntry(ctypes.Structure):
+    _fields_ = [ ('key', ctypes.c_char * 64),
+                 ('lock_id', ctypes.c_char * 64),
+                 ('lock_time', ctypes.c_double) ]
+
+class _StripeSync(object):
+    """Context manager for the multiprocessing.Lock that protects a single stripe of the SharedMemoryLockTable."""
+    def __init__(self, lock, timeout):
+        self.lock = lock
+        self.timeout = timeout
+
+    def __enter__(self):
+        # a process killed while holding this lock would otherwise block everyone forever
+        if not self.lock.acquire(timeout=self.timeout):
+            raise RuntimeError("unable to acquire local lock table stripe after {} seconds".format(self.timeout))
+        return self
+
+    def __exit__(self, *args):
+        self.lock.release()
+
+class SharedMemoryLockTable(object):
+    """Stores local locks in a fixed size hash table in shared memory.
+
+       The table is split into stripes, each with its own multiprocessing.Lock, so processes working on different
+       uuids do not contend with each other. Each stripe is an open addressing (linear probing) hash table.
+       This must be created before the processes that use it are forked."""
+
+    def __init__(self, table_size, stripe_count, sync_timeout=30):
+        assert table_size > 0
+        assert stripe_count > 0
+        self.stripe_count = stripe_count
+        self.stripe_size = max(1, table_size // stripe_count)
+        self.sync_timeout = sync_timeout
+        self.entries = multiprocessing.RawArray(_LockEntry, self.stripe_size * self.stripe_count)
+        self.counts = multiprocessing.RawArray(ctypes.c_int, self.stripe_count)
+        self.stripe_syncs = [_StripeSync(multiprocessing.Lock(), sync_timeout) for _ in range(self.stripe_count)]
+
+    def _hash(self, key):
+        return zlib.crc32(key)
+
+    def _encode(self, key):
+        result = key.encode('utf8')
+        if len(result) >= _LockEntry.key.size:
+            raise ValueError("lock key {} is too long".format(key))
+        return result
+
+    def _stripe(self, key):
+        return self._hash(key) % self.stripe_count
+
+    def sync(self, key):
+        return self.stripe_syncs[self._stripe(self._encode(key))]
+
+    def _find(self, key):
+        """Returns tuple(stripe, index of the entry for key or the empty slot where key would go, found)."""
+        h = self._hash(key)
+        stripe = h % self.stripe_count
+        base = stripe * self.stripe_size
+        home = (h // self.stripe_count) % self.stripe_size
+        for i in range(self.stripe_size):
+            index = base + ((home + i) % self.stripe_size)
+            entry_key = self.entries[index].key
+            if not entry_key:
+                return stripe, index, False
+            if entry_key == key:
+                return stripe, index, True
+
+        # the stripe is full
+        return stripe, None, False
+
+    def __getitem__(self, key):
+        stripe, index, found = self._find(self._encode(key))
+        if not found:
+            raise KeyError(key)
+
+        entry = self.entries[index]
+        return entry.lock_id.decode('utf8'), entry.lock_time
+
+    def __setitem__(self, key, value):
+        _key = self._encode(key)
+        lock_id, lock_time = value
+        stripe, index, found = self._find(_key)
+        if not found:
+            # keep the probe sequences short by removing expired locks when the stripe gets crowded
+            if self.counts[stripe] >= (self.stripe_size * 3) // 4:
+                self._sweep(stripe)
+                stripe, index, found = self._find(_key)
+
+            if index is None:
+                raise RuntimeError("local lock table is full (increase local_lock_table_size)")
+
+            self.counts[stripe] += 1
+
+        entry = self.entries[index]
+        entry.key = _key
+        entry.lock_id = lock_id.encode('utf8')
+        entry.lock_time = lock_time
+
+    def __delitem__(self, key):
+        stripe, index, found = self._find(self._encode(key))
+        if not found:
+            raise KeyError(key)
+
+        self._delete_index(stripe, index)
+
+    def _delete_index(self, stripe, index):
+        # standard deletion for linear probing: shift back any entries in the same cluster
+        # that would no longer be reachable from their home slot
+        base = stripe * self.stripe_size
+        i = index - base
+        j = i
+        while True:
+            j = (j + 1) % self.stripe_size
+            entry = self.entries[base + j]
+            if not entry.key:
+                break
+
+            home = (self._hash(entry.key) // self.stripe_count) % self.stripe_size
+            # is the home slot cyclically in (i, j]? if so then this entry stays where it is
+            if i <= j:
+                if i < home <= j:
+                    continue
+            elif home > i or home <= j:
+                continue
+
+            target = self.entries[base + i]
+            target.key = entry.key
+            target.lock_id = entry.lock_id
+            target.lock_time = entry.lock_time
+            i = j
+
+        ctypes.memset(ctypes.addressof(self.entries[base + i]), 0, ctypes.sizeof(_LockEntry))
+        self.counts[stripe] -= 1
+
+    def _sweep(self, stripe):
+        """Removes all expired locks from the given stripe. Caller must hold the stripe lock."""
+        base = stripe * self.stripe_size
+        live = []
+        for index in range(base, base + self.stripe_size):
+            entry = self.entries[index]
+            if not entry.key:
+                continue
+
+            if lock_expired(datetime.datetime.fromtimestamp(entry.lock_time)):
+                logging.warning("detected expired lock {}".format(entry.lock_id.decode('utf8')))
+                continue
+
+            live.append((entry.key, entry.lock_id, entry.lock_time))
+
+        if len(live) == self.counts[stripe]:
+            return
+
+        ctypes.memset(ctypes.addressof(self.entries[base]), 0, ctypes.sizeof(_LockEntry) * self.stripe_size)
+        self.counts[stripe] = 0
+        for key, lock_id, lock_time in live:
+            stripe, index, found = self._find(key)
+            entry = self.entries[index]
+            entry.key = key
+            entry.lock_id = lock_id
+            entry.lock_time = lock_time
+            self.counts[stripe] += 1
+
+    def clear(self):
+        for stripe in range(self.stripe_count):
+            with self.stripe_syncs[stripe]:
+                base = stripe * self.stripe_size
+                ctypes.memset(ctypes.addressof(self.entries[base]), 0, ctypes.sizeof(_LockEntry) * self.stripe_size)
+                self.counts[stripe] = 0
+
+    def cleanup(self):
+        # expired locks are removed from a stripe when it starts to fill up (see __setitem__)
+        pass
+
+    def shutdown(self):
+        pass
+
 def _atexit_callback():
-    if local_lock_manager:
+    if local_lock_table:
         try:
-            logging.info("shutting down local lock manager...")
-            local_lock_manager.shutdown()
-            logging.info("shut down local lock manager")
+            logging.info("shutting down local lock table...")
+            local_lock_table.shutdown()
+            logging.info("shut down local lock table")
         except Exception as e:
-            logging.error("unable to shutdown local lock manager: {}".format(e))
+            logging.error("unable to shutdown local lock table: {}".format(e))
             report_exception()
 
-def initialize_locking():
+def create_local_lock_table(backend=None):
+    """Returns a new local lock table for the given backend (defaults to the local_lock_backend config option.)"""
+    if backend is None:
+        backend = saq.CONFIG['global'].get('local_lock_backend', fallback=LOCAL_LOCK_BACKEND_SHARED_MEMORY)
+
+    if backend == LOCAL_LOCK_BACKEND_MANAGER:
+        return ManagerLockTable()
+    elif backend == LOCAL_LOCK_BACKEND_SHARED_MEMORY:
+        return SharedMemoryLockTable(saq.CONFIG['global'].getint('local_lock_table_size', fallback=65536),
+                                     saq.CONFIG['global'].getint('local_lock_table_stripes', fallback=64))
+    else:
+        raise ValueError("invalid local_lock_backend {}".format(backend))
+
+def initialize_locking(backend=None):
     import atexit
 
-    global local_lock_manager
-    global local_lock_sync
-    global local_lock_ids
+    global local_lock_table
 
     logging.info("initializing locking")
 
     # have we already initialized locking?
-    if local_lock_manager is not None:
+    if local_lock_table is not None and (backend is None or backend == local_lock_table_backend()):
         # then just clear out any existing lock ids
-        with local_lock_sync:
-            local_lock_ids = local_lock_manager.dict()
-
+        local_lock_table.clear()
         return
 
-    local_lock_manager = multiprocessing.Manager()
-    local_lock_sync = local_lock_manager.RLock()
-    # key = uuid, value = tuple(custom uuid, datetime.datetime.now().timestamp)
-    local_lock_ids = local_lock_manager.dict()
+    if local_lock_table is None:
+        atexit.register(_atexit_callback)
+    else:
+        local_lock_table.shutdown()
+
+    local_lock_table = create_local_lock_table(backend)
 
-    atexit.register(_atexit_callback)
+def local_lock_table_backend():
+    """Returns the name of the backend currently used for local locking."""
+    if isinstance(local_lock_table, ManagerLockTable):
+        return LOCAL_LOCK_BACKEND_MANAGER
+    elif isinstance(local_lock_table, SharedMemoryLockTable):
+        return LOCAL_LOCK_BACKEND_SHARED_MEMORY
+
+    return None
 
 class LockableObject(object):
     """Base interface for the LockableObject."""
@@ -119,10 +359,10 @@ class LocalLockableObject(LockableObject):
         existing_lock_id = None
         existing_lock_time = None
 
-        with local_lock_sync:
+        with local_lock_table.sync(self.uuid):
             try:
                 # get the existing lock
-                existing_lock_id, existing_lock_time = local_lock_ids[self.uuid]
+                existing_lock_id, existing_lock_time = local_lock_table[self.uuid]
                 existing_lock_time = datetime.datetime.fromtimestamp(existing_lock_time)
 
                 # if a lock exists, check to see if it has timed out
@@ -138,7 +378,7 @@ class LocalLockableObject(LockableObject):
             if not existing_lock_id:
                 # no lock exists (or has expired) so we lock it now
                 self.lock_uuid = str(uuid.uuid4())
-                local_lock_ids[self.uuid] = (self.lock_uuid, datetime.datetime.now().timestamp())
+                local_lock_table[self.uuid] = (self.lock_uuid, datetime.datetime.now().timestamp())
                 logging.debug("obtained local lock id {} for {}".format(self.lock_uuid, self.uuid))
                 return True
 
@@ -158,10 +398,10 @@ class LocalLockableObject(LockableObject):
             logging.error("called unlock() on {} when uuid was None or empty".format(self))
             return False
 
-        with local_lock_sync:
+        with local_lock_table.sync(self.uuid):
             # do we still own the lock?
             try:
-                existing_lock_id, existing_lock_time = local_lock_ids[self.uuid]
+                existing_lock_id, existing_lock_time = local_lock_table[self.uuid]
             except KeyError:
                 logging.warning("lock for {} no longer exists (expired?)".format(self.uuid))
                 return True
@@ -172,7 +412,7 @@ class LocalLockableObject(LockableObject):
 
             # delete the entry
             logging.info("deleting lock {}".format(self.uuid))
-            del local_lock_ids[self.uuid]
+            del local_lock_table[self.uuid]
 
         logging.debug("release lock {} for {}".format(self.lock_uuid, self))
         self.lock_uuid = None
@@ -194,10 +434,10 @@ class LocalLockableObject(LockableObject):
             logging.error("called is_locked() on {} when uuid was None or empty".format(self))
             return False
 
-        with local_lock_sync:
+        with local_lock_table.sync(self.uuid):
             try:
                 # get the existing lock
-                existing_lock_id, existing_lock_time = local_lock_ids[self.uuid]
+                existing_lock_id, existing_lock_time = local_lock_table[self.uuid]
                 existing_lock_time = datetime.datetime.fromtimestamp(existing_lock_time)
 
                 # if a lock exists, check to see if it has timed out
@@ -221,10 +461,10 @@ class LocalLockableObject(LockableObject):
             logging.debug("refresh_lock() called on unlocked {}".format(self.uuid))
             return False
 
-        with local_lock_sync:
+        with local_lock_table.sync(self.uuid):
             # do we still own the lock?
             try:
-                existing_lock_id, existing_lock_time = local_lock_ids[self.uuid]
+                existing_lock_id, existing_lock_time = local_lock_table[self.uuid]
             except KeyError:
                 logging.warning("lock_id {} for for {} no longer exists (expired?)".format(self.lock_uuid, self.uuid))
                 return False
@@ -234,7 +474,7 @@ class LocalLockableObject(LockableObject):
                 return False
 
             # update the entry
-            local_lock_ids[self.uuid] = ( self.lock_uuid, datetime.datetime.now().timestamp() )
+            local_lock_table[self.uuid] = ( self.lock_uuid, datetime.datetime.now().timestamp() )
             return True
 
         logging.debug("updated lock {} for {}".format(self.lock_uuid, self.uuid))
@@ -251,15 +491,4 @@ class LocalLockableObject(LockableObject):
         return proxy
 
     def _cleanup(self):
-        # in the case where processes die and locks have expired with no chance
-        # of anything ever locking it again, we just need to keep from having a memory leak here
-        with local_lock_sync:
-            expired_lock_ids = []
-            for lock_uuid in local_lock_ids.keys():
-                lock_id, lock_time = local_lock_ids[lock_uuid]
-                if lock_expired(datetime.datetime.fromtimestamp(lock_time)):
-                    logging.warning("detected expired lock {}".format(lock_id))
-                    expired_lock_ids.append(lock_uuid)
-
-            for lock_uuid in expired_lock_ids:
-                del local_lock_ids[lock_uuid]
+        local_lock_table.cleanup()
@@ -0,0 +1,58 @@
+# vim: sw=4:ts=4:et:cc=120
+#
+# in-memory buffering of the logging of a single analysis
+#
+
+import collections
+import logging
+
+class AnalysisLogBuffer(logging.Handler):
+    """Keeps the last capacity log records in memory instead of writing them out as they happen.
+       The records are written (in a single write) with write() only if someone decides they are worth keeping.
+       Records are formatted as they are buffered so that the tracebacks (and the frames they reference) and the
+       arguments of the messages are not kept alive while the root is analyzed."""
+
+    def __init__(self, capacity=10000, level=logging.NOTSET):
+        super().__init__(level=level)
+        # the formatted records
+        self.records = collections.deque(maxlen=capacity)
+        # the highest level seen so far
+        self.max_level = logging.NOTSET
+        # the number of records that were dropped from the front of the buffer
+        self.dropped = 0
+
+    def emit(self, record):
+        try:
+            line = self.format(record)
+        except Exception:
+            self.handleError(record)
+            return
+
+        if len(self.records) == self.records.maxlen:
+            self.dropped += 1
+
+        self.records.append(line)
+        if record.levelno > self.max_level:
+            self.max_level = record.levelno
+
+    def write(self, path):
+        """Appends the buffered records to the given file."""
+        lines = []
+        if self.dropped:
+            lines.append('... {} earlier log records dropped ...'.format(self.dropped))
+
+        lines.extend(self.records)
+        if not lines:
+            return
+
+        with open(path, 'a') as fp:
+            fp.write('\n'.join(lines) + '\n')
+
+    def clear(self):
+        self.records.clear()
+        self.max_level = logging.NOTSET
+        self.dropped = 0
+
+    def close(self):
+        self.clear()
+        super().close()
@@ -0,0 +1,404 @@
+# vim: sw=4:ts=4:et:cc=120
+#
+# engine runtime metrics
+#
+
+import bisect
+import csv
+import ctypes
+import logging
+import multiprocessing
+import os
+import os.path
+import re
+import socketserver
+import threading
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import saq
+from saq.error import report_exception
+
+# the global SharedMetrics object for this process (see initialize_metrics)
+shared_metrics = None
+
+METRIC_COUNTER = 'counter'
+METRIC_GAUGE = 'gauge'
+METRIC_HISTOGRAM = 'histogram'
+_METRIC_KINDS = [ METRIC_COUNTER, METRIC_GAUGE, METRIC_HISTOGRAM ]
+
+# default upper bounds (in seconds) of the histogram buckets
+DEFAULT_BUCKETS = ( 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, 600.0 )
+
+def hdr_buckets(lowest=0.001, highest=3600.0, sub_buckets=4):
+    """Returns log-linear bucket upper bounds (HDR style.) Each doubling from lowest up to highest is split into
+       sub_buckets equal steps, so the relative error is the same at every magnitude."""
+    result = []
+    magnitude = lowest
+    while magnitude < highest:
+        step = magnitude / sub_buckets
+        for i in range(1, sub_buckets + 1):
+            result.append(round(magnitude + (step * i), 9))
+
+        magnitude *= 2
+
+    return tuple(result)
+
+class _SeriesEntry(ctypes.Structure):
+    _fields_ = [ ('name', ctypes.c_char * 64),
+                 ('labels', ctypes.c_char * 192),
+                 ('kind', ctypes.c_int) ]
+
+def format_labels(labels):
+    """Returns the given dict of labels in the prometheus text format (without the braces.)"""
+    if not labels:
+        return ''
+
+    return ','.join(['{}="{}"'.format(key, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+                     for key, value in sorted(labels.items())])
+
+class SharedMetrics(object):
+    """Counters, gauges and histograms kept in shared memory.
+
+       Every process gets its own slot (row) of values and only ever writes to its own slot, so updates do not need
+       any inter-process locking. Readers add up the slots. The multiprocessing.Lock is only used the first time a
+       process uses a new series. This must be created before the processes that use it are forked."""
+
+    def __init__(self, slot_count, series_capacity=1024, buckets=DEFAULT_BUCKETS):
+        assert slot_count > 0
+        assert series_capacity > 0
+        self.slot_count = slot_count
+        self.series_capacity = series_capacity
+        self.buckets = tuple(buckets)
+        # bucket counts, the +Inf bucket, the sum and the count
+        self.values_per_series = len(self.buckets) + 3
+        self.series = multiprocessing.RawArray(_SeriesEntry, series_capacity)
+        self.series_count = multiprocessing.RawValue(ctypes.c_int, 0)
+        self.values = multiprocessing.RawArray(ctypes.c_double,
+                                               slot_count * series_capacity * self.values_per_series)
+        self.series_sync = multiprocessing.Lock()
+
+        # the slot this process writes to
+        self.slot = 0
+        # threads in the same process share the slot
+        self.thread_sync = threading.Lock()
+        # key = tuple(name, labels), value = series index
+        self.series_cache = {}
+        # series we could not create because the table is full
+        self.dropped_series = set()
+
+    def set_slot(self, slot):
+        """Sets the slot the current process writes to. Call this right after forking."""
+        assert 0 <= slot < self.slot_count
+        self.slot = slot
+        self.thread_sync = threading.Lock()
+
+    def _series_index(self, name, labels, kind):
+        key = (name, labels)
+        try:
+            return self.series_cache[key]
+        except KeyError:
+            pass
+
+        encoded_name = name.encode('utf8')
+        encoded_labels = labels.encode('utf8')
+        if len(encoded_name) >= _SeriesEntry.name.size or len(encoded_labels) >= _SeriesEntry.labels.size:
+            raise ValueError("metric {} {{{}}} is too long".format(name, labels))
+
+        # a process killed while holding this lock would otherwise block everyone forever
+        if not self.series_sync.acquire(timeout=5):
+            logging.warning("unable to acquire metrics table lock to record {} {{{}}}".format(name, labels))
+            return None
+
+        try:
+            for index in range(self.series_count.value):
+                entry = self.series[index]
+                if entry.name == encoded_name and entry.labels == encoded_labels:
+                    self.series_cache[key] = index
+                    return index
+
+            if self.series_count.value >= self.series_capacity:
+                if key not in self.dropped_series:
+                    logging.warning("metrics table is full - unable to record {} {{{}}}".format(name, labels))
+                    self.dropped_series.add(key)
+                return None
+
+            index = self.series_count.value
+            self.series[index].name = encoded_name
+            self.series[index].labels = encoded_labels
+            self.series[index].kind = _METRIC_KINDS.index(kind)
+            # the entry is fully written before it becomes visible to readers
+            self.series_count.value = index + 1
+        finally:
+            self.series_sync.release()
+
+        self.series_cache[key] = index
+        return index
+
+    def _offset(self, index, slot=None):
+        return ((self.slot if slot is None else slot) * self.series_capacity + index) * self.values_per_series
+
+    def increment(self, name, value=1, labels=None):
+        """Adds value to the given counter."""
+        index = self._series_index(name, format_labels(labels), METRIC_COUNTER)
+        if index is None:
+            return
+
+        offset = self._offset(index)
+        with self.thread_sync:
+            self.values[offset] += value
+
+    def set_gauge(self, name, value, labels=None):
+        """Sets the value of the given gauge for this process. Readers see the sum across all processes."""
+        index = self._series_index(name, format_labels(labels), METRIC_GAUGE)
+        if index is None:
+            return
+
+        self.values[self._offset(index)] = value
+
+    def observe(self, name, value, labels=None):
+        """Records value in the given histogram."""
+        index = self._series_index(name, format_labels(labels), METRIC_HISTOGRAM)
+        if index is None:
+            return
+
+        offset = self._offset(index)
+        bucket = bisect.bisect_left(self.buckets, value)
+        with self.thread_sync:
+            self.values[offset + bucket] += 1
+            self.values[offset + len(self.buckets) + 1] += value
+            self.values[offset + len(self.buckets) + 2] += 1
+
+    def collect(self):
+        """Returns a list of tuple(name, kind, labels, values) with the values of each series added across all slots.
+           values is a single number for counters and gauges and a list of
+           [ bucket counts..., +Inf bucket count, sum, count ] for histograms."""
+        result = []
+        for index in range(self.series_count.value):
+            entry = self.series[index]
+            kind = _METRIC_KINDS[entry.kind]
+            width = self.values_per_series if kind == METRIC_HISTOGRAM else 1
+            values = [0.0 for _ in range(width)]
+            for slot in range(self.slot_count):
+                offset = self._offset(index, slot)
+                for i in range(width):
+                    values[i] += self.values[offset + i]
+
+            result.append((entry.name.decode('utf8'), kind, entry.labels.decode('utf8'),
+                           values if kind == METRIC_HISTOGRAM else values[0]))
+
+        return result
+
+    def render(self, prefix='ace_', extra_labels=None):
+        """Returns the metrics in the prometheus text exposition format."""
+        extra = format_labels(extra_labels)
+        lines = []
+        described = set()
+
+        def _labels(labels, *additional):
+            result = [x for x in ([ extra, labels ] + list(additional)) if x]
+            return '{{{}}}'.format(','.join(result)) if result else ''
+
+        for name, kind, labels, values in sorted(self.collect(), key=lambda x: (x[0], x[2])):
+            metric_name = '{}{}'.format(prefix, name)
+            if metric_name not in described:
+                lines.append('# TYPE {} {}'.format(metric_name, kind))
+                described.add(metric_name)
+
+            if kind != METRIC_HISTOGRAM:
+                lines.append('{}{} {}'.format(metric_name, _labels(labels), _format_value(values)))
+                continue
+
+            cumulative = 0
+            for upper_bound, count in zip(self.buckets, values):
+                cumulative += count
+                lines.append('{}_bucket{} {}'.format(metric_name, _labels(labels, 'le="{}"'.format(upper_bound)),
+                                                     _format_value(cumulative)))
+
+            lines.append('{}_bucket{} {}'.format(metric_name, _labels(labels, 'le="+Inf"'), _format_value(values[-1])))
+            lines.append('{}_sum{} {}'.format(metric_name, _labels(labels), _format_value(values[-2])))
+            lines.append('{}_count{} {}'.format(metric_name, _labels(labels), _format_value(values[-1])))
+
+        return '\n'.join(lines) + '\n'
+
+def render_gauges(gauges, prefix='ace_', extra_labels=None):
+    """Returns the given list of tuple(name, labels, value) in the prometheus text exposition format."""
+    lines = []
+    described = set()
+    for name, labels, value in gauges:
+        metric_name = '{}{}'.format(prefix, name)
+        if metric_name not in described:
+            lines.append('# TYPE {} gauge'.format(metric_name))
+            described.add(metric_name)
+
+        all_labels = dict(extra_labels) if extra_labels else {}
+        if labels:
+            all_labels.update(labels)
+
+        formatted = format_labels(all_labels)
+        lines.append('{}{} {}'.format(metric_name, '{{{}}}'.format(formatted) if formatted else '', 
+                                      _format_value(value)))
+
+    return '\n'.join(lines) + '\n' if lines else ''
+
+ROLLUP_HEADER = [ 'timestamp', 'engine', 'module', 'observable_type', 'count', 'sum', 'buckets' ]
+
+def write_histogram_rollup(fp, timestamp, engine, buckets, current, previous):
+    """Writes the change in the histograms since the last rollup to the given file as csv.
+       current and previous are dicts of label dict key -> histogram values as returned by SharedMetrics.collect().
+       Only non-zero buckets are written, as a space separated list of upper_bound:count.
+       Returns the number of rows written."""
+    writer = csv.writer(fp)
+    rows = 0
+    for key, values in current.items():
+        last = previous.get(key)
+        delta = [value - (last[i] if last else 0) for i, value in enumerate(values)]
+        count = delta[-1]
+        if not count:
+            continue
+
+        labels = dict(key)
+        bucket_counts = ' '.join(['{}:{}'.format(upper_bound, int(c)) for upper_bound, c in 
+                                  zip(list(buckets) + [ 'inf' ], delta[:-2]) if c])
+        writer.writerow([ timestamp, engine, labels.get('module', ''), labels.get('observable_type', ''), 
+                          int(count), '{:.6f}'.format(delta[-2]), bucket_counts ])
+        rows += 1
+
+    return rows
+
+def parse_labels(labels):
+    """Returns the given labels formatted by format_labels as a tuple of tuple(key, value) sorted by key."""
+    result = []
+    for match in re.finditer(r'([a-zA-Z_][a-zA-Z0-9_]*)="((?:[^"\\]|\\.)*)"', labels):
+        value = match.group(2).replace('\\n', '\n').replace('\\"', '"').replace('\\\\', '\\')
+        result.append((match.group(1), value))
+
+    return tuple(sorted(result))
+
+def _format_value(value):
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+
+    return str(value)
+
+def initialize_metrics(slot_count, series_capacity=None):
+    """Creates the global SharedMetrics object. Call this before forking the processes that record metrics."""
+    global shared_metrics
+    if series_capacity is None:
+        series_capacity = saq.CONFIG['global'].getint('metrics_series_capacity', fallback=1024)
+
+    shared_metrics = SharedMetrics(slot_count, series_capacity)
+    return shared_metrics
+
+def set_metrics_slot(slot):
+    if shared_metrics is not None:
+        shared_metrics.set_slot(slot)
+
+def _record(method, *args, **kwargs):
+    if shared_metrics is None:
+        return
+
+    try:
+        getattr(shared_metrics, method)(*args, **kwargs)
+    except Exception as e:
+        logging.error("unable to record metric {}: {}".format(args[0], e))
+        report_exception()
+
+def increment_metric(name, value=1, labels=None):
+    """Adds value to the given counter. Does nothing if metrics are not initialized."""
+    _record('increment', name, value, labels)
+
+def set_metric_gauge(name, value, labels=None):
+    """Sets the given gauge. Does nothing if metrics are not initialized."""
+    _record('set_gauge', name, value, labels)
+
+def observe_metric(name, value, labels=None):
+    """Records value in the given histogram. Does nothing if metrics are not initialized."""
+    _record('observe', name, value, labels)
+
+class _MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] not in [ '/', '/metrics' ]:
+            self.send_error(404)
+            return
+
+        try:
+            body = self.server.render_function().encode('utf8')
+        except Exception as e:
+            logging.error("unable to render metrics: {}".format(e))
+            report_exception()
+            self.send_error(500)
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        # unix sockets do not have a client address
+        return str(self.client_address[0]) if self.client_address else 'unix'
+
+    def log_message(self, format, *args):
+        logging.debug("metrics request: {}".format(format % args))
+
+class _TCPMetricsServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+class _UnixMetricsServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def server_bind(self):
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+
+        socketserver.UnixStreamServer.server_bind(self)
+        # HTTPServer expects these to exist
+        self.server_name = 'localhost'
+        self.server_port = 0
+
+class MetricsServer(object):
+    """Serves the output of render_function over HTTP on a local port or unix socket in a side thread.
+       listen is either host:port or unix:path (relative paths are relative to SAQ_HOME.)"""
+
+    def __init__(self, listen, render_function):
+        self.listen = listen
+        self.render_function = render_function
+        self.server = None
+        self.thread = None
+
+    def start(self):
+        if self.listen.startswith('unix:'):
+            path = self.listen[len('unix:'):]
+            if not os.path.isabs(path):
+                path = os.path.join(saq.SAQ_HOME, path)
+
+            self.server = _UnixMetricsServer(path, _MetricsRequestHandler)
+        else:
+            host, port = self.listen.rsplit(':', 1)
+            self.server = _TCPMetricsServer((host, int(port)), _MetricsRequestHandler)
+
+        self.server.render_function = self.render_function
+        self.thread = threading.Thread(target=self.server.serve_forever, name="Metrics Server")
+        self.thread.daemon = True
+        self.thread.start()
+        logging.info("serving metrics on {}".format(self.listen))
+
+    def stop(self):
+        if self.server is None:
+            return
+
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+        if isinstance(self.server, _UnixMetricsServer) and os.path.exists(self.server.server_address):
+            try:
+                os.remove(self.server.server_address)
+            except Exception as e:
+                logging.error("unable to remove {}: {}".format(self.server.server_address, e))
+
+        self.server = None
+        self.thread = None
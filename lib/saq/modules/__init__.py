@@ -1,6 +1,8 @@
 # vim: sw=4:ts=4:et:cc=120
 
+import contextlib
 import datetime
+import hashlib
 import json
 import logging
 import os
@@ -14,8 +16,12 @@ import xml.etree.ElementTree as ET
 import saq
 
 from saq.analysis import Analysis, Observable
+from saq.constants import event_time_format
 from saq.error import report_exception
+from saq.exclusions import ObservableExclusions
+from saq.metrics import observe_metric, increment_metric
 from saq.network_semaphore import NetworkSemaphoreClient
+from saq.prefetch import IOCancelledError
 from saq.util import create_timedelta
 
 from splunklib import SplunkQueryObject
@@ -32,6 +38,60 @@ class WatchedFile(object):
         self.path = path
         self.callback = callback
 
+@contextlib.contextmanager
+def _record_additions(observable):
+    """Records the tags and directives added while inside of this context to the given observable and to the 
+       observables recorded into its root, including the ones an observable already had (a cached result has to add 
+       those too.) Tags and directives added by anything else before this context are not included.
+       Yields a dict of key = observable id, value = tuple(tags, directives)."""
+    additions = {}
+    watched = []
+    root = observable.root
+
+    def _watch(o, new=False):
+        if o.id in additions:
+            return
+
+        # a new observable only has what was added to it before it was recorded
+        tags = [t.name for t in o.tags] if new else []
+        directives = list(o.directives) if new else []
+        additions[o.id] = (tags, directives)
+        add_tag = o.add_tag
+        add_directive = o.add_directive
+
+        def _add_tag(tag, *args, **kwargs):
+            if tag not in tags:
+                tags.append(tag)
+
+            return add_tag(tag, *args, **kwargs)
+
+        def _add_directive(directive, *args, **kwargs):
+            if directive not in directives:
+                directives.append(directive)
+
+            return add_directive(directive, *args, **kwargs)
+
+        o.add_tag = _add_tag
+        o.add_directive = _add_directive
+        watched.append(o)
+
+    record_observable = root.record_observable
+
+    def _record_observable(o, *args, **kwargs):
+        result = record_observable(o, *args, **kwargs)
+        _watch(result, new=result is o)
+        return result
+
+    _watch(observable)
+    root.record_observable = _record_observable
+    try:
+        yield additions
+    finally:
+        del root.record_observable
+        for o in watched:
+            del o.add_tag
+            del o.add_directive
+
 class AnalysisModule(object):
     """The base class of all analysis logic.  All your custom analysis modules extend this class."""
 
@@ -59,7 +119,7 @@ class AnalysisModule(object):
         self.generated_observables = []
 
         # observables that are excluded from being analyzed by this module
-        self.observable_exclusions = {} # key = o_type, value = [] of o_value
+        self.observable_exclusions = ObservableExclusions() # key = o_type, value = [] of o_value
         self.load_exclusions()
 
         # observables that are excluded from being generated by this module
@@ -112,6 +172,13 @@ class AnalysisModule(object):
 
         # reference to the configuration object itself
         self.config = saq.CONFIG[self.config_section]
+
+        # changing the configuration of a module invalidates the results it has cached
+        h = hashlib.sha1(type(self).__name__.encode())
+        for key, value in sorted(self.config.items()):
+            h.update('{}={}\n'.format(key, value).encode('utf8', errors='backslashreplace'))
+        self.config_version = h.hexdigest()
+
         self.load_config()
 
     def load_config(self):
@@ -254,28 +321,17 @@ class AnalysisModule(object):
         logging.warning("{} entered cooldown period until {}".format(self, self.cooldown_timeout))
 
     def add_observable_exclusion(self, o_type, o_value):
-        if o_type not in self.observable_exclusions:
-            self.observable_exclusions[o_type] = []
-
-        if o_value not in self.observable_exclusions[o_type]:
-            self.observable_exclusions[o_type].append(o_value)
+        if self.observable_exclusions.add(o_type, o_value):
             logging.debug("loaded observable exclusion type {} value {} for {}".format(
                 o_type, o_value, self))
 
     def is_excluded(self, observable):
         """Returns True if the given observable is excluded from analysis for this module."""
-        if observable.type not in self.observable_exclusions:
-            return False
-
-        for exclusion_value in self.observable_exclusions[observable.type]:
-            if observable.matches(exclusion_value):
-                return True
-
-        return False
+        return self.observable_exclusions.is_excluded(observable)
 
     def load_exclusions(self):
         # load any observable exclusions for this module
-        self.observable_exclusions = {}
+        self.observable_exclusions = ObservableExclusions()
         for key in self.config.keys():
             if key.startswith("exclude_"):
                 o_type, o_value = self.config[key].split(':', 1)
@@ -365,6 +421,26 @@ class AnalysisModule(object):
         # we still call execution on the module in cooldown mode
         # there may be things it can (or should) do while on cooldown
 
+        if not self.is_valid_target(obj):
+            return False
+
+        # are we in cooldown mode?
+        # XXX side effect!
+        if self.cooldown_timeout:
+            # are we still in cooldown mode?
+            if datetime.datetime.now() < self.cooldown_timeout:
+                logging.debug("{} in cooldown mode".format(self))
+            else:
+                self.cooldown_timeout = None
+                logging.info("{} exited cooldown mode".format(self))
+
+        # end with custom logic, which defaults to True if not implemented
+        return self.should_analyze(obj)
+
+    def is_valid_target(self, obj):
+        """Returns True if this object passes the checks made by accepts() that do not have side effects (everything 
+           except the cooldown and should_analyze.)  This is what the engine uses to decide what to prefetch."""
+
         if self.valid_analysis_target_type is not None:
             if not isinstance(obj, self.valid_analysis_target_type):
                 logging.debug("{} is not a valid target type for {}".format(obj, self))
@@ -415,18 +491,7 @@ class AnalysisModule(object):
                     logging.debug("already analyzed {} with {}".format(obj, self))
                     return False
 
-        # are we in cooldown mode?
-        # XXX side effect!
-        if self.cooldown_timeout:
-            # are we still in cooldown mode?
-            if datetime.datetime.now() < self.cooldown_timeout:
-                logging.debug("{} in cooldown mode".format(self))
-            else:
-                self.cooldown_timeout = None
-                logging.info("{} exited cooldown mode".format(self))
-
-        # end with custom logic, which defaults to True if not implemented
-        return self.should_analyze(obj)
+        return True
 
     def __str__(self):
         return type(self).__name__
@@ -468,8 +533,13 @@ class AnalysisModule(object):
 
         #logging.debug("analysis module {0} acquiring semaphore {1}".format(self, self.semaphore_name))
         try:
-            if not self.semaphore.acquire(self.semaphore_name):
-                raise RuntimeError("acquire returned False")
+            acquire_start_time = time.time()
+            try:
+                if not self.semaphore.acquire(self.semaphore_name):
+                    raise RuntimeError("acquire returned False")
+            finally:
+                observe_metric('semaphore_wait_seconds', time.time() - acquire_start_time, 
+                               labels={ 'semaphore': self.semaphore_name })
             #logging.debug("analysis module {0} acquired semaphore {1}".format(self, self.semaphore_name))
         except Exception as e:
             logging.error("unable to acquire semaphore {} : {}".format(self.semaphore_name, e))
@@ -505,11 +575,172 @@ class AnalysisModule(object):
         #if not self.accepts(obj):
             #return False
 
-        # if we are executing in "final analysis mode" then we call this function instead
-        if final_analysis:
-            return self.execute_final_analysis(obj)
-        else:
-            return self.execute_analysis(obj)
+        try:
+            # if we are executing in "final analysis mode" then we call this function instead
+            if final_analysis:
+                return self.execute_final_analysis(obj)
+
+            # can we use a result this module generated for the same observable in another root?
+            if self.result_cache is None or not isinstance(obj, Observable) \
+            or obj.get_analysis(self.generated_analysis_type) is not None:
+                return self.execute_analysis(obj)
+
+            cached_result = self.get_cached_result(obj)
+            if cached_result is not None:
+                return self.restore_cached_result(obj, cached_result)
+
+            with _record_additions(obj) as additions:
+                result = self.execute_analysis(obj)
+
+            self.cache_result(obj, result, additions)
+            return result
+
+        except IOCancelledError:
+            # see get_io_result
+            logging.info("{} was cancelled waiting for the i/o of {}".format(self, obj))
+            return False
+
+    @property
+    def result_cache(self):
+        """Returns the ModuleResultCache used to share results across roots, or None if results are not cached.
+           Set cache = yes in the configuration of the module to enable. Only modules that keep everything they generate 
+           in the details, tags and observables of the analysis (and the tags and directives of the observable) should 
+           enable this, since that is all a cached result restores."""
+        if not self.config.getboolean('cache', fallback=False):
+            return None
+
+        return getattr(self.engine, 'module_result_cache', None)
+
+    @property
+    def cache_ttl(self):
+        """Number of seconds a result stays cached. Defaults to 3600."""
+        return self.config.getint('cache_ttl', fallback=3600)
+
+    @property
+    def cache_negative_ttl(self):
+        """Number of seconds the module not generating analysis for an observable stays cached. 
+           Defaults to 0 (disabled) since most modules also do not generate analysis when a service they use fails."""
+        return self.config.getint('cache_negative_ttl', fallback=0)
+
+    def cache_key(self, observable):
+        return self.result_cache.cache_key(self.config_section, self.config_version, observable.type, observable.value)
+
+    def get_cached_result(self, observable):
+        """Returns the cached result (dict) for the given observable, or None if nothing is cached."""
+        try:
+            result = self.result_cache.get(self.cache_key(observable))
+            if result is not None:
+                result = json.loads(result)
+        except Exception as e:
+            logging.error("unable to load cached result of {} for {}: {}".format(self, observable, e))
+            report_exception()
+            result = None
+
+        increment_metric('module_cache_hits' if result is not None else 'module_cache_misses', 
+                         labels={ 'module': self.config_section })
+        return result
+
+    def cache_result(self, observable, result, additions):
+        """Caches the result of execute_analysis for the given observable.
+           additions are the tags and directives execute_analysis added to the observable and the observables it 
+           generated (see _record_additions.) Anything else they have depends on the root and is not cached."""
+        from saq.analysis import _JSONEncoder
+
+        if self.cancel_analysis_flag or not isinstance(result, bool):
+            return
+
+        analysis = observable.get_analysis(self.generated_analysis_type)
+        # delayed analysis is not finished yet
+        if analysis and analysis.delayed:
+            return
+
+        ttl = self.cache_ttl if result and analysis else self.cache_negative_ttl
+        if ttl <= 0:
+            return
+
+        cached_result = {
+            'result': result,
+            'tags': additions[observable.id][0],
+            'directives': additions[observable.id][1],
+            'analysis': None, }
+
+        if analysis:
+            cached_result['analysis'] = {
+                'details': analysis.details,
+                'tags': [t.name for t in analysis.tags],
+                'observables': [{ 'type': o.type, 
+                                  'value': o.value, 
+                                  'time': o.time.strftime(event_time_format) 
+                                          if isinstance(o.time, datetime.datetime) else o.time,
+                                  'tags': additions.get(o.id, ([], []))[0],
+                                  'directives': additions.get(o.id, ([], []))[1] }
+                                for o in analysis.observables], }
+
+        try:
+            self.result_cache.set(self.cache_key(observable), self.config_section, ttl, 
+                                  json.dumps(cached_result, cls=_JSONEncoder))
+        except Exception as e:
+            logging.error("unable to cache result of {} for {}: {}".format(self, observable, e))
+            report_exception()
+
+    def restore_cached_result(self, observable, cached_result):
+        """Rebuilds the analysis for the given observable from a cached result. Returns the cached return value."""
+        logging.debug("using cached result of {} for {}".format(self, observable))
+        for tag in cached_result['tags']:
+            observable.add_tag(tag)
+
+        for directive in cached_result['directives']:
+            observable.add_directive(directive)
+
+        if cached_result['analysis'] is None:
+            return cached_result['result']
+
+        analysis = self.create_analysis(observable)
+        analysis.details = cached_result['analysis']['details']
+        for tag in cached_result['analysis']['tags']:
+            analysis.add_tag(tag)
+
+        for o in cached_result['analysis']['observables']:
+            child = analysis.add_observable(o['type'], o['value'], o['time'])
+            if child is None:
+                continue
+
+            for tag in o['tags']:
+                child.add_tag(tag)
+
+            for directive in o['directives']:
+                child.add_directive(directive)
+
+        return cached_result['result']
+
+    @property
+    def io_bound(self):
+        """Returns True if the engine can execute the execute_io function of this module concurrently.
+           Modules that override execute_io are I/O bound unless io_bound = no is set in the configuration."""
+        if type(self).execute_io is AnalysisModule.execute_io:
+            return False
+
+        return self.config.getboolean('io_bound', fallback=True)
+
+    @property
+    def io_concurrency(self):
+        """The maximum number of execute_io calls for this module that can execute at the same time. Defaults to 1."""
+        return self.config.getint('io_concurrency', fallback=1)
+
+    def execute_io(self, observable):
+        """Override this in your subclass to perform the blocking requests (searches, queries, binds) needed to
+           analyze the given observable. The engine may call this on another thread before execute_analysis is called
+           so it must not modify the analysis tree. Use get_io_result from execute_analysis to get the return value."""
+        return None
+
+    def get_io_result(self, observable):
+        """Returns the result of execute_io for the given observable.
+           If the engine is executing it concurrently then this waits for it, otherwise it is executed now.
+           Raises IOCancelledError if analysis is cancelled while waiting (analyze() then returns False.)"""
+        if getattr(self.engine, "io_prefetcher", None) is not None:
+            return self.engine.io_prefetcher.get(self, observable)
+
+        return self.execute_io(observable)
 
     def cleanup(self):
         """Called after all analysis has completed. Override this if you need to clean up something after analysis."""
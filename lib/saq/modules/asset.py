@@ -535,9 +535,12 @@ class ActiveDirectoryAnalyzer(LDAPAnalysisModule):
     def valid_observable_types(self):
         return F_HOSTNAME
 
+    def execute_io(self, hostname):
+        return self.ldap_query_hostname(hostname.value)
+
     def execute_analysis(self, hostname):
 
-        details = self.ldap_query_hostname(hostname.value)
+        details = self.get_io_result(hostname)
         if details is None:
             logging.debug("no result received from ldap query for {}".format(hostname.value))
             return False
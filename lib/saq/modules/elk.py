@@ -49,9 +49,12 @@ class SnortAlertsAnalyzer(ELKAnalysisModule):
     def valid_observable_types(self):
         return F_IPV4
 
+    def execute_io(self, ipv4):
+        return self.search('snort', 'src_ip:{} OR dest_ip:{}'.format(ipv4.value, ipv4.value))
+
     def execute_analysis(self, ipv4):
 
-        search_results = self.search('snort', 'src_ip:{} OR dest_ip:{}'.format(ipv4.value, ipv4.value))
+        search_results = self.get_io_result(ipv4)
         if search_results is None:
             return False
 
@@ -8,6 +8,7 @@ import logging
 import os, os.path
 import time
 import re
+import uuid
 
 import saq
 from saq.constants import *
@@ -82,6 +83,31 @@ class BasicTestAnalyzer(AnalysisModule):
         new_observable.exclude_analysis(BasicTestAnalyzer)
         return True
 
+class CacheTestAnalysis(TestAnalysis):
+    def initialize_details(self):
+        self.details = { KEY_TEST_RESULT: None }
+
+class CacheTestAnalyzer(AnalysisModule):
+    @property
+    def generated_analysis_type(self):
+        return CacheTestAnalysis
+
+    @property
+    def valid_observable_types(self):
+        return F_TEST
+
+    def execute_analysis(self, test):
+        if test.value == 'test_cache':
+            analysis = self.create_analysis(test)
+            # this is different every time the analysis actually executes
+            analysis.details[KEY_TEST_RESULT] = str(uuid.uuid4())
+            test.add_tag('cached_tag')
+            observable = analysis.add_observable(F_TEST, 'cached_observable')
+            observable.add_tag('cached_child_tag')
+            return True
+
+        return False
+
 class MergeTestAnalysis(TestAnalysis):
     def initialize_details(self):
         self.details = { KEY_TEST_RESULT: True }
@@ -84,17 +84,24 @@ class EmailAddressAnalyzer(LDAPAnalysisModule):
     def valid_observable_types(self):
         return F_EMAIL_ADDRESS
 
-    def execute_analysis(self, email_address):
-
+    def execute_io(self, email_address):
         m = re.match(r'^<?([^>]+)>?$', email_address.value.strip())
         if m is None:
-            logging.debug("unable to parse email address {}".format(email_address.value))
-            return False
+            return None
 
         normalized_email_address = m.group(1)
+        return (normalized_email_address,
+                self.ldap_query("mail={}".format(normalized_email_address)),
+                self.tivoli_ldap_query("mail={}".format(normalized_email_address)))
+
+    def execute_analysis(self, email_address):
 
-        ldap_result = self.ldap_query("mail={}".format(normalized_email_address))
-        tivoli_ldap_result = self.tivoli_ldap_query("mail={}".format(normalized_email_address))
+        io_result = self.get_io_result(email_address)
+        if io_result is None:
+            logging.debug("unable to parse email address {}".format(email_address.value))
+            return False
+
+        normalized_email_address, ldap_result, tivoli_ldap_result = io_result
         if ldap_result is None and tivoli_ldap_result is None: 
             logging.debug("no results for {}".format(normalized_email_address))
             return False
@@ -163,8 +170,7 @@ class UserAnalyzer(LDAPAnalysisModule):
     def _tivoli_ldap_query_user(self, username):
         return self.tivoli_ldap_query("uid={}*".format(username))
 
-    def execute_analysis(self, user):
-
+    def execute_io(self, user):
         ldap_result = self._ldap_query_user(user.value)
         tivoli_ldap_result = self._tivoli_ldap_query_user(user.value)
 
@@ -194,6 +200,11 @@ class UserAnalyzer(LDAPAnalysisModule):
                 if manager_result is not None and 'displayName' in manager_result:
                     logging.debug("got manager {} for user {}".format(manager_result['displayName'], user.value))
 
+        return ldap_result, tivoli_ldap_result, manager_result
+
+    def execute_analysis(self, user):
+
+        ldap_result, tivoli_ldap_result, manager_result = self.get_io_result(user)
         analysis = self.create_analysis(user)
 
         if ldap_result is None:
@@ -72,6 +72,12 @@ class CaselessObservable(Observable):
     def _compare_value(self, other):
         return self.normalize_caseless(self.value) == self.normalize_caseless(other)
 
+    def _index_value(self, value):
+        if not isinstance(value, str):
+            return value
+
+        return self.normalize_caseless(value)
+
 class IPv4Observable(Observable):
 
     def __init__(self, *args, **kwargs):
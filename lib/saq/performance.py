@@ -2,6 +2,7 @@
 
 import csv
 import datetime
+import functools
 import logging
 import os, os.path
 import sys
@@ -13,12 +14,13 @@ def record_execution_time(function, start, stop):
     logging.debug("EXECUTION TIME {}: {:.3f}".format(function.__name__, stop - start))
 
 def track_execution_time(f):
+    @functools.wraps(f)
     def _track_execution_time(*args, **kwargs):
-        start = time.clock()
+        start = time.perf_counter()
         try:
-            f(*args, **kwargs)
+            return f(*args, **kwargs)
         finally:
-            stop = time.clock()
+            stop = time.perf_counter()
             record_execution_time(f, start, stop)
 
     return _track_execution_time
@@ -0,0 +1,111 @@
+# vim: sw=4:ts=4:et:cc=120
+#
+# concurrent execution of the blocking i/o of analysis modules
+#
+
+import collections
+import logging
+import os
+import threading
+
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError
+
+class IOCancelledError(Exception):
+    """Raised by IOPrefetcher.get when the module is cancelled while waiting for the result."""
+    pass
+
+class IOPrefetcher(object):
+    """Executes AnalysisModule.execute_io for I/O bound modules on a bounded pool of threads so that the searches,
+       queries and binds of different modules and observables overlap.
+
+       Only execute_io runs on the pool. The results are picked up by execute_analysis (see get()) on the analysis
+       thread, which is the only thread that modifies the analysis tree.
+
+       Each module runs at most module.io_concurrency requests at the same time. Requests that are over the limit
+       wait in a queue for that module instead of holding one of the pool threads."""
+
+    def __init__(self, max_workers):
+        self.max_workers = max_workers
+        # the process this was created in (thread pools do not survive a fork)
+        self.pid = os.getpid()
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.lock = threading.RLock()
+        self.futures = {} # key = (module.config_section, observable.id), value = Future
+        self.pending = collections.defaultdict(collections.deque) # key = module, value = deque of (observable, Future)
+        self.running = collections.defaultdict(int) # key = module, value = number of requests executing
+
+    def __len__(self):
+        return len(self.futures)
+
+    def _key(self, module, observable):
+        return (module.config_section, observable.id)
+
+    def submit(self, module, observable):
+        """Schedules module.execute_io(observable) to run on the pool. Returns the Future for the result."""
+        key = self._key(module, observable)
+        with self.lock:
+            if key in self.futures and not self.futures[key].cancelled():
+                return self.futures[key]
+
+            future = Future()
+            self.futures[key] = future
+            if self.running[module] < max(module.io_concurrency, 1):
+                self.running[module] += 1
+                self.executor.submit(self._execute, module, observable, future)
+            else:
+                self.pending[module].append((observable, future))
+
+            return future
+
+    def _execute(self, module, observable, future):
+        try:
+            if future.set_running_or_notify_cancel():
+                try:
+                    future.set_result(module.execute_io(observable))
+                except BaseException as e:
+                    future.set_exception(e)
+        finally:
+            # start the next request for this module, if there is one
+            with self.lock:
+                if self.pending[module]:
+                    next_observable, next_future = self.pending[module].popleft()
+                    self.executor.submit(self._execute, module, next_observable, next_future)
+                else:
+                    self.running[module] -= 1
+
+    def get(self, module, observable):
+        """Returns the result of module.execute_io(observable), waiting for it if needed.
+           Exceptions raised by execute_io are raised here. Raises IOCancelledError if the module is cancelled while
+           waiting."""
+        with self.lock:
+            future = self.submit(module, observable)
+            # if this is still waiting in line then move it to the front
+            for index, (_observable, _future) in enumerate(self.pending[module]):
+                if _future is future:
+                    del self.pending[module][index]
+                    self.pending[module].appendleft((_observable, _future))
+                    break
+
+        while True:
+            try:
+                return future.result(timeout=0.1)
+            except TimeoutError:
+                if module.cancel_analysis_flag:
+                    logging.warning("cancelled waiting for i/o of {} on {}".format(module, observable))
+                    future.cancel()
+                    raise IOCancelledError()
+
+    def reset(self):
+        """Discards all results and cancels requests that have not started yet. Called after each root is analyzed."""
+        with self.lock:
+            # requests that are already running finish on their own and the results are dropped
+            for pending in self.pending.values():
+                for observable, future in pending:
+                    future.cancel()
+
+            self.pending.clear()
+            self.futures.clear()
+
+    def shutdown(self):
+        self.reset()
+        self.executor.shutdown(wait=True)
@@ -0,0 +1,105 @@
+# vim: sw=4:ts=4:et:cc=120
+#
+# on-demand sampling profiler
+#
+
+import collections
+import logging
+import os, os.path
+import sys
+import threading
+import time
+
+# the context used for samples taken outside of any analysis module
+DEFAULT_CONTEXT = ( 'engine', )
+
+class SamplingProfiler(object):
+    """Periodically samples the stack of a single thread from a background thread.
+
+       Samples are grouped by the current context (a tuple of strings) which the thread being profiled sets
+       with the context property (for example the analysis module and the type of observable being analyzed.)
+       The results are written in the "folded" format used by flamegraph.pl and speedscope: one line per unique
+       stack with the frames separated by semicolons (root first) followed by the number of samples."""
+
+    def __init__(self, interval=0.01, thread_ident=None):
+        # how often (in seconds) we take a sample
+        self.interval = interval
+        # the thread we are profiling (defaults to the thread that creates the profiler)
+        self.thread_ident = thread_ident if thread_ident is not None else threading.get_ident()
+        # key = tuple(context + frames), value = number of samples
+        self.samples = collections.Counter()
+        self.sample_count = 0
+        # set by the thread being profiled
+        self.context = None
+
+        self.start_time = None
+        self.stop_time = None
+        self.thread = None
+        self.shutdown_event = threading.Event()
+
+    @property
+    def running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def start(self):
+        if self.running:
+            return
+
+        self.samples.clear()
+        self.sample_count = 0
+        self.shutdown_event.clear()
+        self.start_time = time.time()
+        self.stop_time = None
+        self.thread = threading.Thread(target=self.loop, name="Sampling Profiler")
+        self.thread.daemon = True
+        self.thread.start()
+        logging.info("started sampling profiler on pid {} interval {}".format(os.getpid(), self.interval))
+
+    def stop(self):
+        if self.thread is None:
+            return
+
+        self.shutdown_event.set()
+        self.thread.join()
+        self.thread = None
+        self.stop_time = time.time()
+        logging.info("stopped sampling profiler on pid {} ({} samples)".format(os.getpid(), self.sample_count))
+
+    def loop(self):
+        while not self.shutdown_event.wait(self.interval):
+            try:
+                self.sample()
+            except Exception as e:
+                logging.error("unable to take profiler sample: {}".format(e))
+
+    def sample(self):
+        frame = sys._current_frames().get(self.thread_ident)
+        if frame is None:
+            return
+
+        # the context is read once since it is changed by another thread
+        context = self.context or DEFAULT_CONTEXT
+
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append('{} ({}:{})'.format(code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+            frame = frame.f_back
+
+        stack.reverse()
+        self.samples[tuple(context) + tuple(stack)] += 1
+        self.sample_count += 1
+
+    def folded(self):
+        """Returns the samples in the folded stack format."""
+        # semicolons separate the frames so they can't be part of the names
+        return ''.join(['{} {}\n'.format(';'.join([name.replace(';', ':') for name in key]), count)
+                       for key, count in sorted(self.samples.items())])
+
+    def write(self, path):
+        """Writes the samples in the folded stack format to the given path."""
+        temp_path = '{}.tmp'.format(path)
+        with open(temp_path, 'w') as fp:
+            fp.write(self.folded())
+
+        os.rename(temp_path, path)
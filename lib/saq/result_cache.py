@@ -0,0 +1,100 @@
+# vim: sw=4:ts=4:et:cc=120
+#
+# cross-root cache of analysis module results
+#
+
+import hashlib
+import logging
+import os
+import sqlite3
+import time
+
+from saq.error import report_exception
+
+class ModuleResultCache(object):
+    """Stores the results of analysis modules by (module, module config version, observable type, observable value)
+       in a local sqlite database shared by all the process managers on this node.
+       Results are stored as JSON text and expire after the ttl given when they are stored."""
+
+    def __init__(self, path):
+        self.path = path
+        # sqlite connections do not survive a fork so we keep one per process
+        self._db = None
+        self._db_pid = None
+        self._inherited_db = None
+
+    @staticmethod
+    def cache_key(module_name, config_version, o_type, o_value):
+        """Returns the key used to store the result of the given module for the given observable."""
+        h = hashlib.sha256()
+        for value in [ module_name, config_version, o_type, o_value ]:
+            h.update(str(value).encode('utf8', errors='backslashreplace'))
+            h.update(b'\x00')
+
+        return h.hexdigest()
+
+    def _connect(self):
+        if self._db is None or self._db_pid != os.getpid():
+            # a connection inherited across a fork is never used or closed here
+            # (closing it would release the locks the parent process holds on the database)
+            if self._db is not None:
+                self._inherited_db = self._db
+
+            self._db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+            self._db_pid = os.getpid()
+
+        return self._db
+
+    def initialize(self):
+        db = self._connect()
+        db.execute("""CREATE TABLE IF NOT EXISTS module_results (
+                          key TEXT PRIMARY KEY,
+                          module TEXT NOT NULL,
+                          expires REAL NOT NULL,
+                          result TEXT NOT NULL )""")
+        db.execute("""CREATE INDEX IF NOT EXISTS idx_expires ON module_results ( expires )""")
+
+    def get(self, key):
+        """Returns the stored result for the given key, or None if there is no result or it has expired."""
+        try:
+            row = self._connect().execute("""SELECT expires, result FROM module_results WHERE key = ?""",
+                                          (key,)).fetchone()
+        except Exception as e:
+            logging.error("unable to query module result cache {}: {}".format(self.path, e))
+            return None
+
+        if row is None:
+            return None
+
+        expires, result = row
+        if expires < time.time():
+            return None
+
+        return result
+
+    def set(self, key, module_name, ttl, result):
+        """Stores the result (JSON text) for the given key for ttl seconds."""
+        try:
+            self._connect().execute("""INSERT OR REPLACE INTO module_results ( key, module, expires, result )
+                                       VALUES ( ?, ?, ?, ? )""", (key, module_name, time.time() + ttl, result))
+        except Exception as e:
+            logging.error("unable to store result in module result cache {}: {}".format(self.path, e))
+
+    def purge(self):
+        """Deletes expired results. Returns the number of results deleted."""
+        try:
+            c = self._connect().execute("""DELETE FROM module_results WHERE expires < ?""", (time.time(),))
+            return c.rowcount
+        except Exception as e:
+            logging.error("unable to purge module result cache {}: {}".format(self.path, e))
+            report_exception()
+            return 0
+
+    def close(self):
+        if self._db is not None and self._db_pid == os.getpid():
+            self._db.close()
+
+        self._db = None
+        self._db_pid = None
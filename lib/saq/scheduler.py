@@ -0,0 +1,156 @@
+# vim: sw=4:ts=4:et:cc=120
+#
+# priority scheduling of engine work items
+#
+
+import collections
+import logging
+import threading
+import time
+
+# the name of the lane used when no lanes are configured
+DEFAULT_LANE = 'default'
+
+class SchedulerLane(object):
+    """A FIFO of work items that share the same priority."""
+    def __init__(self, name, weight):
+        assert isinstance(name, str) and name
+        assert isinstance(weight, int) and weight > 0
+        self.name = name
+        self.weight = weight
+        self.items = collections.deque() # of tuple(enqueue_time, work_item)
+
+        # smooth weighted round robin state
+        self.current_weight = 0
+
+        # metrics
+        self.enqueued = 0
+        self.dequeued = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def __len__(self):
+        return len(self.items)
+
+    @property
+    def oldest_wait(self):
+        """Returns how long (in seconds) the oldest item in this lane has been waiting."""
+        if not self.items:
+            return 0.0
+
+        return time.time() - self.items[0][0]
+
+    def put(self, work_item):
+        self.items.append((time.time(), work_item))
+        self.enqueued += 1
+
+    def get(self):
+        enqueue_time, work_item = self.items.popleft()
+        wait_time = time.time() - enqueue_time
+        self.dequeued += 1
+        self.total_wait += wait_time
+        self.max_wait = max(self.max_wait, wait_time)
+        return work_item
+
+    def __str__(self):
+        return "SchedulerLane({},weight={},depth={})".format(self.name, self.weight, len(self))
+
+class WorkScheduler(object):
+    """Orders work items across multiple priority lanes.
+
+       Lanes are selected by smooth weighted round robin so that a lane with weight 8 gets eight items for every one
+       item from a lane with weight 1. Any item that has waited longer than max_wait seconds is selected first
+       (oldest first) so that low priority lanes are never starved.
+
+       The scheduler is filled and emptied by the thread that manages the queues of the engine while the metrics are
+       read by other threads (the metrics server) so every operation holds the lock of the scheduler."""
+
+    def __init__(self, lanes=None, default_lane=None, max_wait=None):
+        """lanes is a list of tuple(name, weight) in order of priority."""
+        if not lanes:
+            lanes = [ (DEFAULT_LANE, 1) ]
+
+        self.lanes = collections.OrderedDict() # key = lane name, value = SchedulerLane
+        for name, weight in lanes:
+            self.lanes[name] = SchedulerLane(name, weight)
+
+        self.default_lane = default_lane if default_lane else next(iter(self.lanes))
+        if self.default_lane not in self.lanes:
+            raise ValueError("default lane {} is not a valid lane".format(self.default_lane))
+
+        self.max_wait = max_wait
+        self.lock = threading.RLock()
+
+    def __len__(self):
+        with self.lock:
+            return sum([len(lane) for lane in self.lanes.values()])
+
+    def put(self, work_item, lane_name=None):
+        """Adds the work item to the given lane (or the default lane.)"""
+        try:
+            lane = self.lanes[lane_name if lane_name is not None else self.default_lane]
+        except KeyError:
+            logging.warning("invalid lane {} for {} - using default lane {}".format(
+                            lane_name, work_item, self.default_lane))
+            lane = self.lanes[self.default_lane]
+
+        with self.lock:
+            lane.put(work_item)
+
+    def get(self):
+        """Returns the next work item, or None if all lanes are empty."""
+        with self.lock:
+            return self._get()
+
+    def _get(self):
+        # is anything starving?
+        if self.max_wait is not None:
+            starving_lane = None
+            for lane in self.lanes.values():
+                if lane.items and lane.oldest_wait >= self.max_wait:
+                    if starving_lane is None or lane.items[0][0] < starving_lane.items[0][0]:
+                        starving_lane = lane
+
+            if starving_lane is not None:
+                return starving_lane.get()
+
+        # smooth weighted round robin across the lanes that have something in them
+        selected_lane = None
+        active_weight = 0
+        for lane in self.lanes.values():
+            if not lane.items:
+                continue
+
+            lane.current_weight += lane.weight
+            active_weight += lane.weight
+            if selected_lane is None or lane.current_weight > selected_lane.current_weight:
+                selected_lane = lane
+
+        if selected_lane is None:
+            return None
+
+        selected_lane.current_weight -= active_weight
+        work_item = selected_lane.get()
+
+        # lanes don't carry credit from before they were empty
+        if not selected_lane.items:
+            selected_lane.current_weight = 0
+
+        return work_item
+
+    def metrics(self):
+        """Returns a dict of lane name -> dict of metrics for that lane."""
+        result = collections.OrderedDict()
+        with self.lock:
+            for lane in self.lanes.values():
+                result[lane.name] = {
+                    'depth': len(lane),
+                    'weight': lane.weight,
+                    'enqueued': lane.enqueued,
+                    'dequeued': lane.dequeued,
+                    'average_wait': (lane.total_wait / lane.dequeued) if lane.dequeued else 0.0,
+                    'max_wait': lane.max_wait,
+                    'oldest_wait': lane.oldest_wait,
+                }
+
+        return result
@@ -0,0 +1,118 @@
+# vim: sw=4:ts=4:et:cc=120
+#
+# serialization of analysis (data.json, the journal and the analysis details)
+#
+
+import datetime
+import json
+import logging
+
+import saq
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+def json_default(obj):
+    """Returns the JSON serializable value of objects the JSON codecs do not support natively."""
+    if isinstance(obj, datetime.datetime):
+        return obj.isoformat()
+    elif isinstance(obj, bytes):
+        return obj.decode('unicode_escape', 'replace')
+    elif hasattr(obj, 'json'):
+        return obj.json
+
+    raise TypeError("object of type {} is not JSON serializable".format(type(obj).__name__))
+
+class JSONEncoder(json.JSONEncoder):
+    def default(self, obj):
+        try:
+            return json_default(obj)
+        except TypeError:
+            logging.debug('json type {0}'.format(type(obj)))
+            return super(JSONEncoder, self).default(obj)
+
+class JSONCodec(object):
+    """Encodes to and decodes from JSON using the standard json module. The output is ASCII."""
+
+    name = 'json'
+
+    @staticmethod
+    def available():
+        return True
+
+    def __init__(self):
+        self.encoder = JSONEncoder()
+
+    def encode(self, obj):
+        """Returns the given object encoded as JSON (bytes)."""
+        return self.encoder.encode(obj).encode('utf8')
+
+    def decode(self, data):
+        """Returns the object decoded from the given JSON (bytes or str.)"""
+        return json.loads(data)
+
+class OrjsonCodec(JSONCodec):
+    """Uses orjson (if it is installed.) The output is compact UTF-8.
+       Anything orjson cannot encode or decode (for example integers larger than 64 bits or NaN) is done by the
+       standard json module instead."""
+
+    name = 'orjson'
+
+    @staticmethod
+    def available():
+        return orjson is not None
+
+    def encode(self, obj):
+        try:
+            # datetimes are passed to json_default so they are formatted the same way the json codec does
+            return orjson.dumps(obj, default=json_default, 
+                                option=orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME)
+        except TypeError:
+            return super().encode(obj)
+
+    def decode(self, data):
+        try:
+            return orjson.loads(data)
+        except ValueError:
+            return super().decode(data)
+
+# in order of preference for auto
+CODECS = [ OrjsonCodec, JSONCodec ]
+
+def create_codec(name):
+    """Returns a new codec by name. auto selects the fastest codec that is available.
+       Falls back to the json codec if the requested codec is not available."""
+    if name == 'auto':
+        for codec_class in CODECS:
+            if codec_class.available():
+                return codec_class()
+
+    for codec_class in CODECS:
+        if codec_class.name == name:
+            if codec_class.available():
+                return codec_class()
+
+            logging.warning("serialization backend {} is not installed (using json)".format(name))
+            return JSONCodec()
+
+    logging.error("invalid serialization backend {} (using json)".format(name))
+    return JSONCodec()
+
+# the codec in use (see get_codec)
+_codec = None
+
+def get_codec():
+    """Returns the codec selected by serialization_backend in the [global] section."""
+    global _codec
+    if _codec is None:
+        _codec = create_codec(saq.CONFIG['global'].get('serialization_backend', fallback='json'))
+
+    return _codec
+
+def set_codec(name):
+    """Changes the codec in use. Returns the new codec."""
+    global _codec
+    _codec = create_codec(name)
+    return _codec
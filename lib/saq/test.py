@@ -101,6 +101,12 @@ def cleanup_delayed_analysis(target_function):
             delayed_analysis_dir = os.path.join(saq.SAQ_HOME, 'var', 'unittest', 'delayed_analysis')
             if os.path.exists(delayed_analysis_dir):
                 shutil.rmtree(delayed_analysis_dir)
+            delayed_analysis_store = os.path.join(saq.SAQ_HOME, 'var', 'unittest', 'delayed_analysis.db')
+            if os.path.exists(delayed_analysis_store):
+                os.remove(delayed_analysis_store)
+            analysis_checkpoint_store = os.path.join(saq.SAQ_HOME, 'var', 'unittest', 'checkpoints.db')
+            if os.path.exists(analysis_checkpoint_store):
+                os.remove(analysis_checkpoint_store)
     return wrapper
 
 def force_alerts(target_function):
@@ -606,6 +612,14 @@ class ACEEngineTestCase(ACEBasicTestCase):
             finally:
                 self.tracked_engine = None
 
+    def setUp(self):
+        ACEBasicTestCase.setUp(self)
+
+        # don't let delayed analysis requests left over from a previous test get loaded
+        delayed_analysis_store = os.path.join(saq.SAQ_HOME, 'var', 'unittest', 'delayed_analysis.db')
+        if os.path.exists(delayed_analysis_store):
+            os.remove(delayed_analysis_store)
+
     def tearDown(self):
         ACEBasicTestCase.tearDown(self)
         self.stop_tracked_engine()
@@ -78,3 +78,319 @@ class RootAnalysisTestCase(ACEBasicTestCase):
         self.assertTrue(root.has_observable(create_observable(F_TEST, 'test')))
         self.assertFalse(root.has_observable(create_observable(F_TEST, 't3st')))
 
+
+    def test_analysis_005_observable_index(self):
+        root = create_root_analysis()
+        root.initialize_storage()
+        fqdn = root.add_observable(F_FQDN, 'www.example.com')
+        url = root.add_observable(F_URL, 'http://www.example.com/')
+        # the same observable is returned for equal values
+        self.assertIs(root.add_observable(F_FQDN, 'WWW.Example.COM'), fqdn)
+        self.assertIs(root.get_observable_by_spec(F_FQDN, 'WWW.EXAMPLE.COM'), fqdn)
+        self.assertIs(root.get_observable_by_spec(F_URL, 'http://www.example.com/'), url)
+        # urls are case sensitive
+        self.assertIsNone(root.get_observable_by_spec(F_URL, 'HTTP://WWW.EXAMPLE.COM/'))
+        # time is part of the key
+        self.assertIsNone(root.get_observable_by_spec(F_FQDN, 'www.example.com', datetime.datetime.now()))
+
+        # changing the value of an observable updates the index
+        fqdn.value = 'mail.example.com'
+        self.assertIsNone(root.get_observable_by_spec(F_FQDN, 'www.example.com'))
+        self.assertIs(root.get_observable_by_spec(F_FQDN, 'mail.example.com'), fqdn)
+
+        # and the index is rebuilt when the root is loaded
+        root.save()
+        root = RootAnalysis(storage_dir=root.storage_dir)
+        root.load()
+        self.assertEquals(root.get_observable_by_spec(F_FQDN, 'MAIL.example.com').id, fqdn.id)
+        self.assertEquals(len(root.all_observables), 2)
+
+    def test_analysis_006_tree_views(self):
+        from saq.modules.test import BasicTestAnalysis
+
+        def _all_analysis(root):
+            result = [ root ]
+            for observable in root.observable_store.values():
+                result.extend([a for a in observable.analysis.values() if a])
+            return result
+
+        def _assert_views(root):
+            self.assertEquals(list(root.all_analysis), _all_analysis(root))
+            self.assertEquals(list(root.all_observables), list(root.observable_store.values()))
+            self.assertEquals(list(root.all), _all_analysis(root) + list(root.observable_store.values()))
+            tags = set()
+            for obj in root.all:
+                tags.update(obj.tags)
+            self.assertEquals(set(root.all_tags), tags)
+
+        root = create_root_analysis()
+        root.initialize_storage()
+        o1 = root.add_observable(F_TEST, 'test_1')
+        o2 = root.add_observable(F_TEST, 'test_2')
+        _assert_views(root)
+
+        # add analysis to the second observable first
+        a2 = BasicTestAnalysis()
+        o2.add_analysis(a2)
+        _assert_views(root)
+        a1 = BasicTestAnalysis()
+        o1.add_analysis(a1)
+        _assert_views(root)
+        self.assertEquals(list(root.all_analysis), [ root, a1, a2 ])
+
+        # the views are read-only
+        with self.assertRaises(AttributeError):
+            root.all_analysis.append(a1)
+
+        o3 = a2.add_observable(F_TEST, 'test_3')
+        a2.add_tag('tag_1')
+        o3.add_tag('tag_2')
+        root.add_tag('tag_3')
+        _assert_views(root)
+        self.assertEquals(set([t.name for t in root.all_tags]), set([ 'tag_1', 'tag_2', 'tag_3' ]))
+
+        expected_ids = [ o.id for o in root.all_observables ]
+        root.save()
+
+        root = RootAnalysis(storage_dir=root.storage_dir)
+        root.load()
+        _assert_views(root)
+        self.assertEquals([ o.id for o in root.all_observables ], expected_ids)
+        self.assertEquals(len(root.all_analysis), 3)
+        self.assertEquals(set([t.name for t in root.all_tags]), set([ 'tag_1', 'tag_2', 'tag_3' ]))
+
+        # changes made after the root is loaded are seen
+        o4 = root.get_observable(o1.id).get_analysis(BasicTestAnalysis).add_observable(F_TEST, 'test_4')
+        o4.add_tag('tag_4')
+        _assert_views(root)
+        self.assertIn(o4, root.all_observables)
+
+    def test_analysis_007_references(self):
+        from saq.analysis import recurse_down, recurse_tree
+        from saq.modules.test import BasicTestAnalysis, TestAnalysis
+
+        root = create_root_analysis()
+        root.initialize_storage()
+        o1 = root.add_observable(F_TEST, 'test_1')
+        a1 = BasicTestAnalysis()
+        o1.add_analysis(a1)
+        o2 = a1.add_observable(F_TEST, 'test_2')
+        a2 = TestAnalysis()
+        o2.add_analysis(a2)
+        # this creates a cycle o1 -> a1 -> o2 -> a2 -> o1
+        a2.add_observable(o1)
+
+        self.assertEquals(root.get_references(o1), (root, a2))
+        self.assertEquals(root.get_references(o2), (a1,))
+        self.assertEquals(root.get_references(a1), (o1,))
+        self.assertEquals(list(root.iterate_all_references(a2)), [ o2 ])
+        self.assertEquals(o1.parents, [ root, a2 ])
+        # equal observables refer to the same thing
+        self.assertEquals(root.get_references(create_observable(F_TEST, 'test_2')), (a1,))
+
+        visited = []
+        recurse_down(o2, visited.append)
+        # callback is called for every reference but each object is only followed once
+        self.assertEquals(visited, [ a1, o1, root, a2, o2 ])
+
+        visited = []
+        recurse_tree(root, visited.append)
+        self.assertEquals(visited, [ root, o1, a1, o2, a2 ])
+
+        # the index is rebuilt when the tree changes
+        o3 = a2.add_observable(F_TEST, 'test_3')
+        self.assertEquals(root.get_references(o3), (a2,))
+
+        root.save()
+        root = RootAnalysis(storage_dir=root.storage_dir)
+        root.load()
+        o1 = root.get_observable(o1.id)
+        a2 = root.get_observable(o2.id).get_analysis(TestAnalysis)
+        self.assertEquals(root.get_references(o1), (root, a2))
+        self.assertEquals(len(root.get_references(a2)), 1)
+
+    def test_analysis_008_journal(self):
+        from saq.modules.test import BasicTestAnalysis
+
+        root = create_root_analysis()
+        root.initialize_storage()
+        o1 = root.add_observable(F_TEST, 'test_1')
+        o2 = root.add_observable(F_TEST, 'test_2')
+        analysis = BasicTestAnalysis()
+        analysis.initialize_details()
+        o1.add_analysis(analysis)
+        root.save()
+        self.assertFalse(os.path.exists(root.journal_path))
+
+        # saving without any changes does not write anything
+        root.save()
+        self.assertFalse(os.path.exists(root.journal_path))
+
+        # only the change is written to the journal
+        o2.add_tag('test')
+        analysis.details['test'] = 'test'
+        root.save()
+        self.assertTrue(os.path.exists(root.journal_path))
+        with open(root.journal_path, 'r') as fp:
+            entries = [json.loads(line) for line in fp]
+        self.assertEquals(len(entries), 2)
+        self.assertEquals(entries[0][RootAnalysis.JOURNAL_OBSERVABLE], o2.id)
+        self.assertTrue(RootAnalysis.JOURNAL_COMMIT in entries[1])
+
+        # an interrupted save is ignored when the journal is loaded
+        with open(root.journal_path, 'a') as fp:
+            fp.write('{{"{}": "{}", "{}": {{"tags": ["te'.format(RootAnalysis.JOURNAL_OBSERVABLE, o1.id,
+                                                               RootAnalysis.JOURNAL_VALUE))
+
+        root = RootAnalysis(storage_dir=root.storage_dir)
+        root.load()
+        self.assertTrue(root.get_observable(o2.id).has_tag('test'))
+        self.assertFalse(root.get_observable(o1.id).tags)
+        self.assertEquals(root.get_observable(o1.id).get_analysis(BasicTestAnalysis).details['test'], 'test')
+
+        # and discarded by the next save
+        root.get_observable(o1.id).add_tag('test')
+        root.save()
+        root = RootAnalysis(storage_dir=root.storage_dir)
+        root.load()
+        self.assertTrue(root.get_observable(o1.id).has_tag('test'))
+        self.assertTrue(root.get_observable(o2.id).has_tag('test'))
+
+        # compacting writes everything to data.json
+        root.compact()
+        self.assertFalse(os.path.exists(root.journal_path))
+        root = RootAnalysis(storage_dir=root.storage_dir)
+        root.load()
+        self.assertTrue(root.get_observable(o1.id).has_tag('test'))
+        self.assertTrue(root.get_observable(o2.id).has_tag('test'))
+
+    def test_analysis_009_details_store(self):
+        from saq.details_store import PACKED_DETAILS_FILE_NAME
+        from saq.modules.test import BasicTestAnalysis
+
+        saved_backend = saq.CONFIG['global']['analysis_details_store']
+        saq.CONFIG['global']['analysis_details_store'] = 'sqlite'
+        try:
+            root = create_root_analysis()
+            root.initialize_storage()
+            root.details = { 'test': 'root' }
+            o1 = root.add_observable(F_TEST, 'test_1')
+            analysis = BasicTestAnalysis()
+            analysis.initialize_details()
+            analysis.details['test'] = 'test'
+            o1.add_analysis(analysis)
+            root.save()
+        finally:
+            saq.CONFIG['global']['analysis_details_store'] = saved_backend
+
+        # all the details are in the packed file
+        ace_dir = os.path.join(root.storage_dir, '.ace')
+        self.assertEquals(os.listdir(ace_dir), [ PACKED_DETAILS_FILE_NAME ])
+
+        # and can be loaded when the default store is used
+        root = RootAnalysis(storage_dir=root.storage_dir)
+        root.load()
+        self.assertEquals(root.get_observable(o1.id).get_analysis(BasicTestAnalysis).details['test'], 'test')
+
+        # migrate to one file per analysis
+        self.assertEquals(root.details_store.migrate('files'), 2)
+        self.assertFalse(os.path.exists(os.path.join(ace_dir, PACKED_DETAILS_FILE_NAME)))
+        self.assertEquals(len(os.listdir(ace_dir)), 2)
+
+        root = RootAnalysis(storage_dir=root.storage_dir)
+        root.load()
+        self.assertEquals(root.get_observable(o1.id).get_analysis(BasicTestAnalysis).details['test'], 'test')
+
+        # and back again
+        self.assertEquals(root.details_store.migrate('sqlite'), 2)
+        self.assertEquals(os.listdir(ace_dir), [ PACKED_DETAILS_FILE_NAME ])
+
+        root = RootAnalysis(storage_dir=root.storage_dir)
+        root.load()
+        analysis = root.get_observable(o1.id).get_analysis(BasicTestAnalysis)
+        self.assertEquals(analysis.details['test'], 'test')
+
+        # details are deleted from the packed file
+        details_path = analysis.external_details_path
+        analysis.reset()
+        self.assertFalse(root.details_store.exists(details_path))
+        self.assertEquals(len(root.details_store.names()), 1)
+
+    def test_analysis_010_lazy_load(self):
+        from saq.modules.test import BasicTestAnalysis
+
+        root = create_root_analysis()
+        root.initialize_storage()
+        o1 = root.add_observable(F_TEST, 'test_1')
+        analysis = BasicTestAnalysis()
+        analysis.initialize_details()
+        o1.add_analysis(analysis)
+        o2 = analysis.add_observable(F_TEST, 'test_2')
+        o2.add_tag('test')
+        root.save()
+
+        # only the root and the observables it references are loaded
+        root = RootAnalysis(storage_dir=root.storage_dir)
+        root.load(lazy=True)
+        self.assertEquals(root.description, EV_ROOT_ANALYSIS_DESCRIPTION)
+        self.assertEquals([o.id for o in root.observables], [ o1.id ])
+        self.assertTrue(isinstance(root._observable_store[o2.id], dict))
+
+        # an observable can be loaded by itself
+        o2 = root.get_observable(o2.id)
+        self.assertTrue(o2.has_tag('test'))
+        self.assertTrue(root._lazy_tree)
+
+        # the analysis of an observable is loaded when it is used
+        o1 = root.get_observable(o1.id)
+        analysis = o1.get_analysis(BasicTestAnalysis)
+        self.assertTrue(analysis.observables[0] is o2)
+        self.assertTrue(root._lazy_tree)
+
+        # and everything is loaded when the observable_store is used
+        self.assertEquals(len(root.observable_store), 2)
+        self.assertFalse(root._lazy_tree)
+
+        # changes to a lazy loaded root are saved
+        root = RootAnalysis(storage_dir=root.storage_dir)
+        root.load(lazy=True)
+        root.get_observable(o2.id).add_tag('lazy')
+        root.save()
+
+        root = RootAnalysis(storage_dir=root.storage_dir)
+        root.load()
+        self.assertTrue(root.get_observable(o2.id).has_tag('lazy'))
+        self.assertTrue(root.get_observable(o1.id).get_analysis(BasicTestAnalysis).details['test_result'])
+
+    def test_analysis_011_stale_journal(self):
+        root = create_root_analysis()
+        root.initialize_storage()
+        o1 = root.add_observable(F_TEST, 'test_1')
+        for i in range(10):
+            root.add_observable(F_TEST, 'test_{}'.format(i + 2))
+        root.save()
+
+        o1.add_tag('test')
+        root.save()
+        with open(root.journal_path, 'rb') as fp:
+            journal = fp.read()
+
+        # data.json is rewritten but the journal is not removed (ace stopped between the two)
+        o1.add_tag('test_2')
+        root.compact()
+        with open(root.journal_path, 'wb') as fp:
+            fp.write(journal)
+
+        # the journal belongs to the previous data.json and is ignored
+        root = RootAnalysis(storage_dir=root.storage_dir)
+        root.load()
+        self.assertTrue(root.get_observable(o1.id).has_tag('test'))
+        self.assertTrue(root.get_observable(o1.id).has_tag('test_2'))
+
+        # and discarded by the next save
+        root.get_observable(o1.id).add_tag('test_3')
+        root.save()
+        root = RootAnalysis(storage_dir=root.storage_dir)
+        root.load()
+        self.assertTrue(root.get_observable(o1.id).has_tag('test_2'))
+        self.assertTrue(root.get_observable(o1.id).has_tag('test_3'))
@@ -0,0 +1,81 @@
+# vim: sw=4:ts=4:et
+
+from saq.test import *
+from saq.backpressure import *
+
+class BackpressureTestCase(ACEBasicTestCase):
+
+    def create_controller(self):
+        return BackpressureController(2, initial_interval=1, maximum_interval=8, maximum_batch_size=4)
+
+    def test_backpressure_000_saturated(self):
+        controller = self.create_controller()
+        controller.set_busy(0, True)
+        controller.set_busy(1, True)
+        controller.set_engine_depth(2)
+        self.assertEquals(controller.utilization, 1.0)
+
+        self.assertEquals(controller.update(0), BACKPRESSURE_STATE_SATURATED)
+        self.assertEquals(controller.interval, 2.0)
+        self.assertEquals(controller.batch_size, 1)
+        self.assertEquals(controller.holds, 1)
+
+        for _ in range(10):
+            controller.update(0)
+
+        # never goes past the maximum
+        self.assertEquals(controller.interval, 8.0)
+        self.assertEquals(controller.batch_size, 1)
+
+    def test_backpressure_001_idle(self):
+        controller = self.create_controller()
+        self.assertEquals(controller.update(0), BACKPRESSURE_STATE_IDLE)
+        self.assertEquals(controller.interval, 0.5)
+        self.assertEquals(controller.batch_size, 4)
+
+        for _ in range(10):
+            controller.update(0)
+
+        self.assertEquals(controller.interval, 0.0)
+        self.assertEquals(controller.batch_size, 4)
+
+        # nothing was collected so we go back to the normal polling interval
+        self.assertEquals(controller.update(0, collected=False), BACKPRESSURE_STATE_IDLE)
+        self.assertEquals(controller.interval, 1.0)
+
+    def test_backpressure_002_normal(self):
+        controller = self.create_controller()
+        controller.set_busy(0, True)
+        # one process manager is idle but there is work waiting
+        self.assertEquals(controller.update(1), BACKPRESSURE_STATE_NORMAL)
+        self.assertEquals(controller.interval, 1.0)
+        self.assertEquals(controller.batch_size, 2)
+        self.assertEquals(controller.utilization, 0.5)
+
+        metrics = controller.metrics()
+        self.assertTrue(('backpressure_state', { 'state': 'normal' }, 1) in metrics)
+        self.assertTrue(('backpressure_state', { 'state': 'saturated' }, 0) in metrics)
+
+    def test_backpressure_003_recover(self):
+        controller = self.create_controller()
+        controller.set_busy(0, True)
+        controller.set_busy(1, True)
+        controller.set_engine_depth(2)
+        for _ in range(10):
+            controller.update(0)
+
+        self.assertEquals(controller.interval, 8.0)
+        self.assertEquals(controller.batch_size, 1)
+
+        # the process managers are draining what is waiting
+        controller.set_busy(1, False)
+        self.assertEquals(controller.update(0), BACKPRESSURE_STATE_NORMAL)
+        self.assertEquals(controller.interval, 4.0)
+        self.assertEquals(controller.batch_size, 2)
+
+        for _ in range(10):
+            controller.update(0)
+
+        # back to where it started
+        self.assertEquals(controller.interval, 1.0)
+        self.assertEquals(controller.batch_size, 2)
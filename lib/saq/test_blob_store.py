@@ -0,0 +1,111 @@
+# vim: sw=4:ts=4:et
+
+import os, os.path
+import shutil
+import uuid
+
+import saq
+
+from saq.analysis import RootAnalysis
+from saq.blob_store import get_blob_store, copy_file
+from saq.constants import *
+from saq.test import *
+
+class BlobStoreTestCase(ACEBasicTestCase):
+
+    def setUp(self, *args, **kwargs):
+        super().setUp(*args, **kwargs)
+        self.saved_blob_store_enabled = saq.CONFIG['global']['blob_store_enabled']
+        self.saved_blob_store_dir = saq.CONFIG['global']['blob_store_dir']
+
+        # each test gets its own blob store on the same file system as the test roots
+        self.blob_store_dir = os.path.join(saq.SAQ_HOME, 'var', 'test', 'blobs-{}'.format(uuid.uuid4()))
+        saq.CONFIG['global']['blob_store_enabled'] = 'yes'
+        saq.CONFIG['global']['blob_store_dir'] = self.blob_store_dir
+
+        # and content that no other test has linked to
+        self.test_data = 'test data {}'.format(uuid.uuid4()).encode() * 1024
+        self.roots = []
+
+    def tearDown(self, *args, **kwargs):
+        for root in self.roots:
+            if os.path.isdir(root.storage_dir):
+                shutil.rmtree(root.storage_dir)
+
+        if os.path.isdir(self.blob_store_dir):
+            shutil.rmtree(self.blob_store_dir)
+
+        saq.CONFIG['global']['blob_store_enabled'] = self.saved_blob_store_enabled
+        saq.CONFIG['global']['blob_store_dir'] = self.saved_blob_store_dir
+        super().tearDown(*args, **kwargs)
+
+    def create_file_root(self, file_name='sample.bin'):
+        root = create_root_analysis(uuid=str(uuid.uuid4()))
+        root.initialize_storage()
+        self.roots.append(root)
+        with open(os.path.join(root.storage_dir, file_name), 'wb') as fp:
+            fp.write(self.test_data)
+
+        observable = root.add_observable(F_FILE, file_name)
+        observable.compute_hashes()
+        return root, observable
+
+    def test_blob_store_000_store_files(self):
+        root_1, o1 = self.create_file_root()
+        root_2, o2 = self.create_file_root()
+
+        # the first copy becomes the blob
+        self.assertEquals(root_1.store_files(), 0)
+        self.assertEquals(root_2.store_files(), len(self.test_data))
+        self.assertTrue(os.path.samefile(o1.path, o2.path))
+        # storing them again does nothing
+        self.assertEquals(root_2.store_files(), 0)
+
+        stats = get_blob_store().stats()
+        self.assertEquals(stats['blobs'], 1)
+        self.assertEquals(stats['references'], 2)
+        self.assertEquals(stats['saved_bytes'], len(self.test_data))
+        self.assertEquals(stats['deduplicated_files'], 1)
+        self.assertEquals(stats['deduplicated_bytes'], len(self.test_data))
+
+    def test_blob_store_001_copy_file(self):
+        root, o1 = self.create_file_root()
+        target_path = os.path.join(root.storage_dir, 'copy.bin')
+        copy_file(o1.path, target_path)
+        self.assertTrue(os.path.samefile(o1.path, target_path))
+
+        stats = get_blob_store().stats()
+        self.assertEquals(stats['linked_files'], 1)
+        self.assertEquals(stats['linked_bytes'], len(self.test_data))
+
+    def test_blob_store_002_cleanup(self):
+        from saq.modules.test import BasicTestAnalysis
+
+        root_1, o1 = self.create_file_root()
+        # a file added by analysis is removed when the root is archived
+        with open(os.path.join(root_1.storage_dir, 'extracted.bin'), 'wb') as fp:
+            fp.write(self.test_data + b'extracted')
+
+        analysis = BasicTestAnalysis()
+        analysis.initialize_details()
+        o1.add_analysis(analysis)
+        o2 = analysis.add_observable(F_FILE, 'extracted.bin')
+        o2.compute_hashes()
+        root_1.store_files()
+        root_1.save()
+
+        blob_store = get_blob_store()
+        self.assertTrue(os.path.exists(blob_store.blob_path(o2.sha256_hash)))
+        root_1.archive()
+        self.assertFalse(os.path.exists(o2.path))
+        self.assertFalse(os.path.exists(blob_store.blob_path(o2.sha256_hash)))
+        self.assertTrue(os.path.exists(blob_store.blob_path(o1.sha256_hash)))
+
+        # deleting the storage directory of a root (see ace cleanup-alerts) leaves the blob for collect()
+        root_2, o3 = self.create_file_root()
+        root_2.store_files()
+        shutil.rmtree(root_1.storage_dir)
+        self.assertEquals(blob_store.collect(), (0, 0))
+        shutil.rmtree(root_2.storage_dir)
+        self.assertEquals(blob_store.collect(), (1, len(self.test_data)))
+        self.assertEquals(blob_store.stats()['blobs'], 0)
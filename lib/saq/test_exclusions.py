@@ -0,0 +1,52 @@
+# vim: sw=4:ts=4:et
+
+import unittest
+
+from saq.constants import *
+from saq.exclusions import ObservableExclusions
+from saq.observables import create_observable
+from saq.test import *
+
+class ExclusionsTestCase(ACEBasicTestCase):
+
+    def test_exclusions_000_exact(self):
+        exclusions = ObservableExclusions()
+        self.assertTrue(exclusions.add(F_FQDN, 'evil.com'))
+        # adding the same exclusion twice does nothing
+        self.assertFalse(exclusions.add(F_FQDN, 'evil.com'))
+        self.assertEquals(exclusions[F_FQDN], ['evil.com'])
+
+        self.assertTrue(exclusions.is_excluded(create_observable(F_FQDN, 'evil.com')))
+        self.assertFalse(exclusions.is_excluded(create_observable(F_FQDN, 'www.evil.com')))
+        self.assertFalse(exclusions.is_excluded(create_observable(F_HOSTNAME, 'evil.com')))
+
+    def test_exclusions_001_cidr(self):
+        exclusions = ObservableExclusions()
+        exclusions.add(F_IPV4, '10.0.0.0/8')
+        exclusions.add(F_IPV4, '10.1.0.0/16') # overlaps with the first one
+        exclusions.add(F_IPV4, '192.168.1.0/24')
+        exclusions.add(F_IPV4, '1.2.3.4')
+
+        self.assertTrue(exclusions.is_excluded(create_observable(F_IPV4, '10.1.2.3')))
+        self.assertTrue(exclusions.is_excluded(create_observable(F_IPV4, '10.255.255.255')))
+        self.assertTrue(exclusions.is_excluded(create_observable(F_IPV4, '192.168.1.1')))
+        self.assertTrue(exclusions.is_excluded(create_observable(F_IPV4, '1.2.3.4')))
+        self.assertFalse(exclusions.is_excluded(create_observable(F_IPV4, '11.0.0.0')))
+        self.assertFalse(exclusions.is_excluded(create_observable(F_IPV4, '192.168.2.1')))
+        self.assertFalse(exclusions.is_excluded(create_observable(F_IPV4, '1.2.3.5')))
+
+        # adding a range after we've already matched
+        exclusions.add(F_IPV4, '11.0.0.0/8')
+        self.assertTrue(exclusions.is_excluded(create_observable(F_IPV4, '11.0.0.0')))
+
+    def test_exclusions_002_matches_linear_scan(self):
+        # the compiled lookup should agree with Observable.matches
+        exclusions = ObservableExclusions()
+        values = [ '10.0.0.0/8', '172.16.0.0/12', '8.8.8.8', '192.168.0.0/16', '4.4.4.0/30' ]
+        for value in values:
+            exclusions.add(F_IPV4, value)
+
+        for address in [ '10.0.0.1', '172.31.255.255', '172.32.0.0', '8.8.8.8', '8.8.8.9', '4.4.4.3', '4.4.4.4' ]:
+            observable = create_observable(F_IPV4, address)
+            expected = any([observable.matches(value) for value in values])
+            self.assertEquals(exclusions.is_excluded(observable), expected)
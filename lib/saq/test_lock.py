@@ -175,3 +175,47 @@ class LockTestCase(ACEBasicTestCase):
             if p:
                 p.terminate()
                 p.join()
+
+    @modify_logging_level(logging.WARNING)
+    def test_lock_005_manager_backend(self):
+        from saq.lock import LOCAL_LOCK_BACKEND_MANAGER, local_lock_table_backend
+        initialize_locking(LOCAL_LOCK_BACKEND_MANAGER)
+        try:
+            self.assertEquals(local_lock_table_backend(), LOCAL_LOCK_BACKEND_MANAGER)
+            lock = TestLock()
+            self.assertTrue(lock.lock())
+            self.assertTrue(lock.is_locked())
+            self.assertFalse(lock.lock())
+            self.assertTrue(lock.refresh_lock())
+            self.assertTrue(lock.unlock())
+            self.assertFalse(lock.is_locked())
+        finally:
+            initialize_locking(saq.CONFIG['global']['local_lock_backend'])
+
+    @reset_config
+    @modify_logging_level(logging.ERROR)
+    def test_lock_006_shared_memory_table(self):
+        from saq.lock import SharedMemoryLockTable
+        table = SharedMemoryLockTable(64, 2)
+        keys = [str(uuid.uuid4()) for _ in range(32)]
+        for key in keys:
+            table[key] = (key, time.time())
+
+        # delete every other key and make sure the rest are still reachable
+        for key in keys[::2]:
+            del table[key]
+
+        for key in keys[1::2]:
+            self.assertEquals(table[key], (key, table[key][1]))
+
+        for key in keys[::2]:
+            with self.assertRaises(KeyError):
+                table[key]
+
+        # expired locks are removed when the table fills up
+        saq.CONFIG['global']['lock_timeout'] = '00:00'
+        for _ in range(128):
+            key = str(uuid.uuid4())
+            table[key] = (key, time.time())
+
+        self.assertLessEqual(sum(table.counts), 64)
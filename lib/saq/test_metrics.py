@@ -0,0 +1,56 @@
+# vim: sw=4:ts=4:et
+
+import os.path
+import urllib.request
+
+from multiprocessing import Process
+
+from saq.metrics import SharedMetrics, MetricsServer, render_gauges, METRIC_COUNTER, METRIC_HISTOGRAM
+from saq.test import *
+
+class MetricsTestCase(ACEBasicTestCase):
+
+    def test_metrics_000_shared(self):
+        metrics = SharedMetrics(3, 16)
+
+        def p1(slot):
+            metrics.set_slot(slot)
+            for i in range(100):
+                metrics.increment('roots_analyzed')
+                metrics.observe('module_analysis_seconds', 0.02, { 'module': 'test' })
+
+        processes = [Process(target=p1, args=(slot,)) for slot in [ 1, 2 ]]
+        for p in processes:
+            p.start()
+        for p in processes:
+            p.join()
+
+        # values are added up across all the processes
+        collected = { (name, labels): (kind, values) for name, kind, labels, values in metrics.collect() }
+        self.assertEquals(collected[('roots_analyzed', '')], (METRIC_COUNTER, 200))
+        kind, values = collected[('module_analysis_seconds', 'module="test"')]
+        self.assertEquals(kind, METRIC_HISTOGRAM)
+        self.assertEquals(values[-1], 200) # count
+        self.assertAlmostEqual(values[-2], 4.0) # sum
+
+        output = metrics.render(extra_labels={ 'engine': 'test' })
+        self.assertTrue('ace_roots_analyzed{engine="test"} 200' in output)
+        self.assertTrue('ace_module_analysis_seconds_bucket{engine="test",module="test",le="0.025"} 200' in output)
+        self.assertTrue('ace_module_analysis_seconds_count{engine="test",module="test"} 200' in output)
+
+    def test_metrics_001_server(self):
+        metrics = SharedMetrics(1, 16)
+        metrics.increment('lock_failures', 3)
+
+        def _render():
+            return render_gauges([ ('work_queue_depth', None, 7) ]) + metrics.render()
+
+        server = MetricsServer('127.0.0.1:0', _render)
+        server.start()
+        try:
+            url = 'http://127.0.0.1:{}/metrics'.format(server.server.server_address[1])
+            output = urllib.request.urlopen(url).read().decode()
+            self.assertTrue('ace_work_queue_depth 7' in output)
+            self.assertTrue('ace_lock_failures 3' in output)
+        finally:
+            server.stop()
@@ -0,0 +1,73 @@
+# vim: sw=4:ts=4:et
+
+import threading
+import time
+
+from saq.constants import *
+from saq.observables import create_observable
+from saq.prefetch import IOPrefetcher, IOCancelledError
+from saq.test import *
+
+class _TestModule(object):
+    def __init__(self, io_concurrency=1, delay=0.1):
+        self.config_section = 'test_module'
+        self.io_concurrency = io_concurrency
+        self.delay = delay
+        self.cancel_analysis_flag = False
+        self.lock = threading.Lock()
+        self.executing = 0
+        self.max_executing = 0
+
+    def execute_io(self, observable):
+        with self.lock:
+            self.executing += 1
+            self.max_executing = max(self.max_executing, self.executing)
+
+        time.sleep(self.delay)
+
+        with self.lock:
+            self.executing -= 1
+
+        if observable.value == '0.0.0.0':
+            raise ValueError('invalid address')
+
+        return observable.value
+
+class PrefetchTestCase(ACEBasicTestCase):
+
+    def test_prefetch_000_concurrency(self):
+        prefetcher = IOPrefetcher(4)
+        try:
+            module = _TestModule(io_concurrency=2)
+            observables = [create_observable(F_IPV4, '1.2.3.{}'.format(i)) for i in range(8)]
+            for observable in observables:
+                prefetcher.submit(module, observable)
+
+            start = time.time()
+            for observable in observables:
+                self.assertEquals(prefetcher.get(module, observable), observable.value)
+
+            # 8 requests 2 at a time
+            self.assertEquals(module.max_executing, 2)
+            self.assertLess(time.time() - start, 0.1 * 8)
+
+            # errors from execute_io come out of get()
+            with self.assertRaises(ValueError):
+                prefetcher.get(module, create_observable(F_IPV4, '0.0.0.0'))
+
+            prefetcher.reset()
+            self.assertEquals(len(prefetcher), 0)
+        finally:
+            prefetcher.shutdown()
+
+    def test_prefetch_001_cancel(self):
+        prefetcher = IOPrefetcher(1)
+        try:
+            module = _TestModule(delay=1)
+            observable = create_observable(F_IPV4, '1.2.3.4')
+            prefetcher.submit(module, observable)
+            module.cancel_analysis_flag = True
+            with self.assertRaises(IOCancelledError):
+                prefetcher.get(module, observable)
+        finally:
+            prefetcher.shutdown()
@@ -0,0 +1,51 @@
+# vim: sw=4:ts=4:et
+
+import os
+import os.path
+import time
+
+from saq.test import *
+from saq.performance import track_execution_time
+from saq.profiler import SamplingProfiler
+
+def _busy(seconds):
+    end = time.time() + seconds
+    while time.time() < end:
+        pass
+
+class ProfilerTestCase(ACEBasicTestCase):
+
+    def test_profiler_000_samples(self):
+        profiler = SamplingProfiler(interval=0.001)
+        profiler.start()
+        self.assertTrue(profiler.running)
+        profiler.context = ('analysis_module_test', 'test')
+        _busy(0.2)
+        profiler.context = None
+        _busy(0.1)
+        profiler.stop()
+        self.assertFalse(profiler.running)
+        self.assertTrue(profiler.sample_count > 0)
+
+        lines = profiler.folded().splitlines()
+        self.assertTrue(any([line.startswith('analysis_module_test;test;') for line in lines]))
+        self.assertTrue(any([line.startswith('engine;') for line in lines]))
+        self.assertTrue(all(['_busy' in line for line in lines if line.startswith('analysis_module_test;')]))
+        self.assertEquals(sum([int(line.rsplit(' ', 1)[1]) for line in lines]), profiler.sample_count)
+
+        path = os.path.join(saq.SAQ_HOME, 'var', 'test_profiler.folded')
+        try:
+            profiler.write(path)
+            with open(path, 'r') as fp:
+                self.assertEquals(fp.read(), profiler.folded())
+        finally:
+            if os.path.exists(path):
+                os.remove(path)
+
+    def test_profiler_001_track_execution_time(self):
+        @track_execution_time
+        def _test(value):
+            return value
+
+        self.assertEquals(_test(1), 1)
+        self.assertEquals(_test.__name__, '_test')
@@ -0,0 +1,50 @@
+# vim: sw=4:ts=4:et
+
+import time
+
+from saq.scheduler import WorkScheduler
+from saq.test import *
+
+class SchedulerTestCase(ACEBasicTestCase):
+
+    def test_scheduler_000_weighted(self):
+        scheduler = WorkScheduler([ ('high', 4), ('low', 1) ])
+        for i in range(100):
+            scheduler.put('low{}'.format(i), 'low')
+        for i in range(100):
+            scheduler.put('high{}'.format(i), 'high')
+
+        self.assertEquals(len(scheduler), 200)
+
+        # the first 50 items should be split 4 to 1
+        items = [scheduler.get() for _ in range(50)]
+        self.assertEquals(len([x for x in items if x.startswith('high')]), 40)
+        self.assertEquals(len([x for x in items if x.startswith('low')]), 10)
+
+        # each lane is still FIFO
+        self.assertEquals([x for x in items if x.startswith('low')], ['low{}'.format(i) for i in range(10)])
+
+        # once the high lane is empty the low lane gets everything
+        while len(scheduler):
+            scheduler.get()
+
+        self.assertIsNone(scheduler.get())
+        metrics = scheduler.metrics()
+        self.assertEquals(metrics['high']['dequeued'], 100)
+        self.assertEquals(metrics['low']['dequeued'], 100)
+        self.assertEquals(metrics['low']['depth'], 0)
+
+    def test_scheduler_001_starvation(self):
+        scheduler = WorkScheduler([ ('high', 1000), ('low', 1) ], default_lane='high', max_wait=1)
+        scheduler.put('starved', 'low')
+        # invalid lanes go to the default lane
+        scheduler.put('high', 'invalid')
+        self.assertEquals(scheduler.get(), 'high')
+
+        for i in range(100):
+            scheduler.put('high{}'.format(i))
+
+        time.sleep(1)
+        # the low lane item has been waiting too long
+        self.assertEquals(scheduler.get(), 'starved')
+        self.assertGreaterEqual(scheduler.metrics()['low']['max_wait'], 1)
@@ -0,0 +1,43 @@
+# vim: sw=4:ts=4:et
+
+import datetime
+import json
+
+from saq.test import *
+from saq.analysis import _JSONEncoder
+from saq.serialization import CODECS, JSONCodec, create_codec
+
+TEST_DATA = {
+    'datetime': datetime.datetime(2017, 11, 11, hour=7, minute=36, second=1, microsecond=1),
+    'binary_string': '你好，世界'.encode('utf-8'),
+    'unicode': '你好，世界',
+    'url': 'http://www.example.com/',
+    'dict': { 'list': [ 1, 2.5, None, True ] },
+    'big_int': 2 ** 70,
+    'null': None }
+
+class SerializationTestCase(ACEBasicTestCase):
+
+    def test_serialization_000_json_compatible(self):
+        # the json codec produces exactly what json.dumps does
+        codec = JSONCodec()
+        self.assertEquals(codec.encode(TEST_DATA), json.dumps(TEST_DATA, cls=_JSONEncoder).encode('utf8'))
+        self.assertEquals(codec.decode(codec.encode(TEST_DATA)), json.loads(json.dumps(TEST_DATA, cls=_JSONEncoder)))
+
+    def test_serialization_001_codecs(self):
+        expected = json.loads(json.dumps(TEST_DATA, cls=_JSONEncoder))
+        for codec_class in CODECS:
+            if not codec_class.available():
+                continue
+
+            codec = codec_class()
+            # every codec reads what the others write
+            for other_class in CODECS:
+                if other_class.available():
+                    self.assertEquals(other_class().decode(codec.encode(TEST_DATA)), expected)
+
+    def test_serialization_002_fallback(self):
+        self.assertTrue(isinstance(create_codec('json'), JSONCodec))
+        self.assertTrue(create_codec('auto').available())
+        # unknown codecs fall back to json
+        self.assertEquals(create_codec('unknown').name, 'json')
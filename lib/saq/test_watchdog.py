@@ -0,0 +1,101 @@
+# vim: sw=4:ts=4:et
+
+import os.path
+import threading
+import time
+
+from saq.test import *
+from saq.watchdog import AnalysisWatchdog, DEADLINE_ENFORCEMENT_NONE, DEADLINE_ENFORCEMENT_CANCEL, \
+                         DEADLINE_ENFORCEMENT_KILL
+
+class _TestModule(object):
+    def __init__(self):
+        self.cancel_event = threading.Event()
+
+    def cancel_analysis(self):
+        self.cancel_event.set()
+
+    def __str__(self):
+        return 'TestModule'
+
+class WatchdogTestCase(ACEBasicTestCase):
+
+    def test_watchdog_000_clear(self):
+        watchdog = AnalysisWatchdog(0, enforcement=DEADLINE_ENFORCEMENT_CANCEL, hard_time=1)
+        try:
+            module = _TestModule()
+            deadline = watchdog.register(module, 'target')
+            watchdog.clear(deadline)
+            # a cleared deadline is never enforced
+            self.assertFalse(module.cancel_event.wait(2))
+            self.assertFalse(deadline.enforced)
+            self.assertEquals(watchdog.hung_analysis, [])
+        finally:
+            watchdog.stop()
+
+    def test_watchdog_001_cancel(self):
+        record_path = os.path.join(saq.SAQ_HOME, 'var', 'test_watchdog.log')
+        if os.path.exists(record_path):
+            os.remove(record_path)
+
+        watchdog = AnalysisWatchdog(0, enforcement=DEADLINE_ENFORCEMENT_CANCEL, hard_time=1, record_path=record_path)
+        try:
+            module = _TestModule()
+            # a bunch of quick executions that finish on time
+            for _ in range(100):
+                watchdog.clear(watchdog.register(module, 'quick target'))
+
+            deadline = watchdog.register(module, 'slow target', 'root_uuid')
+            self.assertTrue(module.cancel_event.wait(5))
+            watchdog.clear(deadline)
+            self.assertTrue(deadline.enforced)
+            self.assertEquals(watchdog.hung_analysis, [ deadline ])
+
+            with open(record_path, 'r') as fp:
+                record = fp.read()
+
+            self.assertTrue('TestModule' in record)
+            self.assertTrue('slow target' in record)
+            self.assertTrue('root_uuid' in record)
+        finally:
+            watchdog.stop()
+            if os.path.exists(record_path):
+                os.remove(record_path)
+
+    def test_watchdog_002_no_enforcement(self):
+        watchdog = AnalysisWatchdog(0, enforcement=DEADLINE_ENFORCEMENT_NONE, hard_time=1)
+        try:
+            module = _TestModule()
+            deadline = watchdog.register(module, 'target')
+            # warnings only
+            self.assertFalse(module.cancel_event.wait(2))
+            watchdog.clear(deadline)
+            self.assertFalse(deadline.enforced)
+        finally:
+            watchdog.stop()
+
+    def test_watchdog_003_kill(self):
+        handler_path = os.path.join(saq.SAQ_HOME, 'var', 'test_watchdog.killed')
+        if os.path.exists(handler_path):
+            os.remove(handler_path)
+
+        # the process is killed so this has to happen in a child process
+        pid = os.fork()
+        if pid == 0:
+            def _kill_handler(deadline):
+                with open(handler_path, 'w') as fp:
+                    fp.write(deadline.root_uuid)
+
+            watchdog = AnalysisWatchdog(0, enforcement=DEADLINE_ENFORCEMENT_KILL, hard_time=1, 
+                                        kill_handler=_kill_handler)
+            watchdog.register(_TestModule(), 'target', 'root_uuid')
+            time.sleep(10)
+            os._exit(0)
+
+        _, status = os.waitpid(pid, 0)
+        self.assertEquals(os.WEXITSTATUS(status), 1)
+        # the engine uses the kill handler to checkpoint the root and release the lock before the process exits
+        with open(handler_path, 'r') as fp:
+            self.assertEquals(fp.read(), 'root_uuid')
+
+        os.remove(handler_path)
@@ -0,0 +1,61 @@
+# vim: sw=4:ts=4:et
+
+import os
+import os.path
+import time
+
+from saq.test import *
+from saq.zygote import Zygote
+
+def _child_target(slot, stop_event):
+    with open(os.path.join(saq.SAQ_HOME, 'var', 'test_zygote_{}'.format(slot)), 'w') as fp:
+        fp.write(str(os.getpid()))
+
+    stop_event.wait(30)
+
+class ZygoteTestCase(ACEBasicTestCase):
+
+    def setUp(self, *args, **kwargs):
+        super().setUp(*args, **kwargs)
+        for slot in range(2):
+            path = os.path.join(saq.SAQ_HOME, 'var', 'test_zygote_{}'.format(slot))
+            if os.path.exists(path):
+                os.remove(path)
+
+    def wait_for_file(self, path):
+        for _ in range(100):
+            if os.path.exists(path) and os.path.getsize(path):
+                return True
+            time.sleep(0.1)
+        return False
+
+    def test_zygote_000_fork_and_stop(self):
+        zygote = Zygote(_child_target, 2)
+        zygote.start()
+        try:
+            child = zygote.fork(0)
+            path = os.path.join(saq.SAQ_HOME, 'var', 'test_zygote_0')
+            self.assertTrue(self.wait_for_file(path))
+            with open(path, 'r') as fp:
+                self.assertEquals(int(fp.read()), child.pid)
+
+            # the child is a grandchild of this process
+            self.assertNotEquals(child.pid, zygote.process.pid)
+            self.assertTrue(child.is_alive())
+
+            # stopping one slot does not affect the other
+            other = zygote.fork(1)
+            child.stop()
+            child.join(10)
+            self.assertFalse(child.is_alive())
+            self.assertEquals(child.exitcode, 0)
+            self.assertTrue(other.is_alive())
+
+            # the slot can be used again
+            child = zygote.fork(0)
+            self.assertTrue(child.is_alive())
+        finally:
+            zygote.shutdown(timeout=10)
+
+        self.assertFalse(child.is_alive())
+        self.assertFalse(other.is_alive())
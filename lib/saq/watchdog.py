@@ -0,0 +1,230 @@
+# vim: sw=4:ts=4:et:cc=120
+#
+# analysis module deadline monitoring
+#
+
+import datetime
+import heapq
+import itertools
+import logging
+import os
+import threading
+import time
+
+from saq.error import report_exception
+
+# what to do when an analysis module runs past the hard deadline
+DEADLINE_ENFORCEMENT_NONE = 'none'
+DEADLINE_ENFORCEMENT_CANCEL = 'cancel'
+DEADLINE_ENFORCEMENT_KILL = 'kill'
+VALID_DEADLINE_ENFORCEMENT = [ DEADLINE_ENFORCEMENT_NONE, DEADLINE_ENFORCEMENT_CANCEL, DEADLINE_ENFORCEMENT_KILL ]
+
+# how often (in seconds) we keep warning about a module that is still running past the deadline
+WARNING_REPEAT_INTERVAL = 10
+
+class AnalysisDeadline(object):
+    """Tracks a single execution of an analysis module against a target."""
+    def __init__(self, analysis_module, target, root_uuid, warning_time, hard_time):
+        self.analysis_module = analysis_module
+        self.target = target
+        self.root_uuid = root_uuid
+        self.start_time = time.time()
+        self.warning_time = warning_time # seconds after start_time to start warning
+        self.hard_time = hard_time # seconds after start_time to enforce (None if not enforced)
+        self.cleared = False
+        self.enforced = False
+
+    @property
+    def elapsed(self):
+        return time.time() - self.start_time
+
+    def __str__(self):
+        return "analysis deadline for {} analyzing {} in {}".format(self.analysis_module, self.target, self.root_uuid)
+
+class AnalysisWatchdog(object):
+    """A single thread that watches the analysis modules executing in this process.
+
+       Deadlines are kept in a heap ordered by the next time they need attention. Clearing a deadline only marks it
+       so registering and clearing is cheap; cleared entries are discarded when they reach the top of the heap."""
+
+    def __init__(self, warning_time, enforcement=DEADLINE_ENFORCEMENT_NONE, hard_time=None, record_path=None,
+                 kill_handler=None):
+        assert enforcement in VALID_DEADLINE_ENFORCEMENT
+        # number of seconds before we start warning about a module
+        self.warning_time = warning_time
+        # what we do when a module runs past hard_time seconds
+        self.enforcement = enforcement
+        self.hard_time = hard_time if enforcement != DEADLINE_ENFORCEMENT_NONE else None
+        # optional file that hung analysis is recorded to
+        self.record_path = record_path
+        # optional function called with the AnalysisDeadline (on the watchdog thread) right before the process is killed
+        self.kill_handler = kill_handler
+
+        self.heap = [] # of tuple(when, sequence, AnalysisDeadline)
+        self.sequence = itertools.count()
+        self.condition = threading.Condition()
+        self.thread = None
+        self.thread_pid = None
+        self.shutdown = False
+
+        # the list of AnalysisDeadline objects that were enforced
+        self.hung_analysis = []
+
+    def start(self):
+        """Starts the watchdog thread for the current process. Safe to call more than once."""
+        # threads do not survive fork so each process manager ends up with it's own thread
+        if self.thread and self.thread_pid == os.getpid() and self.thread.is_alive():
+            return
+
+        # anything inherited from the parent process is discarded (including the lock which may have been held)
+        self.condition = threading.Condition()
+        self.heap = []
+        self.shutdown = False
+        self.thread_pid = os.getpid()
+        self.thread = threading.Thread(target=self.loop, name="Analysis Watchdog")
+        self.thread.daemon = True
+        self.thread.start()
+        logging.debug("started analysis watchdog on process {}".format(self.thread_pid))
+
+    def stop(self):
+        with self.condition:
+            self.shutdown = True
+            self.condition.notify()
+
+        if self.thread and self.thread_pid == os.getpid():
+            self.thread.join()
+
+        self.thread = None
+
+    def register(self, analysis_module, target, root_uuid=None):
+        """Starts tracking the execution of the given analysis module. Returns an AnalysisDeadline to pass to clear()."""
+        self.start()
+
+        deadline = AnalysisDeadline(analysis_module, target, root_uuid, self.warning_time, self.hard_time)
+        when = deadline.start_time + self.warning_time
+        if self.hard_time is not None:
+            when = min(when, deadline.start_time + self.hard_time)
+
+        with self.condition:
+            # throw away anything that has already completed so the heap stays small
+            while self.heap and self.heap[0][2].cleared:
+                heapq.heappop(self.heap)
+
+            heapq.heappush(self.heap, (when, next(self.sequence), deadline))
+            # only wake up the watchdog if this is now the next thing it needs to look at
+            if self.heap[0][2] is deadline:
+                self.condition.notify()
+
+        return deadline
+
+    def clear(self, deadline):
+        """Stops tracking the given AnalysisDeadline."""
+        deadline.cleared = True
+
+    def loop(self):
+        while True:
+            try:
+                if not self.execute():
+                    break
+            except Exception as e:
+                logging.error("uncaught exception in analysis watchdog: {}".format(e))
+                report_exception()
+                time.sleep(1)
+
+    def execute(self):
+        """Waits for the next deadline and handles it. Returns False when the watchdog should stop."""
+        with self.condition:
+            while not self.shutdown:
+                # throw away anything that has already completed
+                while self.heap and self.heap[0][2].cleared:
+                    heapq.heappop(self.heap)
+
+                if not self.heap:
+                    self.condition.wait()
+                    continue
+
+                timeout = self.heap[0][0] - time.time()
+                if timeout <= 0:
+                    when, _, deadline = heapq.heappop(self.heap)
+                    break
+
+                self.condition.wait(timeout)
+
+            if self.shutdown:
+                return False
+
+        next_time = self.check_deadline(deadline)
+        if next_time is not None:
+            with self.condition:
+                heapq.heappush(self.heap, (next_time, next(self.sequence), deadline))
+
+        return True
+
+    def check_deadline(self, deadline):
+        """Handles a deadline that has come due. Returns the next time to check it, or None to stop tracking it."""
+        if deadline.cleared:
+            return None
+
+        elapsed = deadline.elapsed
+
+        if deadline.hard_time is not None and elapsed >= deadline.hard_time:
+            self.enforce(deadline, elapsed)
+            return None
+
+        if elapsed >= deadline.warning_time:
+            logging.warning("excessive time - analysis module {} has been analyzing {} for {} seconds".format(
+                            deadline.analysis_module, deadline.target, elapsed))
+
+        next_time = time.time() + WARNING_REPEAT_INTERVAL
+        if deadline.hard_time is not None:
+            next_time = min(next_time, deadline.start_time + deadline.hard_time)
+
+        return next_time
+
+    def enforce(self, deadline, elapsed):
+        deadline.enforced = True
+        self.hung_analysis.append(deadline)
+        self.record(deadline, elapsed)
+
+        if self.enforcement == DEADLINE_ENFORCEMENT_CANCEL:
+            logging.error("cancelling analysis module {} analyzing {} in {} after {:.2f} seconds".format(
+                          deadline.analysis_module, deadline.target, deadline.root_uuid, elapsed))
+            try:
+                deadline.analysis_module.cancel_analysis()
+            except Exception as e:
+                logging.error("unable to cancel analysis module {}: {}".format(deadline.analysis_module, e))
+                report_exception()
+
+        elif self.enforcement == DEADLINE_ENFORCEMENT_KILL:
+            logging.critical("killing process {} - analysis module {} hung analyzing {} in {} for {:.2f} "
+                             "seconds".format(os.getpid(), deadline.analysis_module, deadline.target,
+                                              deadline.root_uuid, elapsed))
+            if self.kill_handler is not None:
+                try:
+                    self.kill_handler(deadline)
+                except Exception as e:
+                    logging.error("kill handler failed for {}: {}".format(deadline, e))
+                    report_exception()
+
+            logging.shutdown()
+            # the engine will start a new process manager to replace this one
+            os._exit(1)
+
+    def record(self, deadline, elapsed):
+        """Records the hung analysis to the record_path file, if one was given."""
+        if not self.record_path:
+            return
+
+        try:
+            with open(self.record_path, 'a') as fp:
+                fp.write('{} pid {} {} {} {} ({}) {:.2f} seconds - {}\n'.format(
+                         datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+                         os.getpid(),
+                         deadline.root_uuid,
+                         deadline.analysis_module,
+                         getattr(deadline.target, 'type', None),
+                         deadline.target,
+                         elapsed,
+                         self.enforcement))
+        except Exception as e:
+            logging.error("unable to record hung analysis to {}: {}".format(self.record_path, e))
@@ -0,0 +1,187 @@
+# vim: sw=4:ts=4:et:cc=120
+#
+# zygote process used to fork warm process managers
+#
+
+import ctypes
+import logging
+import os
+import signal
+import time
+
+from multiprocessing import Process, Pipe, Event, RawArray
+
+from saq.error import report_exception
+
+ZYGOTE_COMMAND_FORK = 'fork'
+ZYGOTE_COMMAND_SHUTDOWN = 'shutdown'
+
+class ZygoteChild(object):
+    """Handle to a process forked by a Zygote. Provides enough of the multiprocessing.Process interface
+       (pid, is_alive(), join(), exitcode) to be managed like one."""
+
+    def __init__(self, zygote, slot, pid):
+        self.zygote = zygote
+        self.slot = slot
+        self.pid = pid
+
+    @property
+    def exitcode(self):
+        if self.is_alive():
+            return None
+
+        return self.zygote.exitcodes[self.slot]
+
+    def is_alive(self):
+        # has the zygote moved on to a different process in this slot?
+        if self.zygote.pids[self.slot] != self.pid:
+            return False
+
+        # if the zygote is gone then nobody is left to update the pids
+        if not self.zygote.is_alive():
+            try:
+                os.kill(self.pid, 0)
+                return True
+            except OSError:
+                return False
+
+        return True
+
+    def join(self, timeout=None):
+        start = time.time()
+        while self.is_alive():
+            if timeout is not None and time.time() - start >= timeout:
+                return
+
+            time.sleep(0.05)
+
+    def stop(self):
+        """Asks the child to stop."""
+        self.zygote.stop_events[self.slot].set()
+
+    def __str__(self):
+        return "ZygoteChild(slot={},pid={})".format(self.slot, self.pid)
+
+class Zygote(object):
+    """A process that forks children to execute target(slot, stop_event).
+
+       The zygote is forked once after the expensive initialization (importing and loading the analysis modules) is
+       done and while the parent has no other threads running. Children are then forked from the small, single
+       threaded zygote on demand, instead of from the (large, multi-threaded) parent.
+       Each slot has a stop_event the child is expected to watch."""
+
+    def __init__(self, target, slot_count, name='Zygote'):
+        self.target = target
+        self.slot_count = slot_count
+        self.name = name
+        # the pid of the process running in each slot (0 if nothing is running)
+        self.pids = RawArray(ctypes.c_int, slot_count)
+        # the exit code of the last process that ran in each slot
+        self.exitcodes = RawArray(ctypes.c_int, slot_count)
+        self.stop_events = [Event() for _ in range(slot_count)]
+        self.command_pipe_p, self.command_pipe_c = Pipe()
+        self.process = None
+        self.parent_pid = None
+
+    def start(self):
+        self.parent_pid = os.getpid()
+        self.process = Process(target=self.loop, name=self.name)
+        self.process.start()
+        logging.info("started {} on process {}".format(self.name, self.process.pid))
+
+    def is_alive(self):
+        return self.process is not None and self.process.is_alive()
+
+    def fork(self, slot):
+        """Forks a new child to execute in the given slot. Returns a ZygoteChild."""
+        assert 0 <= slot < self.slot_count
+        self.command_pipe_p.send((ZYGOTE_COMMAND_FORK, slot))
+        pid = self.command_pipe_p.recv()
+        if not pid:
+            raise RuntimeError("{} unable to fork slot {}".format(self.name, slot))
+
+        return ZygoteChild(self, slot, pid)
+
+    def shutdown(self, timeout=None):
+        """Stops all the children and then the zygote."""
+        if self.process is None:
+            return
+
+        for event in self.stop_events:
+            event.set()
+
+        try:
+            self.command_pipe_p.send((ZYGOTE_COMMAND_SHUTDOWN, None))
+        except Exception as e:
+            logging.error("unable to send shutdown to {}: {}".format(self.name, e))
+
+        self.process.join(timeout)
+        if self.process.is_alive():
+            logging.warning("sending SIGKILL to {} {}".format(self.name, self.process.pid))
+            os.kill(self.process.pid, signal.SIGKILL)
+            self.process.join()
+
+        self.process = None
+
+    # the rest of these execute inside the zygote process
+
+    def loop(self):
+        children = {} # key = slot, value = Process
+        shutdown = False
+
+        while True:
+            # reap the children that have exited
+            for slot, child in list(children.items()):
+                child.join(0)
+                if not child.is_alive():
+                    self.exitcodes[slot] = child.exitcode if child.exitcode is not None else 0
+                    if self.pids[slot] == child.pid:
+                        self.pids[slot] = 0
+
+                    del children[slot]
+
+            if shutdown and not children:
+                break
+
+            # if the parent dies then so do we (after the children finish)
+            if os.getppid() != self.parent_pid and not shutdown:
+                logging.warning("parent of {} exited".format(self.name))
+                for event in self.stop_events:
+                    event.set()
+                shutdown = True
+
+            try:
+                if shutdown or not self.command_pipe_c.poll(0.1):
+                    if shutdown:
+                        time.sleep(0.1)
+                    continue
+
+                command, slot = self.command_pipe_c.recv()
+            except EOFError:
+                shutdown = True
+                continue
+
+            if command == ZYGOTE_COMMAND_SHUTDOWN:
+                shutdown = True
+                continue
+
+            if command == ZYGOTE_COMMAND_FORK:
+                try:
+                    if slot in children and children[slot].is_alive():
+                        raise RuntimeError("slot {} is already running process {}".format(slot, children[slot].pid))
+
+                    self.stop_events[slot].clear()
+                    child = Process(target=self.execute_child, args=(slot,), name=self.name)
+                    child.start()
+                    children[slot] = child
+                    self.pids[slot] = child.pid
+                    self.command_pipe_c.send(child.pid)
+                except Exception as e:
+                    logging.error("{} unable to fork slot {}: {}".format(self.name, slot, e))
+                    report_exception()
+                    self.command_pipe_c.send(0)
+
+        logging.debug("{} exiting".format(self.name))
+
+    def execute_child(self, slot):
+        self.target(slot, self.stop_events[slot])